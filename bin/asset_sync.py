@@ -0,0 +1,210 @@
+"""Merge the asset directories of several sources into the website.
+
+Lessons, and setup-documents, each have fig/, data/ and code/ directories
+which are merged into the top level directories of the same name. Rather than
+copying everything on every build, each file is only copied when it differs
+from what is already there, by size and then by content. A changed file is
+cloned (reflinked) if the filesystem supports it, otherwise hardlinked, and
+only copied if neither is possible.
+
+The files written for each group of sources are recorded in the build
+manifest, so files from a source which has since been removed from
+_config.yml are deleted. Two sources providing the same file is reported as a
+collision, with the source listed last in _config.yml winning as before.
+"""
+
+import os
+import errno
+import logging
+from pathlib import Path
+from shutil import copy2 as copy
+from typing import Dict, List, Tuple
+
+import instrumentation
+from build_manifest import hash_file, set_entry
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl, or reflinks, so files are hardlinked instead
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+# ioctl request to clone a file on Linux, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def clone_file(src: Path, dest: Path) -> str:
+    """
+    Put a copy of src at dest, sharing its data where possible.
+
+    Parameters
+    ----------
+    src:
+        The file to copy.
+    dest:
+        The path to copy it to, which must not exist.
+
+    Returns
+    -------
+    method:
+        How the file was copied: "reflink", "hardlink" or "copy".
+    """
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fp_src, open(dest, "wb") as fp_dest:
+                fcntl.ioctl(fp_dest.fileno(), FICLONE, fp_src.fileno())
+            os.utime(dest, ns=(src.stat().st_atime_ns, src.stat().st_mtime_ns))
+            return "reflink"
+        except OSError:
+            dest.unlink(missing_ok=True)
+
+    try:
+        os.link(src, dest)
+        return "hardlink"
+    except OSError as exc:
+        if exc.errno == errno.EEXIST:
+            raise
+
+    copy(src, dest)
+    return "copy"
+
+
+def files_match(src: Path, dest: Path) -> bool:
+    """
+    Check if dest already has the same contents as src.
+
+    Parameters
+    ----------
+    src:
+        The source file.
+    dest:
+        The destination file, which may not exist.
+    """
+    try:
+        src_stat = src.stat()
+        dest_stat = dest.stat()
+    except FileNotFoundError:
+        return False
+
+    if (src_stat.st_dev, src_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return True
+    if src_stat.st_size != dest_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dest_stat.st_mtime_ns:
+        return True
+
+    return hash_file(src) == hash_file(dest)
+
+
+def plan_sync(sources: List[Tuple[str, Path, str]]) -> Tuple[Dict[str, Tuple[Path, str]], List[Tuple[str, str, str]]]:
+    """
+    Work out which source each destination file should come from.
+
+    Parameters
+    ----------
+    sources:
+        The sources in order, each as (owner, source directory, destination
+        directory), e.g. ("shell-novice", "submodules/shell-novice/fig", "fig").
+
+    Returns
+    -------
+    plan, collisions:
+        The source file and owner keyed by destination path, and each
+        collision as (destination path, overwritten owner, winning owner).
+    """
+    plan = {}
+    collisions = []
+    for owner, src_dir, dest_dir in sources:
+        src_dir = Path(src_dir)
+        if not src_dir.is_dir():
+            continue
+        for src in sorted(src_dir.rglob("*")):
+            if not src.is_file() or ".git" in src.relative_to(src_dir).parts:
+                continue
+            dest = f"{dest_dir}/{src.relative_to(src_dir).as_posix()}"
+            if dest in plan and plan[dest][1] != owner:
+                collisions.append((dest, plan[dest][1], owner))
+            plan[dest] = (src, owner)
+
+    return plan, collisions
+
+
+def sync_assets(manifest: dict, group: str, sources: List[Tuple[str, Path, str]]) -> Dict[str, int]:
+    """
+    Bring the destination directories up to date with the sources.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest, which records the files written for each group.
+    group:
+        The name of this group of sources, e.g. the stage doing the sync.
+        Only files written for this group are ever removed.
+    sources:
+        The sources in order, as for plan_sync.
+
+    Returns
+    -------
+    stats:
+        The number of files which were unchanged, written, removed and which
+        collided, and the number of bytes written.
+    """
+    with instrumentation.span(f"sync {group} assets", "copy") as span_args:
+        stats = _sync_assets(manifest, group, sources)
+        span_args["files"] = stats["written"]
+        span_args["bytes"] = stats["bytes"]
+
+    return stats
+
+
+def _sync_assets(manifest: dict, group: str, sources: List[Tuple[str, Path, str]]) -> Dict[str, int]:
+    """Do the work of sync_assets, without recording a span."""
+    ledgers = manifest["assets"]
+    plan, collisions = plan_sync(sources)
+
+    for dest, old_owner, new_owner in collisions:
+        if files_match(plan[dest][0], Path(dest)) or old_owner == new_owner:
+            log.info(f"{dest} is in both {old_owner} and {new_owner}, with the same contents")
+        else:
+            log.warning(f"{dest} is in both {old_owner} and {new_owner}, using the one from {new_owner}")
+    for other_group, ledger in ledgers.items():
+        if other_group == group:
+            continue
+        for dest in sorted(set(plan) & set(ledger)):
+            log.warning(f"{dest} from {plan[dest][1]} is also written by {other_group} for {ledger[dest]}")
+
+    stats = {"unchanged": 0, "written": 0, "removed": 0, "collisions": len(collisions), "bytes": 0}
+    for dest, (src, owner) in plan.items():
+        dest = Path(dest)
+        if files_match(src, dest):
+            stats["unchanged"] += 1
+            continue
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.unlink(missing_ok=True)
+        method = clone_file(src, dest)
+        log.debug(f"Wrote {dest} from {owner} ({method})")
+        stats["written"] += 1
+        stats["bytes"] += dest.stat().st_size
+
+    for dest in sorted(set(ledgers.get(group, {})) - set(plan)):
+        path = Path(dest)
+        if path.is_file():
+            log.info(f"Removing {dest}, as {ledgers[group][dest]} is no longer in the build")
+            path.unlink()
+            stats["removed"] += 1
+            # Tidy up any directories left empty, but not the top level one
+            for parent in path.parents[:-2]:
+                try:
+                    parent.rmdir()
+                except OSError:
+                    break
+
+    set_entry(manifest, "assets", group, {dest: owner for dest, (_, owner) in plan.items()})
+    log.info(
+        f"Synced {group} assets: {stats['written']} written, {stats['unchanged']} unchanged, "
+        f"{stats['removed']} removed, {stats['collisions']} collisions"
+    )
+
+    return stats
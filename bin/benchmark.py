@@ -0,0 +1,1016 @@
+"""Benchmark the build scripts against synthetic lessons.
+
+The lessons are served from local bare git repositories, which are swapped in
+for https://github.com using git's url.<base>.insteadOf configuration, and a
+stub server stands in for the GitHub REST API, so no network access is needed.
+The benchmarks are run from a temporary workshop directory, leaving this
+repository untouched.
+
+The suite builds synthetic workshops of 5, 20 and 100 lessons, each with
+dozens of episodes, figures, data files and slides, with every stage of
+bin/build.py. It times each stage and the functions which scale with the
+number of lessons, from the trace of the build (see instrumentation.py), for
+a cold build with an empty cache, a warm rebuild of the unchanged workshop,
+and a forced rebuild of everything with the cache warm.
+
+The sparse benchmark gives each lesson large files which the build does not
+read, such as notebooks and datasets, and compares the bytes fetched into the
+cache, the size of the checkouts and the time taken by get_submodules.py for
+full and sparse checkouts. The export benchmark does the same for the size of
+what is deployed, comparing the working directory with the export of the
+website by export_site.py, and the time to commit each for the deploy.
+
+The results are printed as JSON, and can be written to a file with --output.
+Given the results of an earlier run with --compare, a benchmark exits with an
+error if anything has got slower by more than --threshold, or makes more
+fetches or API requests than before, so it can be used to catch regressions.
+
+Examples
+--------
+python3 bin/benchmark.py fetch --lessons 1 2 4 8
+python3 bin/benchmark.py slides --lessons 6
+python3 bin/benchmark.py sparse --lessons 10 --unused-mb 8
+python3 bin/benchmark.py export --lessons 10 --unused-mb 8
+python3 bin/benchmark.py --output baseline.json suite
+python3 bin/benchmark.py --compare baseline.json suite --lessons 5 20
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import datetime
+import platform
+import tempfile
+import threading
+import subprocess
+import contextlib
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+BIN_DIR = Path(__file__).resolve().parent
+
+# The workshop sizes built by the suite, and the size of each of their lessons
+SUITE_LESSONS = [5, 20, 100]
+SUITE_LESSON_SIZE = {"episodes": 24, "figures": 24, "data_files": 12, "slides": 40}
+
+# The builds run by the suite, with the environment each is run with
+SUITE_BUILDS = {"cold": {}, "warm": {}, "forced": {"RSG_FORCE_BUILD": "1"}}
+
+# The spans in the trace which time each function reported by the suite, as
+# the category and the start of the span name
+FUNCTION_SPANS = {
+    "check_org_name_and_branch": ("resolve", "resolve "),
+    "create_detailed_lesson_schedules": ("schedule", "schedule "),
+    "create_index_schedules": ("schedule", "index schedule"),
+    "setup.md": ("setup", "setup.md"),
+}
+
+# The smallest slow down, in seconds, which is counted as a regression, so
+# that noise in very short timings is not
+MIN_REGRESSION_SECONDS = 0.05
+
+# The counts which should never go up between runs
+COUNTED_METRICS = ["fetches", "api_requests"]
+
+
+def git(*args, cwd=None):
+    """Run a git command, raising an exception if it fails.
+
+    Parameters
+    ----------
+    args: str
+        The arguments to pass to git.
+    cwd: str, Path
+        The directory to run git in.
+    """
+    subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True)
+
+
+def episode_markdown(lesson_name, n, n_figures):
+    """Write the markdown of a synthetic episode, of a few KB.
+
+    Parameters
+    ----------
+    lesson_name: str
+        The name of the lesson.
+    n: int
+        The number of the episode.
+    n_figures: int
+        The number of figures in the lesson, one of which is shown.
+
+    Returns
+    -------
+    markdown: str
+        The episode.
+    """
+    paragraphs = []
+    for i in range(8):
+        paragraphs.append(
+            f"## Section {i + 1}\n\n"
+            + f"Some text about part {i + 1} of episode {n} of {lesson_name}. " * 6
+            + f"\n\n~~~\n$ python3 code/{lesson_name}.py --episode {n} --section {i + 1}\n~~~\n{{: .language-bash}}\n"
+        )
+    figure = f"![Figure {n}](../fig/{lesson_name}-{n % n_figures:02d}.png)\n\n" if n_figures else ""
+
+    return (
+        f"---\ntitle: Episode {n}\nteaching: 30\nexercises: 15\nquestions:\n- What is episode {n} about?\n"
+        f"objectives:\n- Understand episode {n}\nkeypoints:\n- Episode {n} is understood\n---\n"
+        + figure + "\n".join(paragraphs)
+    )
+
+
+def make_lesson_remote(remotes, org_name, lesson_name, branch="main", extra_files=None, episodes=1, figures=1,
+                       data_files=1, slides=1):
+    """Create a bare repository containing a synthetic lesson.
+
+    By default the lesson is as small as it can be, with one of each thing.
+
+    Parameters
+    ----------
+    remotes: Path
+        The directory which stands in for https://github.com.
+    org_name: str
+        The org to create the lesson in.
+    lesson_name: str
+        The name of the lesson, i.e. gh-name.
+    branch: str
+        The branch to commit the lesson to.
+    extra_files: dict[str, bytes]
+        Any other files to add to the repository, keyed by path.
+    episodes: int
+        The number of episodes, not counting the survey.
+    figures: int
+        The number of 16 KB figures in fig/.
+    data_files: int
+        The number of data files in data/, each with a code file in code/.
+    slides: int
+        The number of slides in the slide deck.
+
+    Returns
+    -------
+    path: Path
+        The path to the bare repository.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp)
+        for directory in ["_episodes", "fig", "data", "code", "slides"]:
+            (src / directory).mkdir()
+        if episodes == 1:
+            (src / "_episodes" / "01-introduction.md").write_text(f"---\ntitle: Introduction\n---\n{lesson_name}\n")
+        else:
+            for i in range(episodes):
+                (src / "_episodes" / f"{i + 1:02d}-episode-{i + 1}.md").write_text(
+                    episode_markdown(lesson_name, i + 1, figures)
+                )
+        (src / "_episodes" / "99-survey.md").write_text("---\ntitle: Survey\nslug: lesson-survey\n---\n")
+        (src / "reference.md").write_text("---\ntitle: Reference\n---\n")
+        (src / "blurb.html").write_text(f"<p>{lesson_name}</p>\n")
+        (src / "_config.yml").write_text(f"title: {lesson_name}\nsetup_docs:\n  - python.md\n")
+        if figures == 1:
+            (src / "fig" / f"{lesson_name}.png").write_bytes(os.urandom(1024))
+        else:
+            for i in range(figures):
+                (src / "fig" / f"{lesson_name}-{i:02d}.png").write_bytes(os.urandom(16 * 1024))
+        if data_files == 1:
+            (src / "data" / f"{lesson_name}.csv").write_text("a,b\n1,2\n")
+            (src / "code" / f"{lesson_name}.py").write_text("print('hello')\n")
+        else:
+            for i in range(data_files):
+                (src / "data" / f"{lesson_name}-{i:02d}.csv").write_text(
+                    "a,b,c\n" + "".join(f"{j},{j * i},{j % 7}\n" for j in range(200))
+                )
+                (src / "code" / f"{lesson_name}-{i:02d}.py").write_text(
+                    f"import csv\n\nwith open('data/{lesson_name}-{i:02d}.csv') as fp:\n    print(len(list(csv.reader(fp))))\n"
+                )
+        (src / "slides" / "index.md").write_text(
+            f"# {lesson_name}\n" + "".join(f"\n### Slide {i}\n\n- A point\n- Another point\n" for i in range(1, slides))
+        )
+        for path, contents in (extra_files or {}).items():
+            (src / path).parent.mkdir(parents=True, exist_ok=True)
+            (src / path).write_bytes(contents)
+
+        git("init", "--quiet", "-b", branch, cwd=src)
+        git("add", "--all", cwd=src)
+        git("-c", "user.name=Benchmark", "-c", "user.email=benchmark@localhost", "commit", "--quiet", "-m",
+            "Add lesson", cwd=src)
+
+        dest = remotes / org_name / f"{lesson_name}.git"
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        git("clone", "--quiet", "--bare", str(src), str(dest))
+        # Like GitHub, the remote serves partial clones
+        git("config", "uploadpack.allowFilter", "true", cwd=dest)
+        git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=dest)
+
+    return dest
+
+
+def make_setup_documents_remote(remotes):
+    """Create a bare repository standing in for setup-documents.
+
+    Parameters
+    ----------
+    remotes: Path
+        The directory which stands in for https://github.com.
+
+    Returns
+    -------
+    path: Path
+        The path to the bare repository.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        src = Path(tmp)
+        (src / "markdown").mkdir()
+        (src / "fig").mkdir()
+        for doc in ["python.md", "workshop.md"]:
+            (src / "markdown" / doc).write_text(f"## {doc}\n\n" + "Install the software. " * 200 + "\n")
+        for i in range(8):
+            (src / "fig" / f"setup-{i}.png").write_bytes(os.urandom(16 * 1024))
+
+        git("init", "--quiet", "-b", "main", cwd=src)
+        git("add", "--all", cwd=src)
+        git("-c", "user.name=Benchmark", "-c", "user.email=benchmark@localhost", "commit", "--quiet", "-m",
+            "Add setup documents", cwd=src)
+
+        dest = remotes / "Southampton-RSG-Training" / "setup-documents.git"
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        git("clone", "--quiet", "--bare", str(src), str(dest))
+        # Like GitHub, the remote serves partial clones
+        git("config", "uploadpack.allowFilter", "true", cwd=dest)
+        git("config", "uploadpack.allowAnySHA1InWant", "true", cwd=dest)
+
+    return dest
+
+
+@contextlib.contextmanager
+def git_environment(remotes, trace_dir):
+    """Point git at the local remotes and trace each git process.
+
+    Parameters
+    ----------
+    remotes: Path
+        The directory which stands in for https://github.com.
+    trace_dir: Path
+        The directory to write the git trace2 events into, one file per
+        process.
+    """
+    config = {
+        f"url.{remotes.as_uri()}/.insteadOf": "https://github.com/",
+        "protocol.file.allow": "always",
+        "advice.detachedHead": "false",
+    }
+    env = {"GIT_CONFIG_COUNT": str(len(config)), "GIT_TRACE2_EVENT": str(trace_dir)}
+    for i, (key, value) in enumerate(config.items()):
+        env[f"GIT_CONFIG_KEY_{i}"] = key
+        env[f"GIT_CONFIG_VALUE_{i}"] = value
+
+    old_env = {key: os.environ.get(key) for key in env}
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for key, value in old_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+class StubGitHubAPIHandler(BaseHTTPRequestHandler):
+    """Answer the GitHub REST API requests made by the build scripts.
+
+    Only /repos/{org}/{repo} and /repos/{org}/{repo}/branches/{branch} are
+    implemented, using the bare repositories in the server's remotes
+    directory. Responses have an ETag and conditional requests are answered
+    with a 304, like GitHub.
+    """
+
+    def do_GET(self):
+        self.server.n_requests += 1
+        parts = self.path.strip("/").split("/")
+        body = None
+
+        if len(parts) in (3, 5) and parts[0] == "repos":
+            repo = self.server.remotes / parts[1] / f"{parts[2]}.git"
+            if len(parts) == 3 and repo.is_dir():
+                body = {"full_name": f"{parts[1]}/{parts[2]}"}
+            elif len(parts) == 5 and parts[3] == "branches" and repo.is_dir():
+                head = subprocess.run(
+                    ["git", "rev-parse", "--verify", "--quiet", f"refs/heads/{parts[4]}"], cwd=repo,
+                    capture_output=True, text=True
+                )
+                if head.returncode == 0:
+                    body = {"name": parts[4], "commit": {"sha": head.stdout.strip()}}
+
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        body = json.dumps(body).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@contextlib.contextmanager
+def stub_github_api(remotes):
+    """Run a stub GitHub REST API for the local remotes in a thread.
+
+    Parameters
+    ----------
+    remotes: Path
+        The directory which stands in for https://github.com.
+
+    Yields
+    ------
+    server: ThreadingHTTPServer
+        The running server, which counts the requests made to it in
+        n_requests. Its URL is "http://{server_address[0]}:{server_address[1]}".
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubGitHubAPIHandler)
+    server.remotes = remotes
+    server.n_requests = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextlib.contextmanager
+def workshop_directory(path, lessons, delivery="static", **config):
+    """Create a workshop repository with the given lessons and change into it.
+
+    Parameters
+    ----------
+    path: Path
+        The directory to create the workshop in.
+    lessons: list[dict]
+        The lessons entries to write to _config.yml.
+    delivery: str
+        How the workshop is delivered.
+    config:
+        Anything else to write to _config.yml.
+    """
+    path.mkdir(parents=True, exist_ok=True)
+    git("init", "--quiet", cwd=path)
+    with open(path / "_config.yml", "w") as fp:
+        yaml.dump(
+            {"kind": "workshop", "delivery": delivery, "title": "Benchmark", "lessons": lessons, **config}, fp
+        )
+
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(cwd)
+
+
+def count_fetches(trace_dir):
+    """Count the number of fetches served by the local remotes.
+
+    Every clone or fetch which transfers objects from a local remote starts a
+    git-pack-objects process to build the pack, so counting those counts the
+    number of fetches. Asking for the refs with ls-remote or cloning from a
+    local mirror does not build a pack, so is not counted.
+
+    Parameters
+    ----------
+    trace_dir: Path
+        The directory containing the git trace2 events.
+
+    Returns
+    -------
+    n_fetches: int
+        The number of fetches.
+    """
+    n_fetches = 0
+    for trace in trace_dir.iterdir():
+        for line in trace.read_text().splitlines():
+            event = json.loads(line)
+            if event.get("event") == "cmd_name" and event.get("name") == "pack-objects":
+                n_fetches += 1
+
+    return n_fetches
+
+
+def make_workshop_remotes(remotes, n_lessons, **lesson_size):
+    """Create the remotes for a workshop of n lessons, and reveal.js.
+
+    reveal.js is made up of 64 files of 16 KB, so that copies of it are
+    noticeable in the size of the website.
+
+    Parameters
+    ----------
+    remotes: Path
+        The directory which stands in for https://github.com.
+    n_lessons: int
+        The number of lessons in the workshop.
+    lesson_size:
+        The number of episodes, figures etc. in each lesson, and any extra
+        files, passed on to make_lesson_remote.
+
+    Returns
+    -------
+    lessons: list[dict]
+        The lessons entries for _config.yml.
+    """
+    sys.path.insert(0, str(BIN_DIR))
+    import get_submodules
+
+    lessons = []
+    for i in range(n_lessons):
+        lesson_name = f"lesson-{i:03d}"
+        make_lesson_remote(remotes, "Southampton-RSG-Training", lesson_name, **lesson_size)
+        lessons.append({"title": f"Lesson {i}", "gh-name": lesson_name, "order": i + 1})
+
+    revealjs = make_lesson_remote(
+        remotes, "hakimel", "reveal.js", branch="master",
+        extra_files={f"js/plugin-{i:02d}.js": os.urandom(16 * 1024) for i in range(64)},
+    )
+    # The pinned commit of reveal.js does not exist in the local remote, so
+    # pin its only commit instead
+    get_submodules.REVEALJS_COMMIT = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=revealjs, check=True, capture_output=True, text=True
+    ).stdout.strip()
+
+    return lessons
+
+
+def run_get_submodules(tmp, remotes, lessons, name, **kwargs):
+    """Run get_submodules.py for a workshop, in tmp/workshop-{name}.
+
+    Parameters
+    ----------
+    tmp: Path
+        The temporary directory the benchmark is run in.
+    remotes: Path
+        The directory which stands in for https://github.com.
+    lessons: list[dict]
+        The lessons entries for _config.yml.
+    name: str
+        The name of the build.
+    kwargs:
+        Passed on to get_submodules.main, the cache defaults to tmp/cache.
+
+    Returns
+    -------
+    result: dict
+        The number of fetches, GitHub API requests and the wall time in
+        seconds, keyed by {name}_fetches etc.
+    """
+    sys.path.insert(0, str(BIN_DIR))
+    import github_api
+    import get_submodules
+
+    trace_dir = tmp / f"trace-{name}"
+    trace_dir.mkdir()
+    with stub_github_api(remotes) as api, git_environment(remotes, trace_dir), \
+            workshop_directory(tmp / f"workshop-{name}", lessons):
+        github_api.GITHUB_API_URL = "http://{}:{}".format(*api.server_address)
+        start = time.perf_counter()
+        get_submodules.main(**{"cache_dir": tmp / "cache", **kwargs})
+        seconds = time.perf_counter() - start
+
+    return {
+        f"{name}_fetches": count_fetches(trace_dir),
+        f"{name}_api_requests": api.n_requests,
+        f"{name}_seconds": round(seconds, 3),
+    }
+
+
+def deployed_size(path):
+    """Get the size, in bytes, of the files in a directory.
+
+    A file with several hardlinks is only counted once, as it is only
+    uploaded once.
+
+    Parameters
+    ----------
+    path: Path
+        The directory.
+    """
+    seen = set()
+    size = 0
+    for file in Path(path).rglob("*"):
+        stat = file.lstat()
+        if file.is_file() and (stat.st_dev, stat.st_ino) not in seen:
+            seen.add((stat.st_dev, stat.st_ino))
+            size += stat.st_size
+
+    return size
+
+
+def bench_fetch(n_lessons, jobs, resolver="api"):
+    """Time get_submodules.py and count fetches for a workshop of n lessons.
+
+    get_submodules.py is run twice with the same cache, to measure a cold build
+    with an empty cache and a warm rebuild of the unchanged workshop.
+
+    Parameters
+    ----------
+    n_lessons: int
+        The number of lessons in the workshop.
+    jobs: int
+        The number of lessons to fetch concurrently.
+    resolver: str
+        How get_submodules.py checks each lesson's org and branch.
+
+    Returns
+    -------
+    result: dict
+        The number of lessons, and the number of fetches, GitHub API requests
+        and the wall time in seconds for the cold and warm builds.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        remotes = tmp / "remotes"
+        lessons = make_workshop_remotes(remotes, n_lessons)
+
+        result = {"lessons": n_lessons}
+        for build in ["cold", "warm"]:
+            result.update(run_get_submodules(tmp, remotes, lessons, build, jobs=jobs, resolver=resolver))
+
+        return result
+
+
+def bench_slides(n_lessons):
+    """Measure the size of slides/ for each way of adding reveal.js to the decks.
+
+    Parameters
+    ----------
+    n_lessons: int
+        The number of lessons, each with a slide deck, in the workshop.
+
+    Returns
+    -------
+    result: dict
+        The number of lessons and the size of slides/, in bytes, for each mode.
+    """
+    sys.path.insert(0, str(BIN_DIR))
+    import get_submodules
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        remotes = tmp / "remotes"
+        lessons = make_workshop_remotes(remotes, n_lessons)
+
+        result = {"lessons": n_lessons}
+        for mode in get_submodules.REVEALJS_MODES:
+            run_get_submodules(tmp, remotes, lessons, mode, revealjs_mode=mode)
+            result[f"{mode}_bytes"] = deployed_size(tmp / f"workshop-{mode}" / "slides")
+
+        return result
+
+
+def suite_lessons(n_lessons, start_date):
+    """Get the lessons entries for a dated workshop of n lessons, one a day.
+
+    Parameters
+    ----------
+    n_lessons: int
+        The number of lessons in the workshop.
+    start_date: datetime.date
+        The date of the first lesson.
+
+    Returns
+    -------
+    lessons: list[dict]
+        The lessons entries for _config.yml.
+    """
+    return [
+        {
+            "title": f"Lesson {i}", "gh-name": f"lesson-{i:03d}", "type": "episode",
+            "date": str(start_date + datetime.timedelta(days=i)), "start-time": "9:30" if i % 2 else "13:30",
+        }
+        for i in range(n_lessons)
+    ]
+
+
+def timings_from_trace(events):
+    """Get the time taken by each stage and function from a trace.
+
+    Parameters
+    ----------
+    events: list[dict]
+        The events in the trace.
+
+    Returns
+    -------
+    stages, functions: dict, dict
+        The seconds taken by each stage, and the number of calls and seconds
+        taken by each function in FUNCTION_SPANS.
+    """
+    stages = {}
+    functions = {function: {"calls": 0, "seconds": 0.0} for function in FUNCTION_SPANS}
+    for event in events:
+        seconds = event["dur"] / 1e6
+        if event["cat"] == "stage":
+            stages[event["name"]] = {"seconds": round(stages.get(event["name"], {}).get("seconds", 0) + seconds, 3)}
+        for function, (category, prefix) in FUNCTION_SPANS.items():
+            if event["cat"] == category and event["name"].startswith(prefix):
+                functions[function]["calls"] += 1
+                functions[function]["seconds"] += seconds
+
+    for timing in functions.values():
+        timing["seconds"] = round(timing["seconds"], 6)
+
+    return stages, functions
+
+
+def run_build(tmp, remotes, lessons, name, jobs, env=None):
+    """Build a workshop with every stage of bin/build.py, in tmp/workshop.
+
+    The stages are run in this process, so that the stub API and the pinned
+    commit of reveal.js are used, and traced into tmp/trace-{name}.json.
+
+    Parameters
+    ----------
+    tmp: Path
+        The temporary directory the benchmark is run in.
+    remotes: Path
+        The directory which stands in for https://github.com.
+    lessons: list[dict]
+        The lessons entries for _config.yml.
+    name: str
+        The name of the build.
+    jobs: int
+        The number of lessons to fetch concurrently.
+    env: dict or None
+        Environment variables to set during the build.
+
+    Returns
+    -------
+    result: dict
+        The wall time, number of fetches and GitHub API requests of the build,
+        and the time taken by each stage and function.
+    """
+    sys.path.insert(0, str(BIN_DIR))
+    import build
+    import github_api
+    import instrumentation
+    from workshop_config import load_config
+
+    trace_dir = tmp / f"git-trace-{name}"
+    trace_dir.mkdir()
+    trace = tmp / f"trace-{name}.json"
+    env = {instrumentation.TRACE_ENV: str(trace), **(env or {})}
+    os.environ.update(env)
+    try:
+        with stub_github_api(remotes) as api, git_environment(remotes, trace_dir), \
+                workshop_directory(
+                    tmp / "workshop", lessons, delivery="dated", startdate=lessons[0]["date"],
+                    enddate=lessons[-1]["date"], setup_docs=["workshop.md"]
+                ) as path:
+            favicon = Path("assets/favicons/rsg/rsg_fav_base.png")
+            (path / favicon).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(BIN_DIR.parent / favicon, path / favicon)
+
+            github_api.GITHUB_API_URL = "http://{}:{}".format(*api.server_address)
+            start = time.perf_counter()
+            results = build.run_stages(build.STAGES, load_config(), jobs, tmp / "cache")
+            seconds = time.perf_counter() - start
+            instrumentation.save_trace()
+    finally:
+        for key in env:
+            os.environ.pop(key)
+
+    failed = [stage for stage, result in results.items() if result["status"] == "failed"]
+    if failed:
+        raise RuntimeError(f"The {name} build failed in {', '.join(failed)}")
+
+    with open(trace, "r") as fp:
+        stages, functions = timings_from_trace(json.load(fp)["traceEvents"])
+
+    return {
+        "seconds": round(seconds, 3),
+        "fetches": count_fetches(trace_dir),
+        "api_requests": api.n_requests,
+        "stages": stages,
+        "functions": functions,
+    }
+
+
+def bench_suite(n_lessons, jobs):
+    """Build a synthetic workshop of n lessons, cold, warm then forced.
+
+    Parameters
+    ----------
+    n_lessons: int
+        The number of lessons in the workshop.
+    jobs: int
+        The number of lessons to fetch concurrently.
+
+    Returns
+    -------
+    result: dict
+        The size of the workshop, and the timings of each build in
+        SUITE_BUILDS, from run_build.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        remotes = tmp / "remotes"
+        make_workshop_remotes(remotes, n_lessons, **SUITE_LESSON_SIZE)
+        make_setup_documents_remote(remotes)
+        lessons = suite_lessons(n_lessons, datetime.date(2030, 1, 7))
+
+        result = {"lessons": n_lessons, **SUITE_LESSON_SIZE}
+        for build, env in SUITE_BUILDS.items():
+            result[build] = run_build(tmp, remotes, lessons, build, jobs, env)
+
+        return result
+
+
+def flatten(results):
+    """Flatten benchmark results into a dict of metrics.
+
+    Parameters
+    ----------
+    results: list[dict]
+        The results of a benchmark, one for each workshop size.
+
+    Returns
+    -------
+    metrics: dict
+        Each number in the results, keyed by the workshop size and its path
+        within the results, e.g. "20 lessons/cold/stages/get_setup/seconds".
+    """
+    metrics = {}
+
+    def add(prefix, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                add(f"{prefix}/{key}", item)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            metrics[prefix] = value
+
+    for result in results:
+        add(f"{result['lessons']} lessons", result)
+
+    return metrics
+
+
+def compare_results(baseline, results, threshold):
+    """Find the regressions since an earlier run of a benchmark.
+
+    A timing is a regression if it is more than threshold slower than the
+    baseline, and at least MIN_REGRESSION_SECONDS slower. A count in
+    COUNTED_METRICS is a regression if it is larger at all.
+
+    Parameters
+    ----------
+    baseline: list[dict]
+        The results of the earlier run.
+    results: list[dict]
+        The results of this run.
+    threshold: float
+        The fraction a timing can slow down by, e.g. 0.25 for 25%.
+
+    Returns
+    -------
+    regressions: list[str]
+        A description of each regression.
+    """
+    old = flatten(baseline)
+    regressions = []
+    for key, value in flatten(results).items():
+        if key not in old:
+            continue
+        metric = key.rsplit("/", 1)[-1]
+        if metric == "seconds":
+            slower = value - old[key]
+            if slower > MIN_REGRESSION_SECONDS and value > old[key] * (1 + threshold):
+                regressions.append(f"{key}: {old[key]} s -> {value} s")
+        elif metric in COUNTED_METRICS and value > old[key]:
+            regressions.append(f"{key}: {old[key]} -> {value}")
+
+    return regressions
+
+
+def bench_sparse(n_lessons, jobs, unused_mb):
+    """Compare full and sparse checkouts of lessons with large unused files.
+
+    Each checkout mode starts with its own empty cache.
+
+    Parameters
+    ----------
+    n_lessons: int
+        The number of lessons in the workshop.
+    jobs: int
+        The number of lessons to fetch concurrently.
+    unused_mb: int
+        The size, in MB, of the files in each lesson which the build does not
+        read.
+
+    Returns
+    -------
+    result: dict
+        The number of lessons, and for each mode the number of fetches, the
+        wall time in seconds, the size of the cache and the size of the
+        checkouts in submodules/, in bytes.
+    """
+    sys.path.insert(0, str(BIN_DIR))
+    import lesson_cache
+
+    # Random contents, so the files do not compress
+    unused_files = {
+        f"notebooks/episode-{i:02d}.ipynb": os.urandom(2**20 // 2) for i in range(unused_mb)
+    }
+    unused_files.update({f"datasets/raw-{i:02d}.bin": os.urandom(2**20 // 2) for i in range(unused_mb)})
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        remotes = tmp / "remotes"
+        lessons = make_workshop_remotes(remotes, n_lessons, extra_files=unused_files)
+
+        result = {"lessons": n_lessons}
+        for mode in lesson_cache.CHECKOUT_MODES:
+            cache_dir = tmp / f"cache-{mode}"
+            result.update(
+                run_get_submodules(tmp, remotes, lessons, mode, cache_dir=cache_dir, jobs=jobs, checkout=mode)
+            )
+            result[f"{mode}_cache_bytes"] = lesson_cache.directory_size(cache_dir)
+            result[f"{mode}_checkout_bytes"] = deployed_size(tmp / f"workshop-{mode}" / "submodules")
+
+        return result
+
+
+def commit_seconds(path):
+    """Time committing the files in a directory to a new git repository, as
+    the deploy to gh-pages does.
+
+    Parameters
+    ----------
+    path: Path
+        The directory to commit, other than any .git directories.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copytree(path, tmp, ignore=shutil.ignore_patterns(".git"), dirs_exist_ok=True)
+        start = time.perf_counter()
+        git("init", "--quiet", cwd=tmp)
+        git("add", "--all", cwd=tmp)
+        git("-c", "user.name=Benchmark", "-c", "user.email=benchmark@example.com", "commit", "--quiet", "-m", "Deploy",
+            cwd=tmp)
+        return time.perf_counter() - start
+
+
+def bench_export(n_lessons, jobs, unused_mb):
+    """Compare deploying the working directory with deploying the export of
+    the website, for lessons with large files the website does not use.
+
+    Parameters
+    ----------
+    n_lessons: int
+        The number of lessons in the workshop.
+    jobs: int
+        The number of lessons to fetch concurrently.
+    unused_mb: int
+        The size, in MB, of the files in each lesson which the website does
+        not use.
+
+    Returns
+    -------
+    result: dict
+        The number of lessons, the size in bytes of the working directory and
+        the export, the time to export the website from scratch and again
+        unchanged, and the time to commit each tree for the deploy.
+    """
+    sys.path.insert(0, str(BIN_DIR))
+    import export_site
+
+    unused_files = {f"datasets/raw-{i:02d}.bin": os.urandom(2**20) for i in range(unused_mb)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        remotes = tmp / "remotes"
+        lessons = make_workshop_remotes(remotes, n_lessons, extra_files=unused_files)
+        run_get_submodules(tmp, remotes, lessons, "export", jobs=jobs)
+
+        # The exclude list of the template's own _config.yml decides what is
+        # left out of the export
+        with open(BIN_DIR.parent / "_config.yml", "r") as fp:
+            exclude = yaml.safe_load(fp).get("exclude", [])
+        with workshop_directory(tmp / "workshop-export", lessons, exclude=exclude) as path:
+            result = {"lessons": n_lessons}
+            for run in ["cold", "warm"]:
+                start = time.perf_counter()
+                export_site.export_site(Path(export_site.DEFAULT_DEPLOY_DIR), jobs)
+                result[f"export_{run}_seconds"] = round(time.perf_counter() - start, 3)
+
+            deploy_dir = path / export_site.DEFAULT_DEPLOY_DIR
+            result["working_directory_bytes"] = export_site.directory_totals(path, skip=[deploy_dir])["bytes"]
+            result["export_bytes"] = export_site.directory_totals(deploy_dir)["bytes"]
+            shutil.rmtree(path / ".git")
+            result["commit_working_directory_seconds"] = round(commit_seconds(path), 3)
+            result["commit_export_seconds"] = round(commit_seconds(deploy_dir), 3)
+
+        return result
+
+
+def main():
+    """Parse the command line and run the requested benchmark.
+
+    Returns
+    -------
+    returncode: int
+        1 if there are regressions compared to --compare, otherwise 0.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", type=Path, help="file to write the results to, as JSON")
+    parser.add_argument("--compare", type=Path, help="results of an earlier run to check for regressions against")
+    parser.add_argument(
+        "--threshold", type=float, default=0.25,
+        help="fraction a timing can slow down by before it is a regression, defaults to 0.25"
+    )
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    fetch = subparsers.add_parser("fetch", help="count fetches made by get_submodules.py")
+    fetch.add_argument("--lessons", type=int, nargs="+", default=[1, 2, 4, 8], help="workshop sizes to benchmark")
+    fetch.add_argument("-j", "--jobs", type=int, default=8, help="number of lessons to fetch concurrently")
+    fetch.add_argument("--resolver", default="api", help="how to check each lesson's org and branch")
+    slides = subparsers.add_parser("slides", help="measure the size of the slides for each reveal.js mode")
+    slides.add_argument("--lessons", type=int, nargs="+", default=[6], help="workshop sizes to benchmark")
+    sparse = subparsers.add_parser("sparse", help="compare full and sparse checkouts of lessons with unused files")
+    sparse.add_argument("--lessons", type=int, nargs="+", default=[10], help="workshop sizes to benchmark")
+    sparse.add_argument("-j", "--jobs", type=int, default=8, help="number of lessons to fetch concurrently")
+    sparse.add_argument(
+        "--unused-mb", type=int, default=8, help="size in MB of the files in each lesson the build does not read"
+    )
+    export = subparsers.add_parser("export", help="compare deploying the working directory and the export")
+    export.add_argument("--lessons", type=int, nargs="+", default=[10], help="workshop sizes to benchmark")
+    export.add_argument("-j", "--jobs", type=int, default=8, help="number of lessons to fetch concurrently")
+    export.add_argument(
+        "--unused-mb", type=int, default=8, help="size in MB of the files in each lesson the website does not use"
+    )
+    suite = subparsers.add_parser("suite", help="time each stage of the build for large synthetic workshops")
+    suite.add_argument("--lessons", type=int, nargs="+", default=SUITE_LESSONS, help="workshop sizes to benchmark")
+    suite.add_argument("-j", "--jobs", type=int, default=8, help="number of lessons to fetch concurrently")
+    args = parser.parse_args()
+
+    # Read the baseline first, so a missing file is found before the benchmark
+    # is run rather than after
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r") as fp:
+            baseline = json.load(fp)["results"]
+
+    if args.benchmark == "fetch":
+        results = [bench_fetch(n, args.jobs, args.resolver) for n in args.lessons]
+    elif args.benchmark == "slides":
+        results = [bench_slides(n) for n in args.lessons]
+    elif args.benchmark == "sparse":
+        results = [bench_sparse(n, args.jobs, args.unused_mb) for n in args.lessons]
+    elif args.benchmark == "export":
+        results = [bench_export(n, args.jobs, args.unused_mb) for n in args.lessons]
+    elif args.benchmark == "suite":
+        results = [bench_suite(n, args.jobs) for n in args.lessons]
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=BIN_DIR, capture_output=True, text=True)
+        run = {
+            "benchmark": args.benchmark,
+            "commit": commit.stdout.strip() or None,
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        }
+        with open(args.output, "w") as fp:
+            json.dump({"run": run, "results": results}, fp, indent=2)
+
+    if baseline is not None:
+        regressions = compare_results(baseline, results, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print(f"No regressions compared to {args.compare}", file=sys.stderr)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
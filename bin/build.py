@@ -0,0 +1,601 @@
+"""Build the workshop website by running the build scripts.
+
+By default every stage, see STAGES, is run one after another in this process.
+The stages share the parsed _config.yml and the modules they import, and
+get_submodules.py fetches the lessons in a pool of threads and builds their
+slides in a pool of processes. Name one or more stages, e.g. `bin/build.py
+get_schedules get_setup`, to run just those stages.
+
+With --graph, the build is instead run as a graph of tasks. Each task declares
+the paths it reads and writes. A task waits for the tasks before it which
+write a path it reads or writes, or read a path it writes, and otherwise runs
+at the same time as them. get_submodules.py is run as its steps, with the
+clone, content and slides of each lesson as separate tasks. For example, the
+favicons are generated and setup-documents is fetched while the lessons are
+being fetched, a lesson's slides are built as soon as it and reveal.js are
+checked out, while other lessons are still being cloned, and the schedules and
+setup.md are written at the same time once the lessons are in place. The tasks
+are listed in an order they could be run one after another, so the graph has
+the same result as doing so.
+
+Each task runs in its own process, with its output prefixed by the task name,
+and at most --jobs tasks run at the same time. Starting a process costs about
+a quarter of a second for each task, so the graph is only quicker with several
+cores and lessons which take a while to clone and build.
+
+A timing summary, with the critical path through the build, is printed at the
+end.
+
+With --trace, a trace of where the time went in every stage is written, see
+instrumentation.py.
+"""
+
+import os
+import sys
+import time
+import argparse
+import importlib
+import logging
+import subprocess
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path, PurePosixPath
+from typing import Dict, List, NamedTuple, Optional
+
+import instrumentation
+from lesson_lock import LockError, load_lock, locked_lessons
+from workshop_config import ConfigError, WorkshopConfig, load_config
+
+log = logging.getLogger(__name__)
+
+BIN_DIR = Path(__file__).resolve().parent
+
+# The number of tasks to run at the same time
+DEFAULT_JOBS = 8
+
+# The stages which can be run in this process, in the order they would be run
+STAGES = ["get_submodules", "make_favicons", "get_schedules", "get_setup"]
+
+# Output from the tasks is written a line at a time, so lines from tasks
+# running at the same time are not mixed up
+_output_lock = threading.Lock()
+
+
+class Task(NamedTuple):
+    """A build script to run, with the paths it reads and writes."""
+
+    name: str
+    command: List[str]
+    inputs: List[str]
+    outputs: List[str]
+
+
+def overlaps(paths: List[str], other_paths: List[str]) -> bool:
+    """
+    Check if any path is the same as, or inside, one of the other paths or the
+    other way around.
+
+    Parameters
+    ----------
+    paths:
+        The paths, relative to the top of the website.
+    other_paths:
+        The other paths, relative to the top of the website.
+    """
+    for path in map(PurePosixPath, paths):
+        for other in map(PurePosixPath, other_paths):
+            if path == other or path in other.parents or other in path.parents:
+                return True
+
+    return False
+
+
+def build_tasks(website_config: WorkshopConfig, script_args: Dict[str, List[str]]) -> List[Task]:
+    """
+    Describe the tasks which build the website.
+
+    get_submodules.py is split into its steps, with the clone, content and
+    slides of each lesson as tasks of their own, so e.g. the slides of one
+    lesson are built while another lesson is still being cloned. The
+    "get_submodules" task registers the lessons as submodules once every
+    lesson is in place.
+
+    Parameters
+    ----------
+    website_config:
+        The website config.
+    script_args:
+        Extra arguments for each script, keyed by the name of the script.
+
+    Returns
+    -------
+    tasks:
+        The tasks, in an order they could be run one after another.
+    """
+    lesson_names = website_config.lesson_names
+    lesson_dirs = [f"submodules/{lesson_name}" for lesson_name in lesson_names]
+    lesson_outputs = {
+        lesson_name: [f"_includes/rsg/{lesson_name}-lesson", f"_episodes/{lesson_name}-lesson"]
+        for lesson_name in lesson_names
+    }
+
+    def script(name, *args):
+        return [sys.executable, str(BIN_DIR / f"{name}.py"), *args, *script_args.get(name, [])]
+
+    def step(name, lesson_name=None):
+        lesson_args = ["--lesson", lesson_name] if lesson_name else []
+        return script("get_submodules", "--step", name, *lesson_args)
+
+    # The tasks with nothing to wait for come first, so they are started first
+    tasks = [
+        Task(
+            "reveal.js", step("reveal.js"),
+            inputs=[],
+            outputs=["submodules/reveal.js", "slides/reveal.js"],
+        ),
+        Task(
+            "setup-documents", script("get_setup", "--fetch-only"),
+            inputs=[],
+            outputs=["submodules/setup-documents"],
+        ),
+        Task(
+            "make_favicons", script("make_favicons"),
+            inputs=["_config.yml"] + website_config.favicons,
+            outputs=[str(PurePosixPath(image).parent) for image in website_config.favicons],
+        ),
+    ]
+    for lesson_name in lesson_names:
+        tasks.append(Task(
+            f"clone/{lesson_name}", step("clone", lesson_name),
+            inputs=["_config.yml"],
+            outputs=[f"submodules/{lesson_name}"],
+        ))
+    for lesson_name in lesson_names:
+        tasks += [
+            Task(
+                f"content/{lesson_name}", step("content", lesson_name),
+                inputs=["_config.yml", f"submodules/{lesson_name}"],
+                outputs=lesson_outputs[lesson_name],
+            ),
+            Task(
+                f"slides/{lesson_name}", step("slides", lesson_name),
+                inputs=[f"submodules/{lesson_name}", "submodules/reveal.js"],
+                outputs=[f"slides/{lesson_name}"],
+            ),
+        ]
+
+    # Registering the lessons also trims the cache and the lesson store, so
+    # waits for everything which reads them
+    tasks += [
+        Task(
+            "assets", step("assets"),
+            inputs=["_config.yml"] + lesson_dirs,
+            outputs=["fig", "data", "code"],
+        ),
+        Task(
+            "get_submodules", step("register"),
+            inputs=["_config.yml", "submodules/reveal.js", "slides", "fig"] + lesson_dirs + [
+                path for outputs in lesson_outputs.values() for path in outputs
+            ],
+            outputs=[".gitmodules"],
+        ),
+        Task(
+            "get_schedules", script("get_schedules"),
+            inputs=["_config.yml", "_includes/rsg"] + lesson_dirs,
+            outputs=["_includes/rsg/schedule.html", "_episodes"],
+        ),
+        Task(
+            "get_setup", script("get_setup", "--no-fetch"),
+            inputs=["_config.yml", "submodules/setup-documents"] + [f"{path}/_config.yml" for path in lesson_dirs],
+            outputs=["setup.md", "fig", ".gitmodules"],
+        ),
+    ]
+
+    return tasks
+
+
+def task_dependencies(tasks: List[Task]) -> Dict[str, List[str]]:
+    """
+    Work out which tasks each task has to wait for.
+
+    A task depends on an earlier task when it reads something the earlier
+    task writes, writes something the earlier task reads, or they both write
+    the same thing.
+
+    Parameters
+    ----------
+    tasks:
+        The tasks, in the order they would be run one after another.
+
+    Returns
+    -------
+    dependencies:
+        The names of the tasks each task depends on, keyed by task name.
+    """
+    dependencies = {}
+    for i, task in enumerate(tasks):
+        dependencies[task.name] = [
+            earlier.name for earlier in tasks[:i]
+            if overlaps(task.inputs + task.outputs, earlier.outputs) or overlaps(task.outputs, earlier.inputs)
+        ]
+
+    return dependencies
+
+
+def run_task(task: Task) -> int:
+    """
+    Run a task, prefixing each line of its output with the task name.
+
+    Parameters
+    ----------
+    task:
+        The task to run.
+
+    Returns
+    -------
+    returncode:
+        The exit status of the task.
+    """
+    with instrumentation.span(task.name, "task") as span_args:
+        process = subprocess.Popen(
+            task.command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace"
+        )
+        for line in process.stdout:
+            with _output_lock:
+                print(f"[{task.name}] {line}", end="", flush=True)
+        span_args["returncode"] = process.wait()
+
+    return span_args["returncode"]
+
+
+def run_tasks(tasks: List[Task], dependencies: Dict[str, List[str]],
+              max_running: Optional[int] = None) -> Dict[str, dict]:
+    """
+    Run each task as soon as the tasks it depends on have finished.
+
+    A task is not run if a task it depends on fails. When more tasks are ready
+    than can run at once, they are started in the order they are listed.
+
+    Parameters
+    ----------
+    tasks:
+        The tasks to run.
+    dependencies:
+        The names of the tasks each task depends on, from task_dependencies.
+    max_running:
+        The most tasks to run at the same time, or None for no limit.
+
+    Returns
+    -------
+    results:
+        The status ("ok", "failed" or "skipped") of each task, and the start
+        and end times, in seconds from the start of the build, of each task
+        which ran, keyed by task name.
+    """
+    start = time.perf_counter()
+    results = {}
+    pending = list(tasks)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as pool:
+        while pending or running:
+            for task in list(pending):
+                statuses = [results.get(name, {}).get("status") for name in dependencies[task.name]]
+                if any(status in ("failed", "skipped") for status in statuses):
+                    log.error(f"Not running {task.name}, as a task it depends on did not succeed")
+                    results[task.name] = {"status": "skipped"}
+                    pending.remove(task)
+                elif all(status == "ok" for status in statuses):
+                    if max_running is not None and len(running) >= max_running:
+                        continue
+                    log.info(f"Starting {task.name}")
+                    results[task.name] = {"start": time.perf_counter() - start}
+                    running[pool.submit(run_task, task)] = task
+                    pending.remove(task)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                results[task.name]["end"] = time.perf_counter() - start
+                try:
+                    returncode = future.result()
+                except OSError as exc:
+                    log.error(f"Unable to run {task.name}: {exc}")
+                    returncode = -1
+                results[task.name]["status"] = "ok" if returncode == 0 else "failed"
+                if returncode != 0:
+                    log.error(f"{task.name} failed with exit status {returncode}")
+
+    return results
+
+
+def critical_path(results: Dict[str, dict], dependencies: Dict[str, List[str]]) -> List[str]:
+    """
+    Find the chain of tasks which determined how long the build took.
+
+    This starts from the task which finished last and repeatedly steps back to
+    whichever of its dependencies finished last.
+
+    Parameters
+    ----------
+    results:
+        The results of each task, from run_tasks.
+    dependencies:
+        The names of the tasks each task depends on.
+
+    Returns
+    -------
+    path:
+        The names of the tasks on the critical path, in the order they ran.
+    """
+    finished = {name: result for name, result in results.items() if "end" in result}
+    if not finished:
+        return []
+
+    path = [max(finished, key=lambda name: finished[name]["end"])]
+    while True:
+        previous = [name for name in dependencies[path[0]] if name in finished]
+        if not previous:
+            return path
+        path.insert(0, max(previous, key=lambda name: finished[name]["end"]))
+
+
+def print_summary(names: List[str], results: Dict[str, dict], dependencies: Dict[str, List[str]]) -> None:
+    """
+    Print how long each task took, marking the tasks on the critical path.
+
+    Parameters
+    ----------
+    names:
+        The names of the tasks which were run.
+    results:
+        The results of each task, from run_tasks.
+    dependencies:
+        The names of the tasks each task depends on.
+    """
+    path = critical_path(results, dependencies)
+    width = max(len(name) for name in names)
+
+    print(f"\n{'task':<{width}}  {'status':<7}  {'start':>8}  {'time':>8}")
+    for name in names:
+        result = results[name]
+        if "end" in result:
+            timing = f"{result['start']:7.2f}s  {result['end'] - result['start']:7.2f}s"
+        else:
+            timing = f"{'-':>8}  {'-':>8}"
+        marker = "  *" if name in path else ""
+        print(f"{name:<{width}}  {result['status']:<7}  {timing}{marker}")
+
+    if path:
+        total = max(result["end"] for result in results.values() if "end" in result)
+        serial = sum(result["end"] - result["start"] for result in results.values() if "end" in result)
+        print(
+            f"\nCritical path (*): {' -> '.join(path)}, {total:.2f} s in total, "
+            f"compared to {serial:.2f} s running the tasks one after another"
+        )
+
+
+def run_stage(stage: str, website_config: WorkshopConfig, jobs: Optional[int] = None,
+              cache_dir: Optional[Path] = None) -> None:
+    """
+    Run a stage in this process.
+
+    The stage's module is only imported when it is run, so e.g. running just
+    get_schedules does not import requests. Options which are not given take
+    the same defaults, from the environment, as running the script directly.
+
+    Parameters
+    ----------
+    stage:
+        The stage to run, one of STAGES.
+    website_config:
+        The website config, shared by every stage.
+    jobs:
+        The number of lessons to fetch at the same time, or None for the
+        default.
+    cache_dir:
+        The directory containing the cache of repositories, or None for the
+        default.
+    """
+    module = importlib.import_module(stage)
+    if stage == "get_submodules":
+        args = module.argument_parser().parse_args([])
+        module.main(
+            jobs or args.jobs, cache_dir or args.cache_dir, args.cache_size, args.resolver, args.revealjs,
+            args.checkout, args.frozen, args.store_size, website_config=website_config
+        )
+    elif stage == "get_setup":
+        args = module.argument_parser().parse_args([])
+        module.main(
+            cache_dir or args.cache_dir, website_config=website_config, checkout=args.checkout, frozen=args.frozen
+        )
+    elif stage == "get_schedules":
+        module.main(website_config)
+    else:
+        module.main(website_config=website_config)
+
+
+def run_stages(stages: List[str], website_config: WorkshopConfig, jobs: Optional[int] = None,
+               cache_dir: Optional[Path] = None) -> Dict[str, dict]:
+    """
+    Run stages one after another in this process.
+
+    The stages after one which fails are not run.
+
+    Parameters
+    ----------
+    stages:
+        The stages to run, in order.
+    website_config:
+        The website config, shared by every stage.
+    jobs, cache_dir:
+        Passed on to run_stage.
+
+    Returns
+    -------
+    results:
+        The results of each stage, as for run_tasks.
+    """
+    start = time.perf_counter()
+    results = {}
+    for stage in stages:
+        if any(result["status"] != "ok" for result in results.values()):
+            results[stage] = {"status": "skipped"}
+            continue
+
+        log.info(f"Starting {stage}")
+        results[stage] = {"start": time.perf_counter() - start}
+        try:
+            run_stage(stage, website_config, jobs, cache_dir)
+            results[stage]["status"] = "ok"
+        except Exception:
+            log.exception(f"{stage} failed")
+            results[stage]["status"] = "failed"
+        results[stage]["end"] = time.perf_counter() - start
+
+    return results
+
+
+def run_graph(website_config: WorkshopConfig, jobs: Optional[int] = None,
+              cache_dir: Optional[Path] = None) -> Dict[str, dict]:
+    """
+    Run the whole build as a graph of tasks, each in its own process.
+
+    Parameters
+    ----------
+    website_config:
+        The website config.
+    jobs:
+        The number of tasks to run at the same time, or None for
+        DEFAULT_JOBS.
+    cache_dir:
+        Passed on to the scripts, if given.
+
+    Returns
+    -------
+    results:
+        The results of each task, from run_tasks.
+    """
+    script_args = {"get_submodules": [], "get_setup": []}
+    if jobs is not None:
+        script_args["get_submodules"] += ["--jobs", str(jobs)]
+    if cache_dir is not None:
+        script_args["get_submodules"] += ["--cache-dir", str(cache_dir)]
+        script_args["get_setup"] += ["--cache-dir", str(cache_dir)]
+
+    tasks = build_tasks(website_config, script_args)
+    dependencies = task_dependencies(tasks)
+    for task in tasks:
+        log.info(f"{task.name} depends on {', '.join(dependencies[task.name]) or 'nothing'}")
+
+    results = run_tasks(tasks, dependencies, jobs or DEFAULT_JOBS)
+    print_summary([task.name for task in tasks], results, dependencies)
+
+    return results
+
+
+def main(stages: Optional[List[str]] = None, jobs: Optional[int] = None, cache_dir: Optional[Path] = None,
+         trace: Optional[Path] = None, frozen: bool = False, graph: bool = False) -> int:
+    """
+    Build the website.
+
+    Parameters
+    ----------
+    stages:
+        The stages to run in this process, or None to run every stage.
+    jobs:
+        The number of lessons to fetch at the same time, or tasks to run at
+        the same time when running the graph, or None for the defaults.
+    cache_dir:
+        The directory containing the cache of repositories, or None for the
+        default.
+    trace:
+        The file to write a trace of the build to, or None to not trace the
+        build unless $RSG_TRACE is set.
+    frozen:
+        Whether to build from the commits in the lockfile, as if $RSG_FROZEN
+        were set.
+    graph:
+        Whether to run the whole build as a graph of tasks, each in its own
+        process, rather than running the stages in this process.
+
+    Returns
+    -------
+    returncode:
+        0 if every task succeeded, otherwise 1.
+    """
+    # Every stage adds to the same trace, which is started afresh for each
+    # build
+    if trace is not None:
+        os.environ[instrumentation.TRACE_ENV] = str(Path(trace).resolve())
+    if instrumentation.enabled():
+        instrumentation.trace_file().unlink(missing_ok=True)
+
+    # Every script reads $RSG_FROZEN, so it is passed on to every stage
+    if frozen:
+        os.environ["RSG_FROZEN"] = "1"
+
+    # Loading the config checks it, and the lockfile is checked against it, so
+    # a broken config or a stale lockfile stops the build before anything is
+    # fetched
+    try:
+        website_config = load_config()
+        if os.environ.get("RSG_FROZEN"):
+            locked_lessons(load_lock(), website_config)
+    except (ConfigError, LockError) as exc:
+        log.error(exc)
+        return 1
+
+    if graph:
+        results = run_graph(website_config, jobs, cache_dir)
+    else:
+        stages = stages or STAGES
+        results = run_stages(stages, website_config, jobs, cache_dir)
+        print_summary(stages, results, {stage: stages[:i][-1:] for i, stage in enumerate(stages)})
+
+    if instrumentation.enabled():
+        instrumentation.save_trace()
+        log.info(f"Wrote a trace of the build to {instrumentation.trace_file()}")
+
+    return 0 if all(result["status"] == "ok" for result in results.values()) else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "stages", nargs="*", metavar="stage",
+        help=f"a stage to run in this process, one of {', '.join(STAGES)}; by default every stage is run"
+    )
+    parser.add_argument(
+        "--graph", action="store_true",
+        help="run the build as a graph of tasks, each in its own process, rather than running the stages in this "
+             "process"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=None,
+        help="number of lessons to fetch concurrently, passed on to get_submodules.py; with --graph, the number of "
+             f"tasks to run at the same time, defaults to {DEFAULT_JOBS}"
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, default=None, help="directory to cache repositories in, passed on to the scripts"
+    )
+    parser.add_argument(
+        "--frozen", action="store_true",
+        help="build from the commits pinned in the lockfile without resolving anything, defaults to on if $RSG_FROZEN "
+             "is set"
+    )
+    parser.add_argument(
+        "--trace", type=Path, default=None,
+        help=f"write a Chrome trace of the build to this JSON file, defaults to ${instrumentation.TRACE_ENV}"
+    )
+    args = parser.parse_args()
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage {stage}, choose from {', '.join(STAGES)}")
+    if args.graph and args.stages:
+        parser.error("--graph runs every stage, so cannot be given stages to run")
+    instrumentation.configure_logging()
+    sys.exit(main(args.stages, args.jobs, args.cache_dir, args.trace, args.frozen, args.graph))
@@ -0,0 +1,267 @@
+"""Record what each build stage used and produced, so unchanged stages can be
+skipped.
+
+The manifest, .build-manifest.json, keeps a hash of the inputs of each stage,
+e.g. its section of _config.yml and the commits of the lessons, and a hash of
+every file or directory written by a stage. A stage is up to date when its
+inputs hash is the same as last time and its outputs have not changed since
+they were last written, either by that stage or a later one.
+
+Set $RSG_FORCE_BUILD to run every stage regardless.
+
+The manifest also keeps the index of each directory of episodes, see
+episodes.py, so they can be renumbered without reading them all again, and
+the commit each repository was checked out at, for the steps which come
+after the checkout.
+
+Stages may run at the same time in separate processes, so saving the manifest
+only writes the entries changed by this process, merged into the manifest on
+disk while holding a lock.
+"""
+
+import os
+import json
+import hashlib
+import logging
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:
+    # Windows locks files with msvcrt instead
+    fcntl = None
+    import msvcrt
+
+log = logging.getLogger(__name__)
+
+MANIFEST_FILE = ".build-manifest.json"
+
+# The sections of the manifest, each a dictionary of entries
+SECTIONS = ["stages", "outputs", "assets", "episodes", "repositories"]
+
+# Where the entries changed since the manifest was loaded are kept, which is
+# not written to the file
+CHANGED_KEY = "_changed"
+
+
+def _read_manifest() -> dict:
+    """Read the build manifest file, or an empty manifest if there is not one."""
+    try:
+        with open(MANIFEST_FILE, "r") as fp:
+            manifest = json.load(fp)
+    except (OSError, ValueError):
+        manifest = {}
+
+    for section in SECTIONS:
+        manifest.setdefault(section, {})
+
+    return manifest
+
+
+def load_manifest() -> dict:
+    """Load the build manifest, or an empty one if there is not one."""
+    manifest = _read_manifest()
+    manifest[CHANGED_KEY] = set()
+
+    return manifest
+
+
+def set_entry(manifest: dict, section: str, key: str, value) -> None:
+    """
+    Set an entry in the build manifest, so it is written by save_manifest.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest.
+    section:
+        The section of the manifest, one of SECTIONS.
+    key:
+        The key of the entry, e.g. the name of a stage.
+    value:
+        The value of the entry, which must be JSON serialisable.
+    """
+    manifest[section][key] = value
+    manifest.setdefault(CHANGED_KEY, set()).add((section, key))
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    """
+    Hold an exclusive lock on a lock file, waiting for any other process which
+    holds it.
+
+    Parameters
+    ----------
+    path:
+        The lock file, which is created if it does not exist.
+    """
+    with open(path, "w") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+            return
+
+        # msvcrt gives up after trying for 10 seconds, so keep trying
+        while True:
+            try:
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+                break
+            except OSError:
+                pass
+        try:
+            yield
+        finally:
+            lock.seek(0)
+            msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def save_manifest(manifest: dict) -> None:
+    """
+    Write the entries of the build manifest changed since it was loaded.
+
+    Parameters
+    ----------
+    manifest:
+        The manifest to write.
+    """
+    changed = manifest.get(CHANGED_KEY, set())
+    with file_lock(f"{MANIFEST_FILE}.lock"):
+        on_disk = _read_manifest()
+        for section, key in changed:
+            on_disk[section][key] = manifest[section][key]
+
+        tmp_file = f"{MANIFEST_FILE}.tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump(on_disk, fp, indent=2, sort_keys=True)
+        os.replace(tmp_file, MANIFEST_FILE)
+
+    changed.clear()
+
+
+def hash_inputs(*values) -> str:
+    """
+    Hash the inputs of a stage.
+
+    Parameters
+    ----------
+    values:
+        Anything which can be converted to JSON, e.g. config sections, commit
+        SHAs or other hashes. Dates and other objects are hashed as strings.
+    """
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def hash_file(path: Path) -> str:
+    """
+    Hash the contents of a file.
+
+    Parameters
+    ----------
+    path:
+        The file to hash.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_path(path: Path) -> Optional[str]:
+    """
+    Hash a file, or the names and contents of all the files in a directory.
+
+    Parameters
+    ----------
+    path:
+        The file or directory to hash.
+
+    Returns
+    -------
+    hash:
+        The hash, or None if the path does not exist.
+    """
+    path = Path(path)
+    if path.is_file():
+        return hash_file(path)
+    if not path.is_dir():
+        return None
+
+    digest = hashlib.sha256()
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        digest.update(f"{file.relative_to(path).as_posix()}\0{hash_file(file)}\0".encode())
+    return digest.hexdigest()
+
+
+def is_up_to_date(manifest: dict, stage: str, inputs: str, outputs: Iterable[str]) -> bool:
+    """
+    Check if a stage can be skipped.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest.
+    stage:
+        The name of the stage.
+    inputs:
+        The hash of the inputs of the stage, from hash_inputs.
+    outputs:
+        The files and directories written by the stage.
+    """
+    if os.environ.get("RSG_FORCE_BUILD"):
+        return False
+
+    recorded = manifest["stages"].get(stage)
+    if not recorded or recorded["inputs"] != inputs:
+        return False
+
+    for output in outputs:
+        # An output which was not written, e.g. for a lesson without slides, is
+        # recorded with a hash of None
+        if str(output) not in manifest["outputs"] or hash_path(output) != manifest["outputs"][str(output)]:
+            log.info(f"{output} has changed since {stage} last wrote it")
+            return False
+
+    return True
+
+
+def record_stage(manifest: dict, stage: str, inputs: str, outputs: Iterable[str] = ()) -> None:
+    """
+    Record the inputs and outputs of a stage which has just run.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest.
+    stage:
+        The name of the stage.
+    inputs:
+        The hash of the inputs of the stage, from hash_inputs.
+    outputs:
+        The files and directories written by the stage.
+    """
+    outputs = [str(output) for output in outputs]
+    set_entry(manifest, "stages", stage, {"inputs": inputs, "outputs": outputs})
+    for output in outputs:
+        set_entry(manifest, "outputs", output, hash_path(output))
+
+
+def stage_inputs(manifest: dict, stage: str) -> Optional[str]:
+    """
+    Get the inputs hash last recorded for a stage.
+
+    This is used to make a stage depend on an earlier one, by including the
+    earlier stage's inputs in its own.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest.
+    stage:
+        The name of the stage.
+    """
+    return manifest["stages"].get(stage, {}).get("inputs")
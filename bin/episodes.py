@@ -0,0 +1,432 @@
+"""Rewrite lesson episodes in a single pass.
+
+Each episode is read once, has all of its frontmatter changes applied and is
+written once, atomically, and only if its contents have changed. The changes
+are:
+
+- the lesson_title and lesson_schedule_slug keys, linking the episode to its
+  lesson schedule,
+- the slug of the lesson survey, the 99- episode, which is lesson-survey in
+  every lesson so is made unique to the lesson,
+- the NN- prefix of the file name, so each lesson's episodes are numbered from
+  01 with 00 left for the lesson schedule.
+
+Applying the changes again gives the same result, so it is safe to run on
+episodes which have already been rewritten.
+
+As the episodes are written, an index of them is made: for each numbered
+episode, keyed by its new name, the name it had in the lesson, its frontmatter
+keys and slug, and the hash, size and modification time of what was written.
+get_submodules.py keeps the index in the build manifest, and get_schedules.py
+renumbers the episodes from it. Only episodes which have been changed since
+the index was made, or which need a new name or slug, are read or written.
+"""
+
+import os
+import re
+import string
+import hashlib
+import logging
+from pathlib import Path
+from shutil import copy2 as copy
+from shutil import copytree
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+FRONTMATTER_DELIMITER = "---"
+
+# The slug every lesson gives its survey episode
+SURVEY_SLUG = "lesson-survey"
+
+# The lesson survey is numbered 99 in every lesson
+SURVEY_NUMBER = "99-"
+
+# Written by get_schedules.py, so not an episode to be numbered
+SCHEDULE_FILE = "00-schedule.md"
+
+
+def split_frontmatter(text: str) -> Tuple[Optional[List[str]], str]:
+    """
+    Split a markdown file into its frontmatter lines and body.
+
+    Parameters
+    ----------
+    text:
+        The contents of the file.
+
+    Returns
+    -------
+    frontmatter, body:
+        The lines between the frontmatter delimiters, without line endings,
+        or None if there is no frontmatter, and the rest of the file.
+    """
+    lines = text.splitlines(keepends=True)
+    if not lines or lines[0].rstrip("\r\n") != FRONTMATTER_DELIMITER:
+        return None, text
+
+    for i, line in enumerate(lines[1:], start=1):
+        if line.rstrip("\r\n") in (FRONTMATTER_DELIMITER, "..."):
+            return [line.rstrip("\r\n") for line in lines[1:i]], "".join(lines[i + 1:])
+
+    return None, text
+
+
+def frontmatter_value(frontmatter: List[str], key: str) -> Optional[str]:
+    """
+    Get the value of a top level key in the frontmatter, as written.
+
+    Parameters
+    ----------
+    frontmatter:
+        The frontmatter lines, from split_frontmatter.
+    key:
+        The key to get the value of.
+    """
+    pattern = re.compile(rf"^{re.escape(key)}\s*:\s*(.*?)\s*$")
+    for line in frontmatter:
+        match = pattern.match(line)
+        if match:
+            return match.group(1)
+
+    return None
+
+
+def update_frontmatter(text: str, updates: Dict[str, str]) -> str:
+    """
+    Set top level keys in the frontmatter of a markdown file.
+
+    Keys which are already in the frontmatter are replaced where they are and
+    new keys are added to the start of the frontmatter, in the order given. The
+    frontmatter keeps the file's line endings. A file without frontmatter is
+    left as it is.
+
+    Parameters
+    ----------
+    text:
+        The contents of the file.
+    updates:
+        The values, formatted as YAML, keyed by the key to set.
+
+    Returns
+    -------
+    text:
+        The new contents of the file.
+    """
+    frontmatter, body = split_frontmatter(text)
+    if frontmatter is None:
+        return text
+    newline = "\r\n" if text.startswith(f"{FRONTMATTER_DELIMITER}\r\n") else "\n"
+
+    remaining = dict(updates)
+    new_frontmatter = []
+    for line in frontmatter:
+        key = line.split(":", 1)[0]
+        if ":" in line and not line.startswith((" ", "\t", "#", "-")) and key.strip() in remaining:
+            line = f"{key.strip()}: {remaining.pop(key.strip())}"
+        new_frontmatter.append(line)
+    new_frontmatter = [f"{key}: {value}" for key, value in remaining.items()] + new_frontmatter
+
+    return newline.join([FRONTMATTER_DELIMITER, *new_frontmatter, FRONTMATTER_DELIMITER]) + newline + body
+
+
+def yaml_quote(value: str) -> str:
+    """
+    Quote a string for YAML in single quotes.
+
+    Parameters
+    ----------
+    value:
+        The string to quote.
+    """
+    return "'" + value.replace("'", "''") + "'"
+
+
+def frontmatter_keys(frontmatter: Optional[List[str]]) -> List[str]:
+    """
+    Get the top level keys in the frontmatter, in order.
+
+    Parameters
+    ----------
+    frontmatter:
+        The frontmatter lines, from split_frontmatter, or None.
+    """
+    keys = []
+    for line in frontmatter or []:
+        if ":" in line and not line.startswith((" ", "\t", "#", "-")):
+            keys.append(line.split(":", 1)[0].strip())
+
+    return keys
+
+
+def index_entry(path: Path, source: str, text: str) -> dict:
+    """
+    Make the index entry for an episode which has just been read or written.
+
+    Parameters
+    ----------
+    path:
+        The episode.
+    source:
+        The name the episode has in the lesson.
+    text:
+        The contents of the episode.
+    """
+    frontmatter, _ = split_frontmatter(text)
+    stat = Path(path).stat()
+    return {
+        "source": source,
+        "keys": frontmatter_keys(frontmatter),
+        "slug": frontmatter_value(frontmatter, "slug") if frontmatter is not None else None,
+        "hash": hashlib.sha256(text.encode("utf-8")).hexdigest(),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def index_entry_is_current(entry: dict, path: Path) -> bool:
+    """
+    Check if an episode is as it was when its index entry was made.
+
+    Parameters
+    ----------
+    entry:
+        The index entry of the episode.
+    path:
+        The episode.
+    """
+    try:
+        stat = Path(path).stat()
+    except FileNotFoundError:
+        return False
+
+    return stat.st_size == entry.get("size") and stat.st_mtime_ns == entry.get("mtime_ns")
+
+
+def read_text(path: Path) -> str:
+    """Read a file, keeping its line endings as they are."""
+    with open(path, "r", encoding="utf-8", newline="") as fp:
+        return fp.read()
+
+
+def write_if_changed(path: Path, text: str) -> bool:
+    """
+    Write a file atomically, unless it already has the same contents.
+
+    Parameters
+    ----------
+    path:
+        The file to write.
+    text:
+        The new contents of the file.
+
+    Returns
+    -------
+    written:
+        True if the file was written.
+    """
+    path = Path(path)
+    try:
+        with open(path, "r", encoding="utf-8", newline="") as fp:
+            if fp.read() == text:
+                return False
+    except FileNotFoundError:
+        pass
+
+    tmp_file = path.with_name(f".{path.name}.tmp")
+    with open(tmp_file, "w", encoding="utf-8", newline="") as fp:
+        fp.write(text)
+    os.replace(tmp_file, path)
+
+    return True
+
+
+def episode_updates(name: str, text: str, lesson_title: Optional[str], lesson_name: Optional[str],
+                    survey_slug: str) -> Dict[str, str]:
+    """
+    Get the frontmatter changes for an episode.
+
+    Parameters
+    ----------
+    name:
+        The name of the episode in the lesson.
+    text:
+        The contents of the episode.
+    lesson_title:
+        The title of the lesson, or None to not set lesson_title and
+        lesson_schedule_slug.
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    survey_slug:
+        The slug for the episode if it is the lesson survey.
+    """
+    updates = {}
+    if lesson_title is not None:
+        updates["lesson_title"] = yaml_quote(lesson_title)
+        updates["lesson_schedule_slug"] = f"{lesson_name}-schedule"
+
+    frontmatter, _ = split_frontmatter(text)
+    slug = frontmatter_value(frontmatter, "slug") if frontmatter is not None else None
+    if SURVEY_NUMBER in name and slug in (SURVEY_SLUG, survey_slug):
+        updates["slug"] = survey_slug
+
+    return updates
+
+
+def numbered_episode_names(names: List[str]) -> Dict[str, str]:
+    """
+    Work out the new name of each numbered episode.
+
+    The episodes are numbered from 01 in their current order, keeping the rest
+    of their names, e.g. 05-loops.md, 10-functions.md and 99-survey.md become
+    01-loops.md, 02-functions.md and 03-survey.md.
+
+    Parameters
+    ----------
+    names:
+        The names of the files in the episodes directory.
+
+    Returns
+    -------
+    new_names:
+        The new name of each numbered episode, keyed by its current name.
+    """
+    numbered = sorted(
+        name for name in names if name[:1] in string.digits and name.endswith(".md") and name != SCHEDULE_FILE
+    )
+    return {name: f"{i + 1:02d}{Path(name).stem.lstrip(string.digits)}.md" for i, name in enumerate(numbered)}
+
+
+def rewrite_lesson_episodes(src_dir: Path, dest_dir: Path, extra_files: List[Path], lesson_title: str,
+                            lesson_name: str) -> Tuple[Dict[str, int], Dict[str, dict]]:
+    """
+    Copy a lesson's episodes into the website, rewriting them on the way.
+
+    Each markdown file is read from the lesson once and written to its new,
+    renumbered, name once, and only if it has changed. Anything else is copied
+    as it is. Files left in dest_dir from an earlier build of the lesson are
+    removed, other than the lesson schedule.
+
+    Parameters
+    ----------
+    src_dir:
+        The lesson's _episodes directory.
+    dest_dir:
+        The directory to put the episodes in.
+    extra_files:
+        Other files to put alongside the episodes, e.g. reference.md.
+    lesson_title:
+        The title of the lesson.
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+
+    Returns
+    -------
+    stats, index:
+        The number of files which were written, were unchanged and were
+        removed, and the number of bytes written. The index entry of each
+        numbered episode, keyed by its new name.
+    """
+    src_dir = Path(src_dir)
+    dest_dir = Path(dest_dir)
+    dest_dir.mkdir(parents=True, exist_ok=True)
+
+    sources = {path.name: path for path in sorted(src_dir.iterdir())} if src_dir.is_dir() else {}
+    sources.update({path.name: path for path in extra_files})
+    new_names = numbered_episode_names(list(sources))
+
+    stats = {"written": 0, "unchanged": 0, "removed": 0, "bytes": 0}
+    index = {}
+    written = set()
+    for name, src in sources.items():
+        dest = dest_dir / new_names.get(name, name)
+        written.add(dest.name)
+        if src.is_dir():
+            copytree(src, dest, dirs_exist_ok=True)
+        elif name.endswith(".md"):
+            text = read_text(src)
+            updates = episode_updates(name, text, lesson_title, lesson_name, f"{lesson_name}-survey")
+            text = update_frontmatter(text, updates)
+            if write_if_changed(dest, text):
+                log.info(f"Wrote {dest}")
+                stats["written"] += 1
+                stats["bytes"] += len(text.encode("utf-8"))
+            else:
+                stats["unchanged"] += 1
+            if name in new_names:
+                index[dest.name] = index_entry(dest, name, text)
+        else:
+            copy(src, dest)
+            stats["written"] += 1
+            stats["bytes"] += dest.stat().st_size
+
+    for path in dest_dir.iterdir():
+        if path.name not in written and path.name != SCHEDULE_FILE and path.is_file():
+            log.info(f"Removing {path}, which is no longer in {lesson_name}")
+            path.unlink()
+            stats["removed"] += 1
+
+    return stats, index
+
+
+def renumber_episodes(directory: Path, survey_slug: str,
+                      index: Optional[Dict[str, dict]] = None) -> Dict[str, dict]:
+    """
+    Renumber the episodes in a directory and set the slug of the lesson survey.
+
+    This is for episodes which are already in place, e.g. copied by
+    get_submodules.py or in a lesson website. The index of the episodes says
+    which slug each has, so only episodes which are not in the index, have
+    changed since it was made, or need a new slug are read. Episodes which
+    already have the right name and slug are not touched, so running this again
+    changes nothing.
+
+    Parameters
+    ----------
+    directory:
+        The directory containing the episodes.
+    survey_slug:
+        The slug to give the lesson survey.
+    index:
+        The index of the episodes from the last time they were written or
+        renumbered, if there is one.
+
+    Returns
+    -------
+    index:
+        The index of the renumbered episodes.
+    """
+    directory = Path(directory)
+    index = dict(index or {})
+    new_names = numbered_episode_names([path.name for path in directory.iterdir()])
+    renames = {name: new_name for name, new_name in new_names.items() if name != new_name}
+
+    # Move the episodes out of the way first, so an episode is never renamed
+    # over another which has yet to be renamed. Renaming keeps the size and
+    # modification time, so the index entries move with the episodes
+    for name in renames:
+        (directory / name).rename(directory / f".{name}.renumber")
+    for name, new_name in renames.items():
+        (directory / f".{name}.renumber").rename(directory / new_name)
+    moved = {new_name: index.pop(name) for name, new_name in renames.items() if name in index}
+    index.update(moved)
+    old_names = {new_name: name for name, new_name in renames.items()}
+
+    new_index = {}
+    for name in sorted(new_names.values()):
+        path = directory / name
+        entry = index.get(name)
+        text = None
+        if entry is None or not index_entry_is_current(entry, path):
+            text = read_text(path)
+            entry = index_entry(path, entry["source"] if entry else old_names.get(name, name), text)
+
+        if SURVEY_NUMBER in entry["source"] and entry["slug"] == SURVEY_SLUG and survey_slug != SURVEY_SLUG:
+            text = update_frontmatter(text if text is not None else read_text(path), {"slug": survey_slug})
+            if write_if_changed(path, text):
+                log.info(f"Set the slug of {path} to {survey_slug}")
+            entry = index_entry(path, entry["source"], text)
+
+        new_index[name] = entry
+
+    return new_index
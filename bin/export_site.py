@@ -0,0 +1,378 @@
+"""Export only what the website needs into a directory to deploy.
+
+The build leaves the lesson clones in submodules/, the build scripts in bin/
+and the repository's git metadata alongside what Jekyll actually reads.
+GitHub Pages builds the website from the deployed files, so this copies just
+those into a staging directory, `_deploy` by default: every path Jekyll would
+read, i.e. everything other than hidden files and the paths in the exclude
+list of _config.yml, such as submodules/ and bin/. Paths in the include list
+are exported even if they are hidden.
+
+Files are hardlinked (or reflinked) into the staging directory, and only when
+they have changed since the last export, and files which are no longer in the
+website are removed. The hash, size and modification time of every exported
+file is written to .deploy-manifest.json in the staging directory, so the
+manifest is deployed with the website. Comparing it with the manifest of the
+last deploy, e.g. from the gh-pages branch, gives the files which have been
+added, changed or removed, and how much there is to upload.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import fnmatch
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, List, Optional
+
+import instrumentation
+from asset_sync import clone_file, files_match
+from build_manifest import hash_file
+from workshop_config import ConfigError, WorkshopConfig, load_config
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEPLOY_DIR = "_deploy"
+
+DEPLOY_MANIFEST = ".deploy-manifest.json"
+
+# Left out by Jekyll whatever the exclude list says, along with its own output
+JEKYLL_EXCLUDE = [
+    "_site", ".sass-cache", ".jekyll-cache", "gemfiles", "Gemfile", "Gemfile.lock", "node_modules", "vendor/bundle",
+    "vendor/cache", "vendor/gems", "vendor/ruby",
+]
+
+
+def matches(path: PurePosixPath, patterns: Iterable[str]) -> bool:
+    """
+    Check if a path is one of a list of paths or glob patterns from _config.yml,
+    or is inside one of them.
+
+    Parameters
+    ----------
+    path:
+        The path, relative to the top of the website.
+    patterns:
+        The paths or patterns, e.g. "submodules/" or "*.log".
+    """
+    for pattern in patterns:
+        pattern = str(pattern).strip("/")
+        for parent in [path, *list(path.parents)[:-1]]:
+            if parent.as_posix() == pattern or fnmatch.fnmatch(parent.as_posix(), pattern):
+                return True
+
+    return False
+
+
+def website_files(website_config: WorkshopConfig, root: Path = Path("."),
+                  skip: Iterable[Path] = ()) -> List[PurePosixPath]:
+    """
+    List the files Jekyll reads to build the website.
+
+    Parameters
+    ----------
+    website_config:
+        The website config, with the include and exclude lists.
+    root:
+        The top of the website.
+    skip:
+        Other directories to leave out, e.g. the staging directory.
+
+    Returns
+    -------
+    files:
+        The paths of the files, relative to root, in sorted order.
+    """
+    include = website_config.get("include") or []
+    exclude = JEKYLL_EXCLUDE + (website_config.get("exclude") or [])
+    skip = {Path(path).resolve() for path in skip}
+
+    def wanted(path: PurePosixPath) -> bool:
+        if matches(path, include):
+            return True
+        return not path.name.startswith(".") and not matches(path, exclude)
+
+    files = []
+    for directory, dirs, names in os.walk(root):
+        relative = PurePosixPath(Path(directory).relative_to(root).as_posix())
+        dirs[:] = [
+            name for name in dirs
+            if wanted(relative / name) and (Path(directory) / name).resolve() not in skip
+        ]
+        files.extend(
+            relative / name for name in names if wanted(relative / name) and (Path(directory) / name).is_file()
+        )
+
+    return sorted(files)
+
+
+def load_deploy_manifest(path: Path) -> Dict[str, dict]:
+    """
+    Load a deploy manifest, or an empty one if there is none.
+
+    Parameters
+    ----------
+    path:
+        The manifest, e.g. in the staging directory.
+    """
+    try:
+        with open(path, "r") as fp:
+            return json.load(fp).get("files", {})
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def hash_files(root: Path, files: List[PurePosixPath], previous: Dict[str, dict], jobs: int) -> Dict[str, dict]:
+    """
+    Make the deploy manifest entry of each file.
+
+    A file's hash is taken from the previous manifest if its size and
+    modification time have not changed, and otherwise the files are hashed
+    in a pool of threads.
+
+    Parameters
+    ----------
+    root:
+        The top of the website.
+    files:
+        The files to hash, relative to root.
+    previous:
+        The entries from the last export.
+    jobs:
+        The number of files to hash at the same time.
+
+    Returns
+    -------
+    entries:
+        The hash, size and modification time of each file, keyed by path.
+    """
+    entries = {}
+    to_hash = []
+    for file in files:
+        stat = (root / file).stat()
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        old = previous.get(file.as_posix(), {})
+        if old.get("size") == entry["size"] and old.get("mtime_ns") == entry["mtime_ns"] and old.get("sha256"):
+            entry["sha256"] = old["sha256"]
+        else:
+            to_hash.append(file)
+        entries[file.as_posix()] = entry
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for file, digest in zip(to_hash, pool.map(lambda file: hash_file(root / file), to_hash)):
+            entries[file.as_posix()]["sha256"] = digest
+
+    return entries
+
+
+def diff_manifests(old: Dict[str, dict], new: Dict[str, dict]) -> Dict[str, List[str]]:
+    """
+    Compare the files in two deploy manifests.
+
+    Parameters
+    ----------
+    old:
+        The files of the last deploy.
+    new:
+        The files of this deploy.
+
+    Returns
+    -------
+    changes:
+        The paths which were added, changed and removed.
+    """
+    return {
+        "added": sorted(path for path in new if path not in old),
+        "changed": sorted(
+            path for path in new if path in old
+            and (old[path].get("sha256"), old[path].get("size")) != (new[path]["sha256"], new[path]["size"])
+        ),
+        "removed": sorted(path for path in old if path not in new),
+    }
+
+
+def export_site(dest: Path = Path(DEFAULT_DEPLOY_DIR), jobs: int = 8,
+                website_config: Optional[WorkshopConfig] = None) -> Dict[str, dict]:
+    """
+    Export the files the website needs into a staging directory.
+
+    Parameters
+    ----------
+    dest:
+        The staging directory, which is created if it does not exist.
+    jobs:
+        The number of files to hash at the same time.
+    website_config:
+        The website config, or None to load _config.yml.
+
+    Returns
+    -------
+    entries:
+        The deploy manifest entry of each exported file, keyed by path.
+    """
+    if website_config is None:
+        website_config = load_config()
+
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    root = Path(".")
+    previous = load_deploy_manifest(dest / DEPLOY_MANIFEST)
+
+    with instrumentation.span("export", "copy") as span_args:
+        files = website_files(website_config, root, skip=[dest])
+        entries = hash_files(root, files, previous, jobs)
+
+        linked = 0
+        for file in files:
+            src, target = root / file, dest / file
+            if files_match(src, target):
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.unlink(missing_ok=True)
+            clone_file(src, target)
+            linked += 1
+
+        # Anything else in the staging directory is no longer in the website
+        wanted = {file.as_posix() for file in files} | {DEPLOY_MANIFEST}
+        removed = 0
+        for directory, dirs, names in os.walk(dest, topdown=False):
+            for name in names:
+                path = Path(directory) / name
+                if path.relative_to(dest).as_posix() not in wanted:
+                    path.unlink()
+                    removed += 1
+            if Path(directory) != dest and not os.listdir(directory):
+                os.rmdir(directory)
+
+        span_args["files"] = linked
+        span_args["bytes"] = sum(entry["size"] for entry in entries.values())
+
+    tmp_file = dest / f".{DEPLOY_MANIFEST}.tmp"
+    with open(tmp_file, "w") as fp:
+        json.dump({"files": entries}, fp, indent=1, sort_keys=True)
+    os.replace(tmp_file, dest / DEPLOY_MANIFEST)
+
+    log.info(f"Exported {len(files)} files to {dest}, {linked} linked, {removed} removed")
+    return entries
+
+
+def directory_totals(root: Path, skip: Iterable[Path] = ()) -> Dict[str, int]:
+    """
+    Count the files and bytes in a directory, leaving out .git directories.
+
+    Parameters
+    ----------
+    root:
+        The directory.
+    skip:
+        Other directories to leave out, e.g. the staging directory.
+    """
+    skip = {Path(path).resolve() for path in skip}
+    totals = {"files": 0, "bytes": 0}
+    for directory, dirs, names in os.walk(root):
+        dirs[:] = [name for name in dirs if name != ".git" and (Path(directory) / name).resolve() not in skip]
+        for name in names:
+            path = Path(directory) / name
+            if not path.is_symlink():
+                totals["files"] += 1
+                totals["bytes"] += path.stat().st_size
+
+    return totals
+
+
+def print_report(entries: Dict[str, dict], seconds: float, changes: Dict[str, List[str]], dest: Path,
+                 working_directory: Optional[Dict[str, int]] = None) -> None:
+    """
+    Print what was exported and what has changed since the last deploy.
+
+    Parameters
+    ----------
+    entries:
+        The deploy manifest entries of the exported files.
+    seconds:
+        How long the export took.
+    changes:
+        The files added, changed and removed since the last deploy.
+    dest:
+        The staging directory.
+    working_directory:
+        The number of files and bytes in the working directory, which was
+        deployed before, or None to leave it out.
+    """
+    total = sum(entry["size"] for entry in entries.values())
+    upload = sum(entries[path]["size"] for path in changes["added"] + changes["changed"])
+    print(f"Exported {len(entries)} files, {total / 2**20:.1f} MB, to {dest} in {seconds:.2f} s")
+    if working_directory is not None:
+        print(
+            f"The working directory has {working_directory['files']} files, "
+            f"{working_directory['bytes'] / 2**20:.1f} MB, not counting .git"
+        )
+    print(
+        f"Since the last deploy: {len(changes['added'])} added, {len(changes['changed'])} changed, "
+        f"{len(changes['removed'])} removed, {upload / 2**20:.1f} MB to upload"
+    )
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """Make the command line parser, with defaults taken from the environment."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "dest", nargs="?", type=Path, default=Path(os.environ.get("RSG_DEPLOY_DIR", DEFAULT_DEPLOY_DIR)),
+        help=f"directory to export the website to, defaults to $RSG_DEPLOY_DIR or {DEFAULT_DEPLOY_DIR}"
+    )
+    parser.add_argument(
+        "--previous", type=Path, default=None,
+        help=f"the {DEPLOY_MANIFEST} of the last deploy to compare with, defaults to the one left in the directory "
+             "by the last export"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=int(os.environ.get("RSG_BUILD_JOBS", 8)),
+        help="number of files to hash at the same time, defaults to $RSG_BUILD_JOBS or 8"
+    )
+    parser.add_argument(
+        "--compare-working-directory", action="store_true",
+        help="also report the size of the working directory, which is what used to be deployed"
+    )
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Export the website and report what has changed.
+
+    Parameters
+    ----------
+    argv:
+        The command line arguments, or None to use sys.argv.
+
+    Returns
+    -------
+    returncode:
+        0 if the website was exported, otherwise 1.
+    """
+    args = argument_parser().parse_args(argv)
+    previous = args.previous if args.previous is not None else args.dest / DEPLOY_MANIFEST
+    old_entries = load_deploy_manifest(previous)
+
+    start = time.perf_counter()
+    try:
+        entries = export_site(args.dest, args.jobs)
+    except ConfigError as exc:
+        log.error(exc)
+        return 1
+    seconds = time.perf_counter() - start
+
+    working_directory = None
+    if args.compare_working_directory:
+        working_directory = directory_totals(Path("."), skip=[args.dest])
+    print_report(entries, seconds, diff_manifests(old_entries, entries), args.dest, working_directory)
+
+    return 0
+
+
+if __name__ == "__main__":
+    instrumentation.configure_logging()
+    sys.exit(main())
@@ -6,31 +6,104 @@ start times to what is in the schedule. The schedules are written to HTML in an
 (n x 2) array, with the first column being filled first (in date order) just
 like in an academic journal. This script updates _includes/rsg/schedule.html,
 and creates a detailed 00-schedule.md file for each lesson.
+
+Given the _config.yml of several websites, or directories containing them, the
+schedules of every website are made in one run, optionally in several
+processes with --jobs. The dates, times and sessions parsed for one website
+are reused for the rest.
 """
 
+import os
+import sys
+import argparse
 import datetime
+import logging
 import math
-import glob
 import textwrap
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-import string
-from bs4 import BeautifulSoup as bs
-import yaml
-from dateutil.parser import parse
+from typing import NamedTuple, Tuple
+
+import instrumentation
+from html_writer import HTMLWriter
+from build_manifest import hash_inputs, is_up_to_date, load_manifest, record_stage, save_manifest, set_entry
+from build_manifest import stage_inputs
+from episodes import renumber_episodes
+from workshop_config import CONFIG_FILE, load_config
+
+log = logging.getLogger(__name__)
+
+# The parts of _config.yml which the schedules are made from. For a lesson
+# website, the lesson is described at the top level of _config.yml
+SCHEDULE_CONFIG_KEYS = [
+    "kind", "delivery", "startdate", "enddate", "lessons", "title", "start-time", "type", "sessions"
+]
+
+# The sessions of a day of a lesson, when neither the lesson or the workshop
+# give their own in _config.yml. The times are moved to the lesson's start time
+DEFAULT_SESSIONS = [
+    {"time": "9:30", "session": "Registration and Teaching"},
+    {"time": "11:00", "session": "Break"},
+    {"time": "11:15", "session": "Teaching"},
+    {"time": "12:45", "session": "Wrap Up"},
+    {"time": "13:00", "session": "Finish"},
+]
+
+MINUTES_IN_DAY = 24 * 60
+
+# The time of a session in a schedule, from the hour and minute
+SESSION_TIME = "{:02d}:{:02d}".format
+
+
+class SessionTemplate(NamedTuple):
+    """The sessions of a day, with the time of each as minutes after the first."""
+
+    offsets: Tuple[int, ...]
+    sessions: Tuple[str, ...]
+
+
+def parse_session_template(sessions):
+    """Parse the sessions of a day into a template which can be moved to any start time.
+
+    Parameters
+    ----------
+    sessions: list[dict]
+        The sessions, in order, each with the "time" it starts and the name
+        of the "session".
+
+    Returns
+    -------
+    template: SessionTemplate
+        The minutes from the start of the first session to the start of each
+        session, and the name of each session.
+    """
+    return _parse_session_template(tuple((session["time"], str(session["session"])) for session in sessions))
+
+
+@lru_cache(maxsize=None)
+def _parse_session_template(sessions):
+    """Parse the (time, session) pairs of a day, as for parse_session_template."""
+    minutes = []
+    for time_string, _ in sessions:
+        time = get_time_object(time_string)
+        minutes.append(time.hour * 60 + time.minute)
+
+    return SessionTemplate(tuple(minute - minutes[0] for minute in minutes), tuple(name for _, name in sessions))
 
 
 def get_yaml_config():
     """Open the YAML config file for the website.
 
+    The config is shared with the other build stages, so it is only parsed
+    once, and is checked for what the build needs when it is parsed.
+
     Returns
     -------
-    config: dict
+    config: WorkshopConfig
         The configuration for the website.
     """
-    with open("_config.yml", "r") as fp:
-        config = yaml.load(fp, yaml.Loader)
-
-    return config
+    return load_config()
 
 
 def get_date_object(date_string):
@@ -60,7 +133,16 @@ def get_date_object(date_string):
     if date_string.lower() == "tbc":
         return date_string.upper()
     else:
-        return parse(date_string).date()
+        return _parse_date(date_string)
+
+
+@lru_cache(maxsize=None)
+def _parse_date(date_string):
+    """Parse a date with dateutil, which is slow, so each date is only parsed once."""
+    from dateutil.parser import parse
+
+    return parse(date_string).date()
+
 
 def get_time_object(time_string):
     """Convert a string into a datetime object.
@@ -78,21 +160,86 @@ def get_time_object(time_string):
     time_object: datetime.datetime
         The converted string as a datetime object.
     """
+    if type(time_string) in (str, int):
+        return _parse_time(time_string)
+    else:
+        raise ValueError(f"start-time {time_string} is an invalid format: accept 24 hr (15:00) or 12 hr with am/pm (3:00 pm)")
+
+
+@lru_cache(maxsize=None)
+def _parse_time(time_string):
+    """Parse a time, as for get_time_object, so each time is only parsed once."""
     if type(time_string) is str:
         try:
             time = datetime.datetime.strptime(time_string, "%I:%M %p")   # start-time: 9:30 am
         except ValueError:
             time = datetime.datetime.strptime(time_string, "%H:%M")      # start-time: "9:30"
-    elif type(time_string) is int:
+    else:
         hours, minutes = divmod(time_string, 60)
         time = datetime.datetime.strptime(f"{hours}:{minutes}", "%H:%M") # start-time: 9:30
-    else:
-        raise ValueError(f"start-time {time_string} is an invalid format: accept 24 hr (15:00) or 12 hr with am/pm (3:00 pm)")
 
     return time
 
 
-def create_detailed_lesson_schedules(lesson_name, lesson_type, start_time, lesson_title, website_kind):
+def create_schedule_rows(lesson_days):
+    """Create the rows of the schedule table for every day of every lesson.
+
+    The times of the sessions are the start time of the day plus the offsets
+    of its template. Many days share a template and start time, so the rows
+    are only made once for each pair.
+
+    Parameters
+    ----------
+    lesson_days: list[dict]
+        The days, each with the "lesson_name", the "title" and "date_string"
+        to show, the "start" time in minutes after midnight and the session
+        "template".
+
+    Returns
+    -------
+    rows: list[list[tuple]]
+        The time and name of each session, for each day in the same order.
+    """
+    rows = {}
+    for day in lesson_days:
+        key = (day["template"], day["start"])
+        if key not in rows:
+            template = day["template"]
+            rows[key] = [
+                (SESSION_TIME(*divmod((day["start"] + offset) % MINUTES_IN_DAY, 60)), session)
+                for offset, session in zip(template.offsets, template.sessions)
+            ]
+
+    return [rows[(day["template"], day["start"])] for day in lesson_days]
+
+
+def write_lesson_schedule(writer, schedule):
+    """Write the schedule of a lesson, or a day of a lesson, for the index.
+
+    Parameters
+    ----------
+    writer: HTMLWriter
+        The writer for _includes/rsg/schedule.html.
+    schedule: dict
+        The schedule, with the "lesson_name" and "title" of the lesson. A day
+        of a dated workshop has the "date_string" and the "rows" of its table,
+        otherwise the lesson has the HTML of its "blurb".
+    """
+    with writer.tag("div", {"class": "col"}):
+        with writer.tag("a", {"href": f"{schedule['lesson_name']}-schedule"}):
+            writer.element("h3", schedule["title"])
+        if "rows" in schedule:
+            writer.element("h4", schedule["date_string"])
+            with writer.tag("table", {"class": "table table-striped"}):
+                for time, session in schedule["rows"]:
+                    with writer.tag("tr"):
+                        writer.element("td", time)
+                        writer.element("td", session)
+        else:
+            writer.html(schedule["blurb"])
+
+
+def create_detailed_lesson_schedules(lesson_name, lesson_type, start_time, lesson_title, website_kind, manifest):
     """Create a detailed lesson schedule landing page for each lesson.
 
     The schedule is based on a modifed version of syllabus.html to work better
@@ -111,62 +258,84 @@ def create_detailed_lesson_schedules(lesson_name, lesson_type, start_time, lesso
         The title of the lesson.
     website_kind: str
         The type of website.
+    manifest: dict
+        The build manifest, which keeps the index of the episodes.
     """
-    file_ext = "md"
-    if website_kind != 'lesson':
-        containing_directory = f"./_episodes/{lesson_name}-lesson"
-    else:
-        containing_directory = "./_episodes/"
-
-    for i, file in enumerate(sorted(glob.glob(f"{containing_directory}/[0-9]*.{file_ext}"))):
-        filepath = Path(file)
-        new_file_name = f"{i + 1:02d}{filepath.stem.lstrip(string.digits)}.{file_ext}"
-        filepath.rename(f"{containing_directory}/{new_file_name}")
-        if "99-" in file:
-            with open(f"{containing_directory}/{new_file_name}", 'r') as fp:
-                data = fp.readlines()
-            try:
-                ix = data.index("slug: lesson-survey\n")
-                if lesson_name == '':
-                    data[ix] = f"slug: {lesson_title}-survey\n"
-                else:
-                    data[ix] = f"slug: {lesson_name}-survey\n"
-                with open(f"{containing_directory}/{new_file_name}", 'w') as fp:
-                    fp.writelines(data)
-            except ValueError as e:
-                print(f"No survey markdown found, caught: {e}\n continuing")
+    with instrumentation.span(f"schedule {lesson_name}", "schedule", lesson=lesson_name or lesson_title):
+        if website_kind != 'lesson':
+            containing_directory = f"./_episodes/{lesson_name}-lesson"
+        else:
+            containing_directory = "./_episodes/"
+
+        # Workshop lessons are already numbered when they are copied by
+        # get_submodules.py, in which case this changes nothing, and the index
+        # of the episodes it made means they do not need to be read
+        index_key = Path(containing_directory).as_posix()
+        if lesson_name == '':
+            survey_slug = f"{lesson_title}-survey"
+        else:
+            survey_slug = f"{lesson_name}-survey"
+        index = renumber_episodes(containing_directory, survey_slug, manifest["episodes"].get(index_key))
+        set_entry(manifest, "episodes", index_key, index)
+
+        if website_kind != 'lesson':
+            schedule_markdown = textwrap.dedent(f"""---
+            lesson_title: '{lesson_title}'
+            lesson_schedule_slug: {lesson_name}-schedule
+            title: Lesson Schedule
+            slug: {lesson_name}-schedule
+            layout: schedule
+            ---
+            {{% include syllabus.html  name="{lesson_name}" start_time={start_time} %}}
+            """)
+
+            with open(f"{containing_directory}/00-schedule.md", "w") as fp:
+                fp.write("\n".join([line.lstrip() for line in schedule_markdown.splitlines()]))
+        else:
+            # This is cheeky as it creates the index schedule but this is necessary the index is the detail
+            p = Path("_includes/rsg/")
+            p.mkdir(parents=True, exist_ok=True)
+            with open("_includes/rsg/schedule.html", "x") as fp:
+                writer = HTMLWriter(fp)
+                # Make the container to hold the schedules 'table', with a row
+                # that expects 2 columns at medium and above and one below
+                with writer.tag("div", {"class": "container"}), writer.tag("div", {"class": "row row-cols-1"}):
+                    #include the syllabus
+                    writer.text(f"{{% include syllabus.html  name=\"{lesson_name}\" start_time={start_time} %}}")
+
+
+def update_detailed_lesson_schedules(manifest, lesson, website_delivery, lesson_name, lesson_type, start_time,
+                                     lesson_title, website_kind):
+    """Create the detailed lesson schedule for a workshop lesson if it has changed.
+
+    The lesson's episodes are renamed when the schedule is created, so it is
+    only created again when the lesson's episodes have been copied again by
+    get_submodules.py or its entry in _config.yml has changed.
 
-    if website_kind != 'lesson':
-        schedule_markdown = textwrap.dedent(f"""---
-        lesson_title: '{lesson_title}'
-        lesson_schedule_slug: {lesson_name}-schedule
-        title: Lesson Schedule
-        slug: {lesson_name}-schedule
-        layout: schedule
-        ---
-        {{% include syllabus.html  name="{lesson_name}" start_time={start_time} %}}
-        """)
-
-        with open(f"{containing_directory}/00-schedule.md", "w") as fp:
-            fp.write("\n".join([line.lstrip() for line in schedule_markdown.splitlines()]))
-    else:
-        # This is cheeky as it creates the index schedule but this is necessary the index is the detail
-        html = ""
-        # Make the container to hold the schedules 'table'
-        html += "<div class=\"container\">"
-        # Start a row that expects 2 columns at medium and above and one below
-        html += "<div class=\"row row-cols-1\">"
-        #include the syllabus
-        html += f"{{% include syllabus.html  name=\"{lesson_name}\" start_time={start_time} %}}"
-        # Close the main row and container
-        html += "</div>"
-        html += "</div>"
-        p = Path("_includes/rsg/")
-        p.mkdir(parents=True, exist_ok=True)
-        with open("_includes/rsg/schedule.html", "x") as fp:
-            fp.write(bs(html, "html.parser").prettify())
+    Parameters
+    ----------
+    manifest: dict
+        The build manifest.
+    lesson: dict
+        The lesson's entry in the lessons list in _config.yml.
+    website_delivery: str
+        The delivery of the workshop.
+    lesson_name, lesson_type, start_time, lesson_title, website_kind:
+        As for create_detailed_lesson_schedules.
+    """
+    stage = f"get_schedules/{lesson_name}"
+    inputs = hash_inputs(lesson, website_kind, website_delivery, stage_inputs(manifest, f"get_submodules/{lesson_name}"))
+    outputs = [f"_episodes/{lesson_name}-lesson"]
 
+    if is_up_to_date(manifest, stage, inputs, outputs):
+        log.info(f"Detailed schedule for {lesson_name} has not changed, not creating")
+        return
 
+    create_detailed_lesson_schedules(lesson_name, lesson_type, start_time, lesson_title, website_kind, manifest)
+    record_stage(manifest, stage, inputs, outputs)
+
+
+@instrumentation.traced("index schedule", "schedule")
 def create_index_schedules(schedules):
     """Write the new schedule to _includes/rsg/schedule.html.
 
@@ -178,8 +347,8 @@ def create_index_schedules(schedules):
     ----------
     schedules: list[dict]
         The list of schedules to write to the file. Each schedule is a dict
-        with keys "date" which is the date for the lesson and "schedule" which
-        is the html table for the schedule.
+        with key "order_on" which is the date or order of the lesson, and the
+        keys needed by write_lesson_schedule.
     """
     n_lessons = len(schedules)
     n_rows = math.ceil(n_lessons / 2)
@@ -190,39 +359,21 @@ def create_index_schedules(schedules):
     left = ordered_schedules[:n_rows]
     right = ordered_schedules[n_rows:]
 
-    html = ""
-    # Start a row that expects 2 columns at medium and above and one below
-    html += "<div class=\"row row-cols-1 row-cols-md-2\">"
-
-    # Start a column to contain the courses that should appear on the left in 2 column layout or top in 1 column layout.
-    html += "<div class=\"col-sm-12 col-md-6\">"
-    # Start a nested row with ony one column
-    html += "<div class=\"row row-cols-1\">"
-    for thing in left:
-        html += thing["schedule"]
-    # Close the LHS/top
-    html += "</div>"
-    html += "</div>"
-
-    # Start a column to contain the courses that should appear on the right in 2 column layout or bottom in 1 column
-    # layout.
-    html += "<div class=\"col-sm-12 col-md-6\">"
-    # Start a nested row with ony one column
-    html += "<div class=\"row row-cols-1\">"
-    for thing in right:
-        html += thing["schedule"]
-    # Close the RHS/bottom
-    html += "</div>"
-    html += "</div>"
-
-    # Close the main row
-    html += "</div>"
-
     with open("_includes/rsg/schedule.html", "w") as fp:
-        fp.write(bs(html, "html.parser").prettify())
-
-
-def main():
+        writer = HTMLWriter(fp)
+        # Start a row that expects 2 columns at medium and above and one below
+        with writer.tag("div", {"class": "row row-cols-1 row-cols-md-2"}):
+            # A column for the courses that should appear on the left (or top
+            # in 1 column layout), then one for those on the right (or
+            # bottom), each with a nested row with only one column
+            for column in (left, right):
+                with writer.tag("div", {"class": "col-sm-12 col-md-6"}), writer.tag("div", {"class": "row row-cols-1"}):
+                    for thing in column:
+                        write_lesson_schedule(writer, thing)
+
+
+@instrumentation.traced("get_schedules")
+def main(website_config=None):
     """Main function of the script.
 
     Handles all of the top level logic, for iterating through lessons to create
@@ -230,20 +381,40 @@ def main():
     which is put into date order and written to HTML. Additionally, this script
     also creates a 00-schedule.md file for each lesson, which is used to create
     a detailed syllabus.
+
+    Parameters
+    ----------
+    website_config: WorkshopConfig or None
+        The website config, or None to load _config.yml.
     """
-    website_config = get_yaml_config()
+    if website_config is None:
+        website_config = get_yaml_config()
     website_kind = website_config.get('kind', None)
     website_delivery = website_config.get('delivery', None)  # None is fine for lessons, but will raise exception for workshops
 
     if website_kind is None:
         raise KeyError("website_kind type has not been specified in _config.yml")
 
-    # create generic schedule layout for lessons
+    # Skip everything if neither the config or the lessons have changed since
+    # the last build, and nothing has been written over since
+    manifest = load_manifest()
+    stage_config = {key: website_config.get(key) for key in SCHEDULE_CONFIG_KEYS}
+    schedule_inputs = hash_inputs(stage_config, stage_inputs(manifest, "get_submodules"))
+    schedule_outputs = ["_includes/rsg/schedule.html"]
+    if website_kind != 'lesson':
+        schedule_outputs += [f"_episodes/{lesson.get('gh-name')}-lesson" for lesson in website_config.get("lessons") or []]
+    else:
+        schedule_outputs += ["_episodes"]
+
+    if is_up_to_date(manifest, "get_schedules", schedule_inputs, schedule_outputs):
+        log.info("Schedules have not changed since the last build, not creating")
+        return
 
-    all_schedule_times = ["9:30", "11:00", "11:15", "12:45", "13:00"]
-    schedule_sessions = [
-        "Registration and Teaching", "Break", "Teaching", "Wrap Up", "Finish"
-    ]
+    # The sessions of a day are parsed once for the workshop, and once for each
+    # lesson which has its own. The days of the lessons are collected, then
+    # their tables made in one go
+    workshop_template = parse_session_template(website_config.get("sessions") or DEFAULT_SESSIONS)
+    lesson_days = []
 
     # Try to parse the start and end date for the workshop, to check that lessons
     # are in the correct time frame. If the date is not a valid date, i.e. if it
@@ -258,7 +429,7 @@ def main():
     if not lessons:
         raise ValueError("No lessons found in the workshop configuration file (_config.yml)")
     if website_kind == 'lesson':
-        lessons = [website_config]  # This is a hack
+        lessons = [dict(website_config)]  # This is a hack
     lesson_schedules = []
 
     for lesson in lessons:
@@ -325,12 +496,16 @@ def main():
                     assert len(lesson_dates) == len(lesson_start_times), \
                         "Lesson starts must be a single value or the same length as lesson dates"
 
+                if lesson.get("sessions"):
+                    template = parse_session_template(lesson["sessions"])
+                else:
+                    template = workshop_template
+
                 # Iterate over each start time and start date in the available
                 # lessons ane create shedule for thoe
                 for i, (start, date) in enumerate(zip(lesson_start_times, lesson_dates)):
                     date = get_date_object(date)
                     start_time = get_time_object(start)
-                    original_start = get_time_object(all_schedule_times[0])
 
                     if isinstance(date, datetime.date):
                         date_string = date.strftime("%d %B %Y")
@@ -341,41 +516,24 @@ def main():
                     else:
                         date_string = date  # i.e. TBC has been returned up get_date_object
 
-                    # Calculate the time difference between the start time and the start
-                    # time in the original schedule. This delta time (in minutes) is added
-                    # to each time in the original schedule.
-
-                    delta_minutes = divmod((start_time - original_start).total_seconds(), 60)[0]
-
-                    # Construct the schedule table for this lesson, adding delta_minutes to
-                    # each original entry, and add the schedule table to the html template
-
                     if len(lesson_dates) > 1:
                         title = f"Day {i + 1}: '{lesson_title}'"
                     else:
                         title = f"'{lesson_title}'"
 
-                    table = f"""
-                    <div class="col">
-                        <a href="{lesson_name}-schedule"><h3>{title}</h3></a>
-                        <h4>{date_string}</h4>
-                        <table class="table table-striped">
-                    """
-
-                    for time, session in zip(all_schedule_times, schedule_sessions):
-                        actual_time = datetime.datetime.strptime(time, "%H:%M") + datetime.timedelta(minutes=delta_minutes)
-                        table += f"<tr> <td> {actual_time.hour:02d}:{actual_time.minute:02d} </td>    <td> {session} </td> </tr>\n"
-
-                    table += """
-                        </table>
-                    </div>
-                    """
-
-                    lesson_schedules.append({"order_on": date, "schedule": table})
+                    # The table for the day is made later, with the sessions
+                    # moved to start at the day's start time
+                    lesson_days.append({
+                        "lesson_name": lesson_name, "title": title, "date": date, "date_string": date_string,
+                        "start": start_time.hour * 60 + start_time.minute, "template": template,
+                    })
 
                 start_time = get_time_object(lesson_start_times[0])
                 start_time_minutes = start_time.hour * 60 + start_time.minute
-                create_detailed_lesson_schedules(lesson_name, lesson_type, start_time_minutes, lesson_title, website_kind)
+                update_detailed_lesson_schedules(
+                    manifest, lesson, website_delivery, lesson_name, lesson_type, start_time_minutes, lesson_title,
+                    website_kind
+                )
             else:
                 path = Path(f"_includes/rsg/{lesson_name}-lesson/blurb.html")
 
@@ -385,23 +543,149 @@ def main():
                 else:
                     blurb = "See course schedule for lesson details"
 
-                table = f"""
-                    <div class="col">
-                        <a href="{lesson_name}-schedule"><h3>{lesson_title}</h3></a>
-                        {blurb}
-                    </div>
-                    """
+                lesson_schedules.append({
+                    "order_on": lesson_order, "lesson_name": lesson_name, "title": lesson_title, "blurb": blurb
+                })
 
-                lesson_schedules.append({"order_on": lesson_order, "schedule": table})
-
-                create_detailed_lesson_schedules(lesson_name, lesson_type, 0, lesson_title,website_kind)
+                update_detailed_lesson_schedules(
+                    manifest, lesson, website_delivery, lesson_name, lesson_type, 0, lesson_title, website_kind
+                )
         else:
             start_time = get_time_object(lesson_start_times)
             start_time_minutes = start_time.hour * 60 + start_time.minute
-            create_detailed_lesson_schedules('', lesson_type, start_time_minutes, lesson_title, website_kind)
+            create_detailed_lesson_schedules('', lesson_type, start_time_minutes, lesson_title, website_kind, manifest)
+
+    for day, rows in zip(lesson_days, create_schedule_rows(lesson_days)):
+        lesson_schedules.append({
+            "order_on": day["date"], "lesson_name": day["lesson_name"], "title": day["title"],
+            "date_string": day["date_string"], "rows": rows,
+        })
 
     if website_kind != 'lesson':
         create_index_schedules(lesson_schedules)
 
+    record_stage(manifest, "get_schedules", schedule_inputs, schedule_outputs)
+    save_manifest(manifest)
+
+
+def find_sites(paths):
+    """Find the websites to make schedules for.
+
+    Parameters
+    ----------
+    paths: list[Path]
+        Each is the config file of a website, a website directory containing
+        _config.yml, or a directory of website directories.
+
+    Returns
+    -------
+    sites: list[tuple[Path, Path]]
+        The directory and config file of each website, in the order given.
+    """
+    sites = {}
+    for path in map(Path, paths):
+        if path.is_file():
+            configs = [path]
+        elif (path / CONFIG_FILE).is_file():
+            configs = [path / CONFIG_FILE]
+        elif path.is_dir():
+            configs = sorted(path.glob(f"*/{CONFIG_FILE}"))
+        else:
+            raise FileNotFoundError(f"{path} is not a config file or a directory")
+        if not configs:
+            raise FileNotFoundError(f"There are no websites in {path}")
+
+        for config in configs:
+            config = config.resolve()
+            if sites.get(config.parent, config) != config:
+                raise ValueError(f"{sites[config.parent]} and {config} are for the same website directory")
+            sites[config.parent] = config
+
+    return list(sites.items())
+
+
+def make_site_schedules(site):
+    """Make the schedules for a website, in its own directory.
+
+    Parameters
+    ----------
+    site: tuple[Path, Path]
+        The directory and config file of the website.
+
+    Returns
+    -------
+    success: bool
+        Whether the schedules were made.
+    """
+    directory, config = site
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        main(load_config(config))
+        return True
+    except Exception:
+        log.exception(f"Could not make the schedules for {directory}")
+        return False
+    finally:
+        os.chdir(cwd)
+        # This may run in a worker process, which does not save its spans
+        # when it exits
+        instrumentation.save_trace()
+
+
+def main_batch(paths, jobs=1):
+    """Make the schedules for many websites in one run.
+
+    The output for each website is the same as running this script in its
+    directory.
+
+    Parameters
+    ----------
+    paths: list[Path]
+        The websites, as for find_sites.
+    jobs: int
+        The number of processes to make the schedules in.
+
+    Returns
+    -------
+    failed: list[Path]
+        The directories of the websites whose schedules could not be made.
+    """
+    sites = find_sites(paths)
+    # The trace is written from each website's directory, so must not be
+    # relative to this one
+    if instrumentation.enabled():
+        os.environ[instrumentation.TRACE_ENV] = str(instrumentation.trace_file().resolve())
+
+    if jobs > 1 and len(sites) > 1:
+        with ProcessPoolExecutor(min(jobs, len(sites))) as pool:
+            results = list(pool.map(make_site_schedules, sites))
+    else:
+        results = [make_site_schedules(site) for site in sites]
+
+    failed = [directory for (directory, _), success in zip(sites, results) if not success]
+    log.info(f"Made the schedules for {len(sites) - len(failed)} of {len(sites)} websites")
+
+    return failed
+
+
+def argument_parser():
+    """Make the command line parser."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "sites", nargs="*", type=Path,
+        help="config files or directories of the websites to make schedules for, defaults to this directory"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=1, help="number of processes to make the schedules of many websites in"
+    )
+    return parser
+
+
 if __name__ == "__main__":
-    main()
+    instrumentation.configure_logging()
+    args = argument_parser().parse_args()
+    if args.sites:
+        sys.exit(1 if main_batch(args.sites, args.jobs) else 0)
+    else:
+        main()
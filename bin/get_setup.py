@@ -1,65 +1,392 @@
+"""Write setup.md from the setup documents needed by the workshop and its
+lessons, taken from the setup-documents repository.
+
+Each setup document is only included once, under the workshop or the first
+lesson which needs it. setup.md is only written when the setup documents it is
+made from, or which ones are needed, have changed, and the figures from
+setup-documents are only synced when they have changed.
+"""
+
+import argparse
 import logging
 import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from shutil import copyfileobj, rmtree
+from pathlib import Path
 from yaml import load
 try:
     from yaml import CLoader as Loader
 except ImportError:
     from yaml import Loader
-from distutils.dir_util import copy_tree
 import warnings
 
+import instrumentation
+from asset_sync import sync_assets
+from build_manifest import hash_file, hash_inputs, hash_path, is_up_to_date, load_manifest, record_stage, save_manifest
+from lesson_cache import CHECKOUT_MODES, DEFAULT_CACHE_DIR, checkout_mirror, fetch_mirror, repository_url
+from lesson_lock import LOCK_FILE, load_lock, locked_repository
+from workshop_config import load_config
+
 log = logging.getLogger(__name__)
 
 # change this to get setup docs
+SETUP_DOCS_ORG = "Southampton-RSG-Training"
+SETUP_DOCS_REPO = "setup-documents"
+SETUP_DOCS_BRANCH = "main"
+SETUP_DOCS_PATH = "submodules/setup-documents"
 
-log.info(f"Getting setup info")
-os.system(f"git submodule add --force -b main https://github.com/Southampton-RSG-Training/setup-documents.git submodules/setup-documents")
-os.system("git submodule update --remote --merge")
+# The paths in setup-documents which the build reads, which are all that is
+# checked out in a sparse checkout
+SETUP_DOCS_PATHS = ["markdown/", "fig/"]
 
-with open('_config.yml') as config:
-    website_config = load(config, Loader=Loader)
+# The number of lesson configs to read at the same time
+CONFIG_READERS = 8
 
-# get list of setup.md chunks from _config.yml and apply order to them
-# Open the website config, which contains a list of the lessons we want in the
-# workshop, then create the directory "submodules" which will contain the files
-# for each lesson.
 
-# First get any docs that are at workshop level. The setup_docs structure is
-# a dictionary where the keys are the workshop/lesson title and the values are
-# a list of filepaths to the setup docs
-try:
-    setup_docs = {website_config['title']: [x for x in website_config['setup_docs']]}
-except (KeyError, TypeError):  # KeyError for when there is no setup_docs, TypeError for when it's empty
-    setup_docs = {website_config['title']: []}
+def setup_documents_commit():
+    """Get the commit the setup-documents checkout is at.
+
+    Returns
+    -------
+    commit: str or None
+        The full SHA of HEAD, or None if there is no checkout.
+    """
+    if not Path(SETUP_DOCS_PATH, ".git").exists():
+        return None
+
+    local = subprocess.run(["git", "-C", SETUP_DOCS_PATH, "rev-parse", "HEAD"], capture_output=True, text=True)
+
+    return local.stdout.strip() if local.returncode == 0 else None
+
+
+def setup_documents_up_to_date(commit):
+    """Check if the setup-documents checkout is at the given commit.
+
+    Parameters
+    ----------
+    commit: str
+        The full SHA of the commit at the head of the setup-documents branch.
+
+    Returns
+    -------
+    up_to_date: bool
+        True when the checkout exists and its HEAD is commit.
+    """
+    return setup_documents_commit() == commit
+
+
+def fetch_setup_documents(cache_dir, checkout="full", frozen=False):
+    """Check out the head of the setup-documents branch.
+
+    Only setup-documents is fetched here, the lessons are already at the head
+    of their branches from get_submodules.py, so there is no need to update
+    every submodule again. The fetch goes through the same cache as the
+    lessons, so nothing is transferred when setup-documents has not changed.
+
+    This does not touch the git index, so it can run at the same time as
+    get_submodules.py.
+
+    Parameters
+    ----------
+    cache_dir: Path
+        The directory containing the cache of repositories.
+    checkout: str
+        How to check out setup-documents, one of CHECKOUT_MODES. A sparse
+        checkout only fetches and checks out SETUP_DOCS_PATHS.
+    frozen: bool
+        Whether to get the commit in the lockfile, rather than the head of the
+        branch.
+
+    Returns
+    -------
+    commit: str
+        The full SHA of the commit checked out.
+    """
+    sparse = checkout == "sparse"
+    expected = {"org-name": SETUP_DOCS_ORG, "branch": SETUP_DOCS_BRANCH}
+    locked = locked_repository(load_lock(), SETUP_DOCS_REPO, expected) if frozen else {}
+    setup_docs_commit = fetch_mirror(
+        cache_dir, SETUP_DOCS_ORG, SETUP_DOCS_REPO, branch=SETUP_DOCS_BRANCH, commit=locked.get("commit"),
+        partial=sparse, pinned=frozen
+    )
+
+    if setup_documents_up_to_date(setup_docs_commit):
+        log.info(f"{SETUP_DOCS_PATH} is up to date, not checking out")
+    else:
+        rmtree(SETUP_DOCS_PATH, ignore_errors=True)
+        checkout_mirror(
+            cache_dir, SETUP_DOCS_ORG, SETUP_DOCS_REPO, Path(SETUP_DOCS_PATH), setup_docs_commit,
+            sparse_paths=SETUP_DOCS_PATHS if sparse else None
+        )
 
-# create a list of setup files already included, so we dont add duplicates
-setups_included = list(setup_docs.values())
+    return setup_docs_commit
 
-# Then get the docs from lesson episode
-for n, lesson_info in enumerate(website_config['lessons']):
-    with open(f'submodules/{lesson_info.get("gh-name")}/_config.yml') as config:
+
+def read_lesson_setup_docs(lesson_name):
+    """Read the title and setup documents of a lesson from its _config.yml.
+
+    Parameters
+    ----------
+    lesson_name: str
+        The name of the lesson, i.e. gh-name.
+
+    Returns
+    -------
+    title, docs: str, list or None
+        The title of the lesson, and its setup documents, or None if it does
+        not have any.
+    """
+    with open(f'submodules/{lesson_name}/_config.yml') as config:
         episode_config = load(config, Loader=Loader)
-        #select element of the dictionary called setup_docs
-        try:
-            docs = [x for x in episode_config['setup_docs'] if x not in setups_included]
-            setup_docs[episode_config['title']] = docs
-            setups_included += docs
-        except (KeyError, TypeError):  # KeyError for when there is no setup_docs, TypeError for when it's empty
-            warnings.warn(f'{episode_config["title"]} does not have any setup docs')
-
-# Get the images for the setup documents
-copy_tree(f"submodules/setup-documents/fig", "fig/")
-
-#for each element in the list
-#paste into a string 'submodules/setup-documents/markdown'+setup docs element
-with open("setup.md", "w") as file_out:
-    for n, (lesson_title, lesson_setups) in enumerate(setup_docs.items()):
-        if n == 0:
-            file_out.write(f'---\ntitle: Setup for {lesson_title}\n---\n')
+
+    return episode_config['title'], episode_config.get('setup_docs')
+
+
+def get_setup_docs(website_config):
+    """Get the setup documents for the workshop and each of its lessons.
+
+    The lesson configs are read at the same time. A setup document is only
+    included once, for the workshop or the first lesson which needs it.
+
+    Parameters
+    ----------
+    website_config: WorkshopConfig
+        The website config.
+
+    Returns
+    -------
+    setup_docs: dict
+        The setup documents, as paths within the markdown directory of
+        setup-documents, keyed by the title of the workshop or lesson, with
+        the workshop first.
+    """
+    # First get any docs that are at workshop level. The setup_docs structure is
+    # a dictionary where the keys are the workshop/lesson title and the values are
+    # a list of filepaths to the setup docs
+    setup_docs = {website_config['title']: []}
+
+    # The setup files already included, so we dont add duplicates
+    setups_included = set()
+
+    def include(title, docs):
+        setup_docs[title] = [doc for doc in dict.fromkeys(docs) if doc not in setups_included]
+        setups_included.update(docs)
+
+    include(website_config['title'], website_config.setup_docs)
+
+    # Then get the docs from lesson episode
+    lesson_names = [lesson_info.get("gh-name") for lesson_info in website_config['lessons']]
+    with ThreadPoolExecutor(max_workers=max(1, min(CONFIG_READERS, len(lesson_names)))) as pool:
+        lesson_setup_docs = list(pool.map(read_lesson_setup_docs, lesson_names))
+
+    for title, docs in lesson_setup_docs:
+        if docs is None:
+            warnings.warn(f'{title} does not have any setup docs')
+        else:
+            include(title, docs)
+
+    return setup_docs
+
+
+def setup_doc_path(setup):
+    """Get the path of a setup document in the setup-documents checkout."""
+    return Path(SETUP_DOCS_PATH) / "markdown" / setup
+
+
+def write_setup(setup_docs):
+    """Write setup.md from the setup documents.
+
+    Each document is streamed into setup.md as text, so its line endings are
+    converted as they always have been. setup.md is only replaced when its
+    contents have changed.
+
+    Parameters
+    ----------
+    setup_docs: dict
+        The setup documents keyed by workshop or lesson title, from
+        get_setup_docs.
+
+    Returns
+    -------
+    written: bool
+        Whether setup.md was replaced.
+    """
+    tmp_file = Path(".setup.md.tmp")
+    with instrumentation.span("setup.md", "setup") as span_args:
+        with open(tmp_file, "w") as file_out:
+            for n, (lesson_title, lesson_setups) in enumerate(setup_docs.items()):
+                if n == 0:
+                    file_out.write(f'---\ntitle: Setup for {lesson_title}\n---\n')
+                else:
+                    file_out.write(f'\n\n# {lesson_title}')
+
+                for setup in lesson_setups:
+                    file_out.write('\n\n')
+                    with open(setup_doc_path(setup), "r", encoding="utf-8", newline=None) as file_in:
+                        copyfileobj(file_in, file_out)
+
+        span_args["bytes"] = tmp_file.stat().st_size
+
+        written = not Path("setup.md").is_file() or hash_file(tmp_file) != hash_file("setup.md")
+        if written:
+            os.replace(tmp_file, "setup.md")
         else:
-            file_out.write('\n\n' + f'# {lesson_title}')
+            log.info("setup.md has the same contents, not replacing")
+            tmp_file.unlink()
+        span_args["files"] = int(written)
+
+    return written
+
+
+def setup_figures_tree():
+    """Get the git tree of the figures in setup-documents, which changes only
+    when they do.
+
+    Returns
+    -------
+    tree: str or None
+        The SHA of the fig directory at HEAD, or None if there is not one.
+    """
+    tree = subprocess.run(["git", "-C", SETUP_DOCS_PATH, "rev-parse", "HEAD:fig"], capture_output=True, text=True)
+
+    return tree.stdout.strip() if tree.returncode == 0 else None
+
+
+def sync_setup_figures(manifest):
+    """Sync the figures from setup-documents into fig/, unless they have not
+    changed since the last build.
+
+    The figures are skipped when the fig tree in setup-documents and the
+    figures synced from the lessons are the same as last time, and none of
+    the figures written last time have been removed.
+
+    Parameters
+    ----------
+    manifest: dict
+        The build manifest.
+    """
+    stage = "get_setup/fig"
+    inputs = hash_inputs(setup_figures_tree(), manifest["assets"].get("get_submodules"))
+    written = manifest["assets"].get("get_setup", {})
+    if is_up_to_date(manifest, stage, inputs, []) and all(Path(dest).is_file() for dest in written):
+        log.info("The setup-documents figures have not changed since the last build, not syncing")
+        return
+
+    # Only images which have changed are written, and a clash with an image
+    # from a lesson is reported
+    sync_assets(manifest, "get_setup", [(SETUP_DOCS_REPO, Path(f"{SETUP_DOCS_PATH}/fig"), "fig")])
+    record_stage(manifest, stage, inputs)
+
+
+@instrumentation.traced("get_setup")
+def main(cache_dir=DEFAULT_CACHE_DIR, fetch=True, build=True, website_config=None, checkout="full", frozen=False):
+    """Get setup-documents and write setup.md.
+
+    The two halves can be run separately, so setup-documents can be fetched
+    while the lessons are being fetched by get_submodules.py, then setup.md
+    written once the lessons are in place.
+
+    Parameters
+    ----------
+    cache_dir: Path
+        The directory containing the cache of repositories.
+    fetch: bool
+        Whether to fetch and check out setup-documents, otherwise the existing
+        checkout is used.
+    build: bool
+        Whether to write setup.md and copy the images.
+    website_config: WorkshopConfig or None
+        The website config, or None to load _config.yml.
+    checkout: str
+        How to check out setup-documents, one of CHECKOUT_MODES.
+    frozen: bool
+        Whether to get the commit of setup-documents in the lockfile.
+    """
+    log.info(f"Getting setup info")
+
+    if fetch:
+        setup_docs_commit = fetch_setup_documents(cache_dir, checkout, frozen)
+    else:
+        setup_docs_commit = setup_documents_commit()
+        if setup_docs_commit is None:
+            raise FileNotFoundError(f"There is no checkout of setup-documents in {SETUP_DOCS_PATH}")
+
+    if not build:
+        return
+
+    instrumentation.system(
+        f"git submodule add --force -b {SETUP_DOCS_BRANCH} {repository_url(SETUP_DOCS_ORG, SETUP_DOCS_REPO)} "
+        f"{SETUP_DOCS_PATH}",
+        name=f"git submodule add {SETUP_DOCS_REPO}", category="git", lesson=SETUP_DOCS_REPO
+    )
+
+    build_setup(website_config)
+
+
+def build_setup(website_config=None):
+    """Write setup.md and copy the images from the checkout of setup-documents.
+
+    setup.md is only written when the setup docs which are needed, or their
+    contents, have changed since the last build.
+
+    Parameters
+    ----------
+    website_config: WorkshopConfig or None
+        The website config, or None to load _config.yml.
+    """
+    if website_config is None:
+        website_config = load_config()
+
+    setup_docs = get_setup_docs(website_config)
+    manifest = load_manifest()
+
+    sync_setup_figures(manifest)
+
+    # Skip writing setup.md when neither which setup docs are needed or their
+    # contents have changed since the last build, even if other parts of
+    # setup-documents have
+    doc_hashes = {setup: hash_path(setup_doc_path(setup)) for docs in setup_docs.values() for setup in docs}
+    setup_inputs = hash_inputs(setup_docs, doc_hashes)
+    setup_outputs = ["setup.md"]
+
+    if is_up_to_date(manifest, "get_setup", setup_inputs, setup_outputs):
+        log.info("setup.md has not changed since the last build, not writing")
+    else:
+        write_setup(setup_docs)
+        record_stage(manifest, "get_setup", setup_inputs, setup_outputs)
+
+    save_manifest(manifest)
+
+
+def argument_parser():
+    """Make the command line parser, with defaults taken from the environment."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--cache-dir", type=Path, default=Path(os.environ.get("RSG_CACHE_DIR", DEFAULT_CACHE_DIR)),
+        help=f"directory to cache repositories in, defaults to $RSG_CACHE_DIR or {DEFAULT_CACHE_DIR}"
+    )
+    parser.add_argument(
+        "--checkout", choices=CHECKOUT_MODES, default=os.environ.get("RSG_CHECKOUT", "full"),
+        help="check out every file of setup-documents, or only the paths the build reads from a partial clone, "
+             "defaults to $RSG_CHECKOUT or full"
+    )
+    parser.add_argument(
+        "--frozen", action="store_true", default=bool(os.environ.get("RSG_FROZEN")),
+        help=f"get the commit pinned in {LOCK_FILE}, defaults to on if $RSG_FROZEN is set"
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--fetch-only", action="store_true", help="only fetch and check out setup-documents, do not write setup.md"
+    )
+    group.add_argument(
+        "--no-fetch", action="store_true", help="write setup.md from the existing checkout of setup-documents"
+    )
+    return parser
+
 
-        for setup in lesson_setups:
-            doc_filepath = 'submodules/setup-documents/markdown/' + setup
-            with open(doc_filepath, "r", encoding="utf-8") as file_in:
-                file_out.write('\n\n' + file_in.read())
+if __name__ == "__main__":
+    instrumentation.configure_logging()
+    args = argument_parser().parse_args()
+    main(args.cache_dir, fetch=not args.no_fetch, build=not args.fetch_only, checkout=args.checkout,
+         frozen=args.frozen)
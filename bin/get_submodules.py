@@ -3,26 +3,77 @@ from each lesson into the appropriate directory structure.
 """
 
 import os
+import json
+import argparse
 import logging
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 from shutil import copy2 as copy
 from shutil import rmtree
 from shutil import copytree
+from shutil import ignore_patterns
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
-from yaml import load
-
-try:
-    from yaml import CLoader as Loader
-except ImportError:
-    from yaml import Loader
-import requests
-from requests.exceptions import ConnectTimeout
+import instrumentation
+from asset_sync import clone_file, sync_assets
+from build_manifest import hash_file, hash_inputs, is_up_to_date, load_manifest, record_stage, save_manifest, set_entry
+from episodes import SCHEDULE_FILE, rewrite_lesson_episodes
+from get_setup import SETUP_DOCS_ORG, SETUP_DOCS_PATH, SETUP_DOCS_REPO
+from github_api import GitHubAPI
+from lesson_lock import LOCK_FILE, load_lock, locked_lessons, locked_repository
+from lesson_cache import CHECKOUT_MODES, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_MB
+from lesson_cache import checkout_mirror, evict_mirrors, fetch_mirror, mirror_path, repository_url
+from lesson_store import DEFAULT_STORE_SIZE_MB, add_artifact, artifact_key, evict_artifacts, link_tree
+from lesson_store import lookup_artifact, materialize
+from workshop_config import WorkshopConfig, load_config
 
 log = logging.getLogger(__name__)
 
+# The number of lessons to resolve and clone at the same time
+DEFAULT_JOBS = 8
+
+# How the org and branch of each lesson are checked: "api" asks the GitHub API
+# and "ls-remote" asks git directly, which also gives the commit to fetch
+RESOLVERS = ["api", "ls-remote"]
+
+# The version of reveal.js used to build the slides
+REVEALJS_ORG = "hakimel"
+REVEALJS_REPO = "reveal.js"
+REVEALJS_COMMIT = "8a54118f43"
+
+# slides are built using pandoc in this script -- sometimes we seem to need to
+# specify revealjs-url
+PANDOC_COMMAND = "pandoc -t revealjs -s -o index.html index.md -V theme=black --slide-level=3 "
+PANDOC_COMMAND += "revealjs-url='https://cdnjs.cloudflare.com/ajax/libs/reveal.js/3.9.2'"
+
+# How reveal.js is put alongside each slide deck: "copy" copies it into each
+# deck, "hardlink" hardlinks the files of one copy into each deck and "shared"
+# puts one copy in slides/reveal.js which every deck refers to
+REVEALJS_MODES = ["copy", "hardlink", "shared"]
+
+# The steps of getting the lessons, in the order main runs them. The steps in
+# LESSON_STEPS are run once for each lesson, so bin/build.py --graph can run
+# e.g. the slides of one lesson while another is still being cloned
+STEPS = ["clone", "content", "assets", "reveal.js", "slides", "register"]
+LESSON_STEPS = ["clone", "content", "slides"]
+
+# The directories in each lesson which are merged into the top level of the
+# website
+SHARED_DIRECTORIES = ["fig", "data", "code"]
+
+# The paths in each lesson which the build reads, which are all that is
+# checked out in a sparse checkout
+LESSON_PATHS = ["_config.yml", "blurb.html", "reference.md", "_episodes/", "slides/"] + [
+    f"{directory}/" for directory in SHARED_DIRECTORIES
+]
+
 
-def check_org_name_and_branch(lesson_name: str, org_name: str, gh_branch: str) -> Tuple[str, str]:
+def check_org_name_and_branch(lesson_name: str, org_name: str, gh_branch: str,
+                              api: Optional[GitHubAPI] = None) -> Tuple[str, str]:
     """
     Check the GH org name and branch are correct for a lesson.
 
@@ -39,43 +90,51 @@ def check_org_name_and_branch(lesson_name: str, org_name: str, gh_branch: str) -
         The proposed org name where the lesson repo should exist.
     gh_branch:
         The proposed branch of the repo containing the lesson.
+    api:
+        The client to make requests to the GitHub API with. Sharing one client
+        between lessons reuses its connections and cached responses.
     """
+    from requests.exceptions import ConnectTimeout
+
+    if api is None:
+        api = GitHubAPI()
+
     ret_org_name = org_name
     ret_gh_branch = gh_branch
 
     try:
-        r = requests.get(f'https://api.github.com/repos/{org_name}/{lesson_name}', timeout=7)
+        status = api.status(f'repos/{org_name}/{lesson_name}')
     except ConnectTimeout as exc:
         raise Exception(f"Connection timeout when trying to find {org_name}/{lesson_name} repository") from exc
 
-    if r.status_code != 200:
+    if status != 200:
         log.warning(f'Lesson {lesson_name} does not exist in {org_name} trying in default org')
 
         try:
-            r = requests.get(f'https://api.github.com/repos/Southampton-RSG-Training/{lesson_name}', timeout=7)
+            status = api.status(f'repos/Southampton-RSG-Training/{lesson_name}')
         except ConnectTimeout as exc:
             raise Exception(f"Connection timeout when trying to find Southampton-RSG-Training/{lesson_name} repository") from exc
 
-        if r.status_code == 200:
+        if status == 200:
             log.warning(f"Lesson {lesson_name} found in 'Southampton-RSG-Training' using as fallback")
             ret_org_name = "Southampton-RSG-Training"
         else:
             raise ValueError(f"Lesson {lesson_name} does not exist in '{org_name}', or 'Southampton-RSG-Training'")
     else:
         try:
-            r = requests.get(f'https://api.github.com/repos/{org_name}/{lesson_name}/branches/{gh_branch}', timeout=7)
+            status = api.status(f'repos/{org_name}/{lesson_name}/branches/{gh_branch}')
         except ConnectTimeout as exc:
             raise Exception("Connection timeout when trying to find {gh_branch} branch in {org_name}/{lesson_name}") from exc
 
-        if r.status_code != 200:
+        if status != 200:
             log.warning(f'Branch {gh_branch} does not exist in {org_name}/{lesson_name} trying default branch')
 
             try:
-                r = requests.get(f'https://api.github.com/repos/{org_name}/{lesson_name}/branches/gh-pages', timeout=7)
+                status = api.status(f'repos/{org_name}/{lesson_name}/branches/gh-pages')
             except ConnectTimeout as exc:
                 raise Exception("Connection timeout when trying to find gh-pages branch in {org_name}/{lesson}") from exc
 
-            if r.status_code == 200:
+            if status == 200:
                 log.warning(f'Branch {gh_branch} found in {org_name}/{lesson_name} using as fallback')
                 ret_gh_branch = "gh-pages"
             else:
@@ -84,123 +143,1025 @@ def check_org_name_and_branch(lesson_name: str, org_name: str, gh_branch: str) -
     return ret_org_name, ret_gh_branch
 
 
-# Remove previously existing directories, to start fresh
+def list_remote_heads(urls: List[str]) -> List[Optional[Dict[str, str]]]:
+    """
+    List the branches of several repositories at the same time.
+
+    Parameters
+    ----------
+    urls:
+        The URLs of the repositories.
+
+    Returns
+    -------
+    heads:
+        For each repository, a dict of the commit at the head of each branch
+        keyed by branch name, or None if the repository does not exist.
+    """
+    # Without a terminal prompt, git fails straight away for a repository which
+    # does not exist instead of asking for credentials
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    processes = [
+        subprocess.Popen(
+            ["git", "ls-remote", "--heads", url], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, env=env
+        )
+        for url in urls
+    ]
+
+    heads = []
+    for process in processes:
+        stdout, _ = process.communicate()
+        if process.returncode != 0:
+            heads.append(None)
+            continue
+        branches = {}
+        for line in stdout.splitlines():
+            commit, ref = line.split()
+            branches[ref.removeprefix("refs/heads/")] = commit
+        heads.append(branches)
+
+    return heads
+
+
+def resolve_with_ls_remote(lesson_name: str, org_name: str, gh_branch: str) -> Tuple[str, str, str]:
+    """
+    Check the GH org name and branch are correct for a lesson using git.
+
+    This has the same fallbacks as check_org_name_and_branch, first trying
+    the lesson in 'Southampton-RSG-Training' if it does not exist in org_name
+    and then the 'gh-pages' branch if gh_branch does not exist, but without
+    using the GitHub API. Both orgs are asked at the same time, with a single
+    git ls-remote each, which also gives the commit at the head of the branch.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson to check
+    org_name:
+        The proposed org name where the lesson repo should exist.
+    gh_branch:
+        The proposed branch of the repo containing the lesson.
+
+    Returns
+    -------
+    org_name, gh_branch, commit:
+        The org name and branch to use, and the commit at the head of the
+        branch.
+    """
+    orgs = list(dict.fromkeys([org_name, "Southampton-RSG-Training"]))
+    heads = list_remote_heads([repository_url(org, lesson_name) for org in orgs])
+
+    for org, branches in zip(orgs, heads):
+        if branches is None:
+            log.warning(f'Lesson {lesson_name} does not exist in {org}')
+            continue
+        if org != org_name:
+            log.warning(f"Lesson {lesson_name} found in '{org}' using as fallback")
 
-rmtree("submodules", ignore_errors=True)
-# rmtree("slides", ignore_errors=True)
+        for branch in dict.fromkeys([gh_branch, "gh-pages"]):
+            if branch in branches:
+                if branch != gh_branch:
+                    log.warning(f'Branch {gh_branch} does not exist in {org}/{lesson_name} using {branch} as fallback')
+                return org, branch, branches[branch]
 
-Path("submodules").mkdir(parents=True, exist_ok=True)
+        raise ValueError(f"Branch '{gh_branch}' or 'gh-pages' does not exist in '{org}/{lesson_name}'")
 
-# Open the website config, which contains a list of the lessons we want in the
-# workshop, then create the directory "submodules" which will contain the files
-# for each lesson
+    raise ValueError(f"Lesson {lesson_name} does not exist in '{org_name}', or 'Southampton-RSG-Training'")
 
-with open('_config.yml', 'r') as config:
-    website_config = load(config, Loader=Loader)
 
-log.info(f"Getting submodules specified in {website_config['lessons']}")
+def resolve_lesson(n: int, lesson_info: dict, cache_dir: Path, api: Optional[GitHubAPI],
+                   resolver: str = "api", checkout: str = "full") -> Tuple[str, str, str, str]:
+    """
+    Resolve the org and branch for a lesson and fetch its head into the cache.
 
-# Now process each lesson in the list
+    The lesson is fetched into its mirror in the cache, which is skipped if the
+    mirror is already at the head of the branch.
 
-for n, lesson_info in enumerate(website_config['lessons']):
+    Parameters
+    ----------
+    n:
+        The position of the lesson in the lessons list, used for error messages.
+    lesson_info:
+        The lesson entry from the lessons list in _config.yml.
+    cache_dir:
+        The directory containing the cache of lesson repositories.
+    api:
+        The client to check the lesson exists with the GitHub API, which is
+        only needed by the "api" resolver.
+    resolver:
+        How to check the lesson's org and branch, either "api" to use the
+        GitHub API or "ls-remote" to use git.
+    checkout:
+        How the lesson will be checked out, one of CHECKOUT_MODES. Only the
+        commits and trees are fetched for a sparse checkout.
 
-    # Create the command to pull the sub-directory from GitHub
+    Returns
+    -------
+    lesson_name, org_name, gh_branch, commit:
+        The name of the lesson, the resolved org name and branch and the commit
+        at the head of the branch.
+    """
     org_name = lesson_info.get("org-name", "Southampton-RSG-Training")
     lesson_name = lesson_info.get('gh-name', None)
     if not lesson_name:
         raise ValueError(f"No lesson name specified for lesson {n}")
     gh_branch = lesson_info.get('branch', 'main')
 
-    org_name, gh_branch = check_org_name_and_branch(lesson_name, org_name, gh_branch)
+    with instrumentation.span(f"resolve {lesson_name}", "resolve", lesson=lesson_name, resolver=resolver):
+        if resolver == "ls-remote":
+            org_name, gh_branch, commit = resolve_with_ls_remote(lesson_name, org_name, gh_branch)
+        else:
+            org_name, gh_branch = check_org_name_and_branch(lesson_name, org_name, gh_branch, api)
+            commit = None
     log.info(f"Getting lesson with parameters:\n org-name: {org_name} \n gh-name: {lesson_name} \n branch: {gh_branch}")
 
-    os.system(f"git submodule add --force -b {gh_branch} https://github.com/{org_name}/{lesson_name}.git submodules/{lesson_name}")
-    os.system("git submodule update --remote --merge")
+    # Only the head of the branch is used to build the website, so the mirror
+    # holds a shallow copy of the branch
+    commit = fetch_mirror(
+        cache_dir, org_name, lesson_name, branch=gh_branch, commit=commit, partial=checkout == "sparse"
+    )
+
+    return lesson_name, org_name, gh_branch, commit
+
+
+def clone_lesson(n: int, lesson_info: dict, cache_dir: Path, api: Optional[GitHubAPI],
+                 resolver: str = "api", checkout: str = "full",
+                 locked: Optional[Dict[str, str]] = None) -> Tuple[str, str, str, str]:
+    """
+    Get a lesson into its mirror in the cache and check it out in submodules/.
+
+    This is the network bound part of getting a lesson, so is safe to run
+    concurrently for each lesson. Registering the clone as a submodule is done
+    afterwards, as git does not allow concurrent writes to the index.
+
+    The lesson is resolved and fetched by resolve_lesson, unless it is locked,
+    in which case the commit in the lockfile is fetched without asking GitHub
+    anything. A sparse checkout only fetches and checks out LESSON_PATHS.
+
+    Parameters
+    ----------
+    n:
+        The position of the lesson in the lessons list, used for error messages.
+    lesson_info:
+        The lesson entry from the lessons list in _config.yml.
+    cache_dir:
+        The directory containing the cache of lesson repositories.
+    api:
+        The client to check the lesson exists with the GitHub API, which is
+        only needed by the "api" resolver.
+    resolver:
+        How to check the lesson's org and branch, either "api" to use the
+        GitHub API or "ls-remote" to use git.
+    checkout:
+        How to check out the lesson, one of CHECKOUT_MODES.
+    locked:
+        The lesson's entry in the lockfile, or None to use the head of its
+        branch.
+
+    Returns
+    -------
+    lesson_name, org_name, gh_branch, commit:
+        The name of the lesson, the resolved org name and branch and the commit
+        which was checked out.
+    """
+    sparse = checkout == "sparse"
+    if locked is None:
+        lesson_name, org_name, gh_branch, commit = resolve_lesson(n, lesson_info, cache_dir, api, resolver, checkout)
+    else:
+        lesson_name, org_name, gh_branch = lesson_info["gh-name"], locked["org-name"], locked["branch"]
+        log.info(f"Getting {org_name}/{lesson_name}@{gh_branch} at {locked['commit'][:10]} from {LOCK_FILE}")
+        commit = fetch_mirror(
+            cache_dir, org_name, lesson_name, branch=gh_branch, commit=locked["commit"], partial=sparse, pinned=True
+        )
+
+    # The checkout from a previous build is replaced
+    rmtree(f"submodules/{lesson_name}", ignore_errors=True)
+    checkout_mirror(
+        cache_dir, org_name, lesson_name, Path(f"submodules/{lesson_name}"), commit,
+        sparse_paths=LESSON_PATHS if sparse else None
+    )
+
+    return lesson_name, org_name, gh_branch, commit
+
+
+def record_repository(manifest: dict, repo_name: str, org_name: str, gh_branch: Optional[str], commit: str) -> None:
+    """
+    Record what a lesson, or reveal.js, was resolved to and checked out at, for
+    the steps which come after it.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest.
+    repo_name:
+        The name of the repository, i.e. gh-name for a lesson.
+    org_name:
+        The org it was checked out from.
+    gh_branch:
+        The branch it was checked out from, or None for reveal.js.
+    commit:
+        The commit which was checked out.
+    """
+    set_entry(manifest, "repositories", repo_name, {"org-name": org_name, "branch": gh_branch, "commit": commit})
+
+
+def lesson_outputs(lesson_name: str) -> List[str]:
+    """
+    List the files and directories written by copy_lesson_content.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    """
+    return [f"_includes/rsg/{lesson_name}-lesson", f"_episodes/{lesson_name}-lesson"]
+
 
-    # move required files from the subdirectories to _includes/rsg/{lesson_name}/...
-    # lesson destinations need to be appended with -lesson to avoid gh-pages naming conflicts
+def process_lesson_content(lesson_name: str, lesson_info: dict, dest: Path) -> None:
+    """
+    Process the content of a cloned lesson into an entry in the lesson store.
 
+    The entry holds the lesson's blurb in includes/, its rewritten episodes in
+    episodes/ and the index of the episodes in index.json.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    lesson_info:
+        The lesson entry from the lessons list in _config.yml.
+    dest:
+        The directory to build the entry in.
+    """
     # Things to move to ./_includes/rsg
-    includes_dest = f"_includes/rsg/{lesson_name}-lesson"
-    Path(includes_dest).mkdir(parents=True, exist_ok=True)
+    includes_dest = dest / "includes"
+    includes_dest.mkdir(parents=True, exist_ok=True)
 
     for file in ["blurb.html"]:
         try:
-            copy(f"submodules/{lesson_name}/{file}", f"{includes_dest}/{file.split('/')[-1]}")
-            log.info(f"Copied submodules/{lesson_name}/{file} to {includes_dest}")
+            copy(f"submodules/{lesson_name}/{file}", includes_dest / file.split('/')[-1])
+            log.info(f"Copied submodules/{lesson_name}/{file}")
         except IOError:
             log.error(f"Cannot find or move submodules/{lesson_name}/{file}, but carrying on anyway")
 
-    # Move lesson episodes into the _episodes directory
-    lesson_content_dest = f"_episodes/{lesson_name}-lesson"
-    Path(lesson_content_dest).mkdir(parents=True, exist_ok=True)
-    copytree(f"submodules/{lesson_name}/_episodes/", lesson_content_dest, dirs_exist_ok=True)
-
     # move any extra lesson files into the same directory as the episodes, e.g.
     # the glossary is a good example
+    extra_files = []
     for file in ["reference.md"]:
-        try:
-            copy(f"submodules/{lesson_name}/{file}", f"{lesson_content_dest}/{file.split('/')[-1]}")
-        except IOError:
+        if Path(f"submodules/{lesson_name}/{file}").is_file():
+            extra_files.append(Path(f"submodules/{lesson_name}/{file}"))
+        else:
             log.error(f"Cannot find or move submodules/{lesson_name}/{file}, but carrying on anyway")
 
-    # now we need to add two additional frontmatter variables to link the
-    # lesson episodes to the correct syllabus/schedule
-    for file in os.listdir(lesson_content_dest):
-        if file.endswith(".md"):
-            with open(f"{lesson_content_dest}/{file}", "r") as f:
-                contents = f.readlines()
-            contents.insert(
-                1,
-                f"lesson_title: '{lesson_info.get('title', '')}'\nlesson_schedule_slug: {lesson_name}-schedule\n"
-            )
-            with open(f"{lesson_content_dest}/{file}", "w") as f:
-                f.write("".join(contents))
+    # On the way into the store, the episodes are renumbered and we add two
+    # additional frontmatter variables to link the lesson episodes to the
+    # correct syllabus/schedule, all in one pass over each file. The index of
+    # the episodes lets get_schedules.py renumber them without reading them
+    # again
+    with instrumentation.span(f"rewrite episodes {lesson_name}", "episodes", lesson=lesson_name) as span_args:
+        stats, index = rewrite_lesson_episodes(
+            Path(f"submodules/{lesson_name}/_episodes"), dest / "episodes", extra_files, lesson_info.get('title', ''),
+            lesson_name
+        )
+        span_args["files"] = stats["written"]
+        span_args["bytes"] = stats["bytes"]
+    with open(dest / "index.json", "w") as fp:
+        json.dump(index, fp)
 
-    # Moves figures into fig directory
-    try:
-        copytree(f"submodules/{lesson_name}/fig", "fig/", dirs_exist_ok=True)
-    except IOError:
-        log.info(f"No figures to move for {lesson_name}")
 
-    # Move lesson data into data directory
-    try:
-        copytree(f"submodules/{lesson_name}/data", "data/", dirs_exist_ok=True)
-    except IOError:
-        log.info(f"No data file to move for {lesson_name}")
+def link_lesson_content(lesson_name: str, artifact: Path, manifest: dict) -> int:
+    """
+    Put a lesson's processed content into the website directory structure.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    artifact:
+        The processed content, from process_lesson_content.
+    manifest:
+        The build manifest, to keep the index of the lesson's episodes in.
+
+    Returns
+    -------
+    files:
+        The number of files which were linked.
+    """
+    # move required files to _includes/rsg/{lesson_name}/... lesson
+    # destinations need to be appended with -lesson to avoid gh-pages naming
+    # conflicts. The lesson schedule is written by get_schedules.py
+    includes_dest, episodes_dest = (Path(output) for output in lesson_outputs(lesson_name))
+    with instrumentation.span(f"materialize {lesson_name}", "store", lesson=lesson_name) as span_args:
+        stats = materialize(artifact / "includes", includes_dest)
+        episode_stats = materialize(artifact / "episodes", episodes_dest, keep=[SCHEDULE_FILE])
+        span_args["files"] = stats["linked"] + episode_stats["linked"]
+
+    with open(artifact / "index.json", "r") as fp:
+        set_entry(manifest, "episodes", episodes_dest.as_posix(), json.load(fp))
+
+    return span_args["files"]
+
+
+def copy_lesson_content(lesson_name: str, lesson_info: dict, commit: Optional[str], cache_dir: Path,
+                        manifest: dict) -> bool:
+    """
+    Move the content of a cloned lesson into the website directory structure.
+
+    The processed content is taken from the lesson store if another build has
+    already processed the lesson at this commit with the same title, and is
+    otherwise processed into the store. Either way, it is reflinked or
+    hardlinked from the store into the website.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    lesson_info:
+        The lesson entry from the lessons list in _config.yml.
+    commit:
+        The commit of the lesson which has been cloned, or None if the
+        checkout may have been edited, in which case it is processed without
+        using the store.
+    cache_dir:
+        The directory containing the cache, and the lesson store.
+    manifest:
+        The build manifest, to keep the index of the lesson's episodes in.
 
-    # Move codes for lessons into code directory
+    Returns
+    -------
+    stored:
+        True if the content was already in the store.
+    """
+    if commit is None:
+        # Processed next to the store, so the files can still be linked
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=cache_dir) as tmp:
+            process_lesson_content(lesson_name, lesson_info, Path(tmp))
+            n_files = link_lesson_content(lesson_name, Path(tmp), manifest)
+        log.info(f"Linked {n_files} files of {lesson_name} from its checkout")
+        return False
+
+    key = artifact_key(commit, lesson_info.get('title', ''), lesson_name)
+    artifact = lookup_artifact(cache_dir, "lessons", key)
+    stored = artifact is not None
+    if not stored:
+        artifact = add_artifact(cache_dir, "lessons", key, partial(process_lesson_content, lesson_name, lesson_info))
+
+    n_files = link_lesson_content(lesson_name, artifact, manifest)
+    log.info(f"Linked {n_files} files of {lesson_name} from the store{'' if stored else ', newly processed'}")
+
+    return stored
+
+
+def link_or_copy(src: str, dst: str) -> None:
+    """
+    Hardlink a file, or copy it if it cannot be linked, e.g. across filesystems.
+
+    Parameters
+    ----------
+    src:
+        The file to link to.
+    dst:
+        The path of the new link.
+    """
     try:
-        copytree(f"submodules/{lesson_name}/code", "code/", dirs_exist_ok=True)
-    except IOError:
-        log.info(f"No code files for {lesson_name}")
+        os.link(src, dst)
+    except OSError:
+        copy(src, dst)
 
-# Now need to do copy the slides over, but have to do it afterwards because we
-# need a specific version of reveal.js and so we need to avoid the git submodule
-# update
 
-os.system("git submodule add --force https://github.com/hakimel/reveal.js.git submodules/reveal.js")
-os.system("cd submodules/reveal.js && git checkout 8a54118f43")
+def install_revealjs(dest: str, revealjs_mode: str) -> None:
+    """
+    Put a copy of the reveal.js submodule, without its git metadata, at dest.
 
-for n, lesson_info in enumerate(website_config['lessons']):
-    # if we've gotten here, am gonna assume lesson_name exists
-    lesson_name = lesson_info.get('gh-name', None)
+    Parameters
+    ----------
+    dest:
+        The directory to put reveal.js in, which is replaced if it exists.
+    revealjs_mode:
+        How to copy reveal.js, "hardlink" to hardlink the files or anything
+        else to copy them.
+    """
+    rmtree(dest, ignore_errors=True)
+    copytree(
+        "submodules/reveal.js", dest, ignore=ignore_patterns(".git"),
+        copy_function=link_or_copy if revealjs_mode == "hardlink" else copy,
+    )
+
+
+def pandoc_command(revealjs_mode: str) -> str:
+    """
+    Get the pandoc command to build a slide deck with.
+
+    Parameters
+    ----------
+    revealjs_mode:
+        How reveal.js is put alongside the deck, one of REVEALJS_MODES.
+    """
+    if revealjs_mode == "shared":
+        return PANDOC_COMMAND + " -V revealjs-url=../reveal.js"
+    return PANDOC_COMMAND
+
+
+def copy_lesson_slides(lesson_name: str, revealjs_mode: str = "hardlink") -> bool:
+    """
+    Copy the slides for a lesson, if it has any, ready to be built.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    revealjs_mode:
+        How reveal.js is put alongside the slides, one of REVEALJS_MODES.
+
+    Returns
+    -------
+    has_slides:
+        True if the lesson has slides which need building.
+    """
     slides_src = Path(f"submodules/{lesson_name}/slides")
     # not all lessons have slides, so check the dir exists
-    if slides_src.is_dir():
+    if not slides_src.is_dir():
+        return False
+
+    # The lesson reveal.js folder is empty, so is replaced by the reveal.js
+    # submodule. The slides from a previous build may be linked to the lesson
+    # store, so are removed rather than copied over
+    with instrumentation.span(f"copy slides {lesson_name}", "copy", lesson=lesson_name):
         slides_dest = Path(f"slides/{lesson_name}/")
-        slides_dest.mkdir(parents=True, exist_ok=True)
-        copytree(f"submodules/{lesson_name}/slides", str(slides_dest), dirs_exist_ok=True)
+        rmtree(slides_dest, ignore_errors=True)
+        copytree(str(slides_src), str(slides_dest), ignore=ignore_patterns("reveal.js"))
+        install_lesson_revealjs(lesson_name, revealjs_mode)
+
+    return True
 
-        # The lesson reveal.js folder which gets copied is empty, so delete that
-        # and copy the reveal.js submodule
+
+def install_lesson_revealjs(lesson_name: str, revealjs_mode: str) -> None:
+    """
+    Put reveal.js alongside a lesson's slides.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    revealjs_mode:
+        How reveal.js is put alongside the slides, one of REVEALJS_MODES.
+    """
+    if revealjs_mode == "shared":
         rmtree(f"slides/{lesson_name}/reveal.js", ignore_errors=True)
-        Path(f"slides/{lesson_name}/reveal.js").mkdir(parents=True, exist_ok=True)
-        copytree("submodules/reveal.js", f"slides/{lesson_name}/reveal.js", dirs_exist_ok=True)
+    else:
+        install_revealjs(f"slides/{lesson_name}/reveal.js", revealjs_mode)
+
+
+def link_lesson_slides(lesson_name: str, artifact: Path, revealjs_mode: str) -> None:
+    """
+    Put a lesson's built slides from the lesson store into the website.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    artifact:
+        The slides in the lesson store, which do not include reveal.js.
+    revealjs_mode:
+        How reveal.js is put alongside the slides, one of REVEALJS_MODES.
+    """
+    with instrumentation.span(f"materialize slides {lesson_name}", "store", lesson=lesson_name) as span_args:
+        stats = materialize(artifact, Path(f"slides/{lesson_name}"), keep=["reveal.js"])
+        install_lesson_revealjs(lesson_name, revealjs_mode)
+        span_args["files"] = stats["linked"]
+
+
+def get_pandoc_version() -> Optional[str]:
+    """Get the version of pandoc, or None if pandoc is not installed."""
+    try:
+        result = subprocess.run(["pandoc", "--version"], capture_output=True, text=True)
+    except FileNotFoundError:
+        return None
+
+    return result.stdout.splitlines()[0] if result.returncode == 0 else None
+
+
+def render_lesson_slides(lesson_name: str, cache_dir: Path, pandoc_version: str,
+                         command: str = PANDOC_COMMAND) -> Tuple[str, float, bool]:
+    """
+    Build the slides for a lesson with pandoc, or copy them from the store.
+
+    The built slides are kept in the lesson store by the hash of index.md, the
+    version of pandoc and the pandoc command, so a deck is only built once for
+    each version of its slides.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    cache_dir:
+        The directory containing the cache.
+    pandoc_version:
+        The version of pandoc, from get_pandoc_version.
+    command:
+        The pandoc command to build the slides with, from pandoc_command.
+
+    Returns
+    -------
+    lesson_name, seconds, cached:
+        The name of the lesson, how long it took and if the slides came from
+        the store.
+    """
+    start = time.perf_counter()
+    slides_dir = Path(f"slides/{lesson_name}")
+    key = artifact_key(hash_file(slides_dir / "index.md"), pandoc_version, command)
+
+    with instrumentation.span(f"pandoc {lesson_name}", "pandoc", lesson=lesson_name) as span_args:
+        artifact = lookup_artifact(cache_dir, "pandoc", key)
+        span_args["cached"] = artifact is not None
+        if artifact is not None:
+            copy(artifact / "index.html", slides_dir / "index.html")
+        else:
+            subprocess.run(command, shell=True, cwd=slides_dir, check=True)
+            add_artifact(
+                cache_dir, "pandoc", key, lambda dest: clone_file(slides_dir / "index.html", dest / "index.html")
+            )
+        span_args["files"] = 1
+        span_args["bytes"] = (slides_dir / "index.html").stat().st_size
+
+    return lesson_name, time.perf_counter() - start, artifact is not None
+
+
+def build_lesson_content(lesson_name: str, lesson_info: dict, cache_dir: Path, manifest: dict) -> None:
+    """
+    Put the content of a cloned lesson into the website, unless it has not
+    changed since the last build.
+
+    This is the "content" step of a lesson, which comes after its "clone" step.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    lesson_info:
+        The lesson entry from the lessons list in _config.yml.
+    cache_dir:
+        The directory containing the cache, and the lesson store.
+    manifest:
+        The build manifest, with the commit the lesson was checked out at.
+    """
+    repository = manifest["repositories"][lesson_name]
+    stage = f"get_submodules/{lesson_name}"
+    inputs = hash_inputs(lesson_info, repository["org-name"], repository["branch"], repository["commit"])
+    outputs = lesson_outputs(lesson_name)
+    if is_up_to_date(manifest, stage, inputs, outputs):
+        log.info(f"{lesson_name} has not changed since the last build, not copying")
+    else:
+        copy_lesson_content(lesson_name, lesson_info, repository["commit"], cache_dir, manifest)
+        record_stage(manifest, stage, inputs, outputs)
+
+
+def sync_lesson_assets(manifest: dict, website_config: WorkshopConfig) -> Dict[str, int]:
+    """
+    Merge the figures, data and code of every lesson into the top level
+    directories.
+
+    Only files which have changed are written, and files from lessons which
+    have been removed from _config.yml are deleted.
+
+    Parameters
+    ----------
+    manifest:
+        The build manifest, which records the files written for each lesson.
+    website_config:
+        The website config.
+
+    Returns
+    -------
+    stats:
+        The number of files which were unchanged, written, removed and which
+        collided, and the number of bytes written.
+    """
+    return sync_assets(manifest, "get_submodules", [
+        (lesson_info.get('gh-name'), Path(f"submodules/{lesson_info.get('gh-name')}/{directory}"), directory)
+        for lesson_info in website_config['lessons'] for directory in SHARED_DIRECTORIES
+    ])
+
+
+def get_revealjs(cache_dir: Path, revealjs_mode: str, manifest: dict, lock: Optional[dict] = None) -> str:
+    """
+    Check out reveal.js in submodules/, and put it in slides/reveal.js if the
+    decks share one copy.
+
+    This is the "reveal.js" step, which comes before the "slides" step of
+    every lesson.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    revealjs_mode:
+        How reveal.js is put alongside each slide deck, one of REVEALJS_MODES.
+    manifest:
+        The build manifest.
+    lock:
+        The lockfile, for a frozen build, or None to use REVEALJS_COMMIT.
+
+    Returns
+    -------
+    commit:
+        The commit of reveal.js which was checked out.
+    """
+    if lock is not None:
+        commit = locked_repository(lock, REVEALJS_REPO, {"pin": REVEALJS_COMMIT})["commit"]
+    else:
+        commit = REVEALJS_COMMIT
+    commit = fetch_mirror(cache_dir, REVEALJS_ORG, REVEALJS_REPO, commit=commit)
+    rmtree("submodules/reveal.js", ignore_errors=True)
+    checkout_mirror(cache_dir, REVEALJS_ORG, REVEALJS_REPO, Path("submodules/reveal.js"), commit)
+    record_repository(manifest, REVEALJS_REPO, REVEALJS_ORG, None, commit)
+
+    # In shared mode there is one copy of reveal.js for every deck, otherwise
+    # there should not be one left over from a previous build
+    if revealjs_mode == "shared":
+        stage = "get_submodules/reveal.js"
+        inputs = hash_inputs(commit)
+        if not is_up_to_date(manifest, stage, inputs, ["slides/reveal.js"]):
+            install_revealjs("slides/reveal.js", revealjs_mode)
+            record_stage(manifest, stage, inputs, ["slides/reveal.js"])
+    else:
+        rmtree("slides/reveal.js", ignore_errors=True)
+
+    return commit
+
+
+def build_lesson_slides(lesson_name: str, cache_dir: Path, revealjs_mode: str, pandoc_version: Optional[str],
+                        manifest: dict) -> None:
+    """
+    Build the slides of a lesson, if it has any, unless they have not changed
+    since the last build.
+
+    The slides are linked from the lesson store if another build has already
+    built them, and are otherwise built with pandoc and added to the store.
+    This is the "slides" step of a lesson, which comes after its "clone" step
+    and the "reveal.js" step.
+
+    Parameters
+    ----------
+    lesson_name:
+        The name of the lesson, i.e. gh-name.
+    cache_dir:
+        The directory containing the cache, and the lesson store.
+    revealjs_mode:
+        How reveal.js is put alongside the slides, one of REVEALJS_MODES.
+    pandoc_version:
+        The version of pandoc, or None if it is not installed, in which case
+        the slides are copied but not built.
+    manifest:
+        The build manifest, with the commits the lesson and reveal.js were
+        checked out at.
+    """
+    commit = manifest["repositories"][lesson_name]["commit"]
+    command = pandoc_command(revealjs_mode)
+    stage = f"get_submodules/{lesson_name}/slides"
+    inputs = hash_inputs(
+        commit, manifest["repositories"][REVEALJS_REPO]["commit"], command, pandoc_version, revealjs_mode
+    )
+    outputs = [f"slides/{lesson_name}"]
+    # The built slides do not depend on reveal.js, which is put alongside
+    # them in each build, so are shared by every build with the same pandoc.
+    # They are found by the lesson's commit, without copying anything. A
+    # new commit usually leaves the slides alone, so render_lesson_slides
+    # then finds the deck by its index.md, in the "pandoc" entries, and
+    # only the copy is done again. Edits in watch mode have no commit, so
+    # only ever use the "pandoc" entries
+    slides_key = artifact_key(commit, pandoc_version, command)
+    artifact = lookup_artifact(cache_dir, "slides", slides_key) if pandoc_version is not None else None
+    if is_up_to_date(manifest, stage, inputs, outputs):
+        log.info(f"Slides for {lesson_name} have not changed since the last build, not building")
+        return
+    if artifact is not None:
+        link_lesson_slides(lesson_name, artifact, revealjs_mode)
+        log.info(f"Linked the slides for {lesson_name} from the store")
+    elif copy_lesson_slides(lesson_name, revealjs_mode) and pandoc_version is not None:
+        try:
+            _, seconds, cached = render_lesson_slides(lesson_name, cache_dir, pandoc_version, command)
+        except subprocess.CalledProcessError as exc:
+            log.error(f"pandoc failed to build the slides for {lesson_name}, but carrying on anyway: {exc}")
+            return
+        log.info(f"Built slides for {lesson_name} in {seconds:.2f} s{' (cached)' if cached else ''}")
+        add_artifact(
+            cache_dir, "slides", slides_key, partial(link_tree, Path(f"slides/{lesson_name}"), ignore=["reveal.js"])
+        )
+    record_stage(manifest, stage, inputs, outputs)
+
+
+def build_slides_in_worker(lesson_name: str, cache_dir: Path, revealjs_mode: str,
+                           pandoc_version: Optional[str]) -> None:
+    """
+    Run the "slides" step of a lesson in a worker process, with its own copy of
+    the build manifest.
+
+    Parameters
+    ----------
+    lesson_name, cache_dir, revealjs_mode, pandoc_version:
+        Passed on to build_lesson_slides.
+    """
+    manifest = load_manifest()
+    try:
+        build_lesson_slides(lesson_name, cache_dir, revealjs_mode, pandoc_version, manifest)
+        save_manifest(manifest)
+    finally:
+        # A worker process does not save its spans when it exits
+        instrumentation.save_trace()
+
+
+def register_lessons(website_config: WorkshopConfig, cache_dir: Path, cache_size_mb: int, store_size_mb: int,
+                     manifest: dict) -> None:
+    """
+    Register the lessons and reveal.js as submodules, and trim the cache.
+
+    This is the last step, once every lesson has been through its other steps.
+    Lessons which are no longer in _config.yml are removed from submodules/.
+
+    Parameters
+    ----------
+    website_config:
+        The website config.
+    cache_dir:
+        The directory containing the cache.
+    cache_size_mb:
+        The maximum size of the cache of repositories in MB.
+    store_size_mb:
+        The maximum size of the lesson store in MB.
+    manifest:
+        The build manifest, with the commit each lesson was checked out at.
+    """
+    # setup-documents belongs to get_setup.py, which may be fetching it at the
+    # same time
+    for path in Path("submodules").iterdir():
+        if path.name not in website_config.lesson_names + [REVEALJS_REPO, Path(SETUP_DOCS_PATH).name]:
+            rmtree(path, ignore_errors=True)
+
+    # The lessons have already been checked out at the head of their branches,
+    # so this only adds the existing repositories to .gitmodules and the index,
+    # in config order, and there is nothing left to update
+    used_mirrors = []
+    lesson_commits = {}
+    for lesson_name in website_config.lesson_names:
+        repository = manifest["repositories"][lesson_name]
+        org_name, gh_branch = repository["org-name"], repository["branch"]
+        instrumentation.system(
+            f"git submodule add --force -b {gh_branch} https://github.com/{org_name}/{lesson_name}.git submodules/{lesson_name}",
+            name=f"git submodule add {lesson_name}", category="git", lesson=lesson_name
+        )
+        used_mirrors.append(mirror_path(cache_dir, org_name, lesson_name))
+        lesson_commits[lesson_name] = repository["commit"]
+
+    # Now need to do the slides' reveal.js, but have to do it afterwards because
+    # we need a specific version of reveal.js and so we need to avoid the git
+    # submodule update
+    instrumentation.system(
+        "git submodule add --force https://github.com/hakimel/reveal.js.git submodules/reveal.js",
+        name="git submodule add reveal.js", category="git", lesson="reveal.js"
+    )
+    revealjs_commit = manifest["repositories"][REVEALJS_REPO]["commit"]
+    used_mirrors.append(mirror_path(cache_dir, REVEALJS_ORG, REVEALJS_REPO))
+
+    # Later stages depend on the lessons, so record everything which went into
+    # getting them
+    record_stage(manifest, "get_submodules", hash_inputs(website_config['lessons'], lesson_commits, revealjs_commit))
+
+    # setup-documents is used by every build, and may be being checked out by
+    # get_setup.py at the same time, so is never evicted here
+    used_mirrors.append(mirror_path(cache_dir, SETUP_DOCS_ORG, SETUP_DOCS_REPO))
+    evict_mirrors(cache_dir, cache_size_mb * 2**20, keep=used_mirrors)
+    evict_artifacts(cache_dir, store_size_mb * 2**20)
+
+
+@instrumentation.traced("get_submodules")
+def main(jobs: int = DEFAULT_JOBS, cache_dir: Path = DEFAULT_CACHE_DIR,
+         cache_size_mb: int = DEFAULT_CACHE_SIZE_MB, resolver: str = "api", revealjs_mode: str = "hardlink",
+         checkout: str = "full", frozen: bool = False, store_size_mb: int = DEFAULT_STORE_SIZE_MB,
+         website_config: Optional[WorkshopConfig] = None) -> None:
+    """
+    Get each lesson in _config.yml and place its content into the website.
+
+    This runs every step, see STEPS, in this process. bin/build.py --graph
+    instead runs each step as its own task, with --step.
+
+    The lessons are resolved and shallow cloned concurrently using a pool of
+    `jobs` threads, so each lesson is fetched exactly once. Each lesson's
+    content is then copied in the order given in _config.yml, as soon as its
+    clone is available. Lessons share the fig, data and code directories, so
+    they are merged in config order once every lesson is cloned, which keeps
+    the output the same whichever clone finishes first. The slides are built
+    in a pool of processes, and finally the lessons are registered as
+    submodules.
+
+    Copying a lesson's content and building its slides is skipped when the
+    lesson, its commit and the outputs are the same as in the last build, as
+    recorded in the build manifest.
 
-        # slides are built using pandoc in this script -- sometimes we seem to
-        # need to specify revealjs-url
-        pandoc_command = "pandoc -t revealjs -s -o index.html index.md -V theme=black --slide-level=3 "
-        pandoc_command += "revealjs-url='https://cdnjs.cloudflare.com/ajax/libs/reveal.js/3.9.2'"
+    The repositories are kept in a persistent cache between builds, which is
+    trimmed back to cache_size_mb at the end of the build by removing the least
+    recently used repositories. Processed lessons and built slides are kept in
+    the lesson store in the same directory, shared by every workshop built with
+    the cache, and linked into the website from there. The store is trimmed
+    back to store_size_mb in the same way.
 
-        os.system(f"cd slides/{lesson_name} && {pandoc_command}")
+    Parameters
+    ----------
+    jobs:
+        The number of lessons to fetch at the same time.
+    cache_dir:
+        The directory containing the cache of lesson repositories.
+    cache_size_mb:
+        The maximum size of the cache in MB.
+    resolver:
+        How to check each lesson's org and branch, either "api" to use the
+        GitHub API or "ls-remote" to use git.
+    revealjs_mode:
+        How reveal.js is put alongside each slide deck, one of REVEALJS_MODES.
+    checkout:
+        How to check out each lesson, one of CHECKOUT_MODES. reveal.js is
+        always checked out in full, as the whole of it is copied.
+    frozen:
+        Whether to get the commits in the lockfile, without resolving anything
+        or making any GitHub API requests.
+    store_size_mb:
+        The maximum size of the lesson store in MB.
+    website_config:
+        The website config, or None to load _config.yml.
+    """
+    Path("submodules").mkdir(parents=True, exist_ok=True)
+
+    # Open the website config, which contains a list of the lessons we want in the
+    # workshop
+
+    if website_config is None:
+        website_config = load_config()
+
+    log.info(f"Getting submodules specified in {website_config['lessons']}")
+
+    # A frozen build gets the commits in the lockfile, so has nothing to resolve
+    lock = load_lock() if frozen else None
+    locked = locked_lessons(lock, website_config) if frozen else {}
+
+    # All the lessons share one GitHub API client, so they share its connections
+    # and the responses cached from previous builds
+    api = GitHubAPI(Path(cache_dir) / "github-api.json", pool_size=jobs) if resolver == "api" and not frozen else None
+    manifest = load_manifest()
+
+    # Now process each lesson in the list. The clones are started all at once,
+    # but the results are collected in config order
+
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        clones = [
+            pool.submit(
+                clone_lesson, n, lesson_info, cache_dir, api, resolver, checkout, locked.get(lesson_info.get('gh-name'))
+            )
+            for n, lesson_info in enumerate(website_config['lessons'])
+        ]
+
+        for clone, lesson_info in zip(clones, website_config['lessons']):
+            record_repository(manifest, *clone.result())
+            build_lesson_content(lesson_info['gh-name'], lesson_info, cache_dir, manifest)
+
+    if api is not None:
+        api.save()
+
+    sync_lesson_assets(manifest, website_config)
+    get_revealjs(cache_dir, revealjs_mode, manifest, lock)
+
+    pandoc_version = get_pandoc_version()
+    if pandoc_version is None:
+        log.error("Cannot find pandoc, so the slides will not be built")
+
+    # Each deck is built by its own pandoc process, so the decks are built in a
+    # pool of processes, which read what has been done so far from the manifest
+    save_manifest(manifest)
+    with ProcessPoolExecutor(
+        max_workers=max(1, min(jobs, os.cpu_count() or 1)), initializer=instrumentation.configure_logging
+    ) as pool:
+        slides = [
+            pool.submit(build_slides_in_worker, lesson_name, cache_dir, revealjs_mode, pandoc_version)
+            for lesson_name in website_config.lesson_names
+        ]
+        for build in slides:
+            build.result()
+
+    register_lessons(website_config, cache_dir, cache_size_mb, store_size_mb, manifest)
+    save_manifest(manifest)
+
+
+def run_step(step: str, lesson_name: Optional[str], args: argparse.Namespace,
+             website_config: Optional[WorkshopConfig] = None) -> None:
+    """
+    Run one step of getting the lessons, e.g. as a task of bin/build.py.
+
+    Parameters
+    ----------
+    step:
+        The step to run, one of STEPS.
+    lesson_name:
+        The lesson to run it for, which steps in LESSON_STEPS need.
+    args:
+        The options from the command line.
+    website_config:
+        The website config, or None to load _config.yml.
+    """
+    if website_config is None:
+        website_config = load_config()
+
+    lessons = dict(zip(website_config.lesson_names, website_config.lessons))
+    if step in LESSON_STEPS and lesson_name not in lessons:
+        raise ValueError(f"The {step} step needs the name of a lesson in {website_config.path}, not {lesson_name}")
+
+    manifest = load_manifest()
+    with instrumentation.span(f"get_submodules {step}", "stage", lesson=lesson_name):
+        if step == "clone":
+            Path("submodules").mkdir(parents=True, exist_ok=True)
+            locked = locked_lessons(load_lock(), website_config)[lesson_name] if args.frozen else None
+            api = None
+            if args.resolver == "api" and not args.frozen:
+                api = GitHubAPI(Path(args.cache_dir) / "github-api.json", pool_size=1)
+            n = website_config.lesson_names.index(lesson_name)
+            record_repository(
+                manifest, *clone_lesson(n, lessons[lesson_name], args.cache_dir, api, args.resolver, args.checkout,
+                                        locked)
+            )
+            if api is not None:
+                api.save()
+        elif step == "content":
+            build_lesson_content(lesson_name, lessons[lesson_name], args.cache_dir, manifest)
+        elif step == "reveal.js":
+            get_revealjs(args.cache_dir, args.revealjs, manifest, load_lock() if args.frozen else None)
+        elif step == "slides":
+            pandoc_version = get_pandoc_version()
+            if pandoc_version is None:
+                log.error(f"Cannot find pandoc, so the slides for {lesson_name} will not be built")
+            build_lesson_slides(lesson_name, args.cache_dir, args.revealjs, pandoc_version, manifest)
+        elif step == "assets":
+            sync_lesson_assets(manifest, website_config)
+        elif step == "register":
+            register_lessons(website_config, args.cache_dir, args.cache_size, args.store_size, manifest)
+
+    save_manifest(manifest)
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """Make the command line parser, with defaults taken from the environment."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=int(os.environ.get("RSG_BUILD_JOBS", DEFAULT_JOBS)),
+        help=f"number of lessons to fetch concurrently, defaults to $RSG_BUILD_JOBS or {DEFAULT_JOBS}"
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, default=Path(os.environ.get("RSG_CACHE_DIR", DEFAULT_CACHE_DIR)),
+        help=f"directory to cache lesson repositories in, defaults to $RSG_CACHE_DIR or {DEFAULT_CACHE_DIR}"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=int(os.environ.get("RSG_CACHE_SIZE_MB", DEFAULT_CACHE_SIZE_MB)),
+        help=f"maximum size of the cache in MB, defaults to $RSG_CACHE_SIZE_MB or {DEFAULT_CACHE_SIZE_MB}"
+    )
+    parser.add_argument(
+        "--resolver", choices=RESOLVERS, default=os.environ.get("RSG_RESOLVER", "api"),
+        help="how to check each lesson's org and branch: with the GitHub API or git ls-remote, defaults to "
+             "$RSG_RESOLVER or api"
+    )
+    parser.add_argument(
+        "--revealjs", choices=REVEALJS_MODES, default=os.environ.get("RSG_REVEALJS_MODE", "hardlink"),
+        help="how to put reveal.js alongside each slide deck, defaults to $RSG_REVEALJS_MODE or hardlink"
+    )
+    parser.add_argument(
+        "--checkout", choices=CHECKOUT_MODES, default=os.environ.get("RSG_CHECKOUT", "full"),
+        help="check out every file of each lesson, or only the paths the build reads from a partial clone, "
+             "defaults to $RSG_CHECKOUT or full"
+    )
+    parser.add_argument(
+        "--frozen", action="store_true", default=bool(os.environ.get("RSG_FROZEN")),
+        help=f"get the commits pinned in {LOCK_FILE} without resolving anything, defaults to on if $RSG_FROZEN is set"
+    )
+    parser.add_argument(
+        "--store-size", type=int, default=int(os.environ.get("RSG_STORE_SIZE_MB", DEFAULT_STORE_SIZE_MB)),
+        help=f"maximum size of the store of processed lessons in MB, defaults to $RSG_STORE_SIZE_MB or "
+             f"{DEFAULT_STORE_SIZE_MB}"
+    )
+    parser.add_argument(
+        "--step", choices=STEPS, default=None,
+        help="run just one step of getting the lessons, as bin/build.py --graph does, rather than all of them"
+    )
+    parser.add_argument(
+        "--lesson", default=None, metavar="GH_NAME",
+        help=f"the lesson to run the step for, which the {', '.join(LESSON_STEPS)} steps need"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    instrumentation.configure_logging()
+    args = argument_parser().parse_args()
+    if args.step is not None:
+        run_step(args.step, args.lesson, args)
+    else:
+        main(
+            args.jobs, args.cache_dir, args.cache_size, args.resolver, args.revealjs, args.checkout, args.frozen,
+            args.store_size
+        )
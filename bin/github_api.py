@@ -0,0 +1,154 @@
+"""Cached access to the GitHub REST API.
+
+All requests go through one pooled requests.Session, so the connection to
+api.github.com is reused across lessons and threads. Responses are kept in a
+JSON file in the lesson cache directory. Within the time to live a cached
+response is used without making a request, and after that the request is made
+conditional on the cached ETag, which GitHub answers with a 304 that does not
+count towards the rate limit.
+
+The API URL can be changed with $RSG_GITHUB_API_URL, e.g. to point at a local
+stub server.
+
+requests is only imported when a client is made, so importing this module is
+cheap for builds which do not use the API.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+
+import instrumentation
+from build_manifest import file_lock
+
+log = logging.getLogger(__name__)
+
+GITHUB_API_URL = os.environ.get("RSG_GITHUB_API_URL", "https://api.github.com")
+
+# How long, in seconds, a cached response is used without checking it with
+# GitHub
+DEFAULT_TTL = 3600
+
+# Only whether a repository or branch exists is cached, so only these statuses
+# are worth keeping
+CACHED_STATUSES = (200, 404)
+
+
+class GitHubAPI:
+    """
+    A pooled, cached client for the GitHub REST API.
+
+    Parameters
+    ----------
+    cache_file:
+        The JSON file to keep responses in, or None to not cache responses
+        between builds.
+    ttl:
+        How long, in seconds, a cached response is used without a request.
+    pool_size:
+        The number of connections to keep open, which should be at least the
+        number of threads using the client.
+    timeout:
+        The timeout, in seconds, of each request.
+    """
+
+    def __init__(self, cache_file: Optional[Path] = None, ttl: float = DEFAULT_TTL, pool_size: int = 8,
+                 timeout: float = 7):
+        self.api_url = GITHUB_API_URL.rstrip("/")
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.ttl = ttl
+        self.timeout = timeout
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept"] = "application/vnd.github+json"
+        if os.environ.get("GITHUB_TOKEN"):
+            self.session.headers["Authorization"] = f"Bearer {os.environ['GITHUB_TOKEN']}"
+
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._changed = set()
+        if self.cache_file and self.cache_file.is_file():
+            try:
+                with open(self.cache_file, "r") as fp:
+                    self._cache = json.load(fp)
+            except (OSError, ValueError):
+                log.warning(f"Unable to read GitHub API cache {self.cache_file}, starting with an empty cache")
+
+    def status(self, path: str) -> int:
+        """
+        Get the HTTP status code of a GET request to the API.
+
+        Raises requests.exceptions.ConnectTimeout if GitHub cannot be reached.
+
+        Parameters
+        ----------
+        path:
+            The path of the API endpoint, e.g. repos/{org}/{repo}.
+        """
+        with self._lock:
+            cached = self._cache.get(path)
+
+        if cached and time.time() - cached["time"] < self.ttl:
+            log.debug(f"Using cached response for {path}")
+            return cached["status"]
+
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+
+        with instrumentation.span(f"GET {path}", "github") as span_args:
+            r = self.session.get(f"{self.api_url}/{path}", headers=headers, timeout=self.timeout)
+            span_args["status"] = r.status_code
+            span_args["bytes"] = len(r.content)
+
+        if r.status_code == 304:
+            log.debug(f"Cached response for {path} is still valid")
+            status = cached["status"]
+            etag = cached.get("etag")
+        else:
+            status = r.status_code
+            etag = r.headers.get("ETag")
+
+        if status in CACHED_STATUSES:
+            with self._lock:
+                self._cache[path] = {"status": status, "etag": etag, "time": time.time()}
+                self._changed.add(path)
+
+        return status
+
+    def save(self) -> None:
+        """
+        Write the responses this client has cached to the cache file.
+
+        Clients in other processes, e.g. one for each lesson, may be saving
+        at the same time, so only this client's responses are merged into the
+        file, while holding a lock.
+        """
+        if not self.cache_file:
+            return
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with file_lock(f"{self.cache_file}.lock"):
+            try:
+                with open(self.cache_file, "r") as fp:
+                    on_disk = json.load(fp)
+            except (OSError, ValueError):
+                on_disk = {}
+
+            with self._lock:
+                on_disk.update({path: self._cache[path] for path in self._changed})
+                self._changed.clear()
+
+            tmp_file = self.cache_file.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_file, "w") as fp:
+                json.dump(on_disk, fp)
+            os.replace(tmp_file, self.cache_file)
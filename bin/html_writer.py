@@ -0,0 +1,226 @@
+"""Write indented HTML straight to a file.
+
+The schedules used to be built as one string of HTML, which was then parsed
+and written out again with BeautifulSoup's prettify() just to indent it.
+HTMLWriter writes the same layout as it goes: one tag or piece of text per
+line, indented by one space for each element it is inside. HTML from
+elsewhere, such as a lesson's blurb, is run through the standard library's
+HTML parser into the writer, so it is laid out the same way.
+"""
+
+from contextlib import contextmanager
+from html import escape
+from html.parser import HTMLParser
+from typing import Dict, Iterator, List, Optional, TextIO
+
+# Elements which have no end tag
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr",
+}
+
+# Elements whose contents are written as they are, without indenting
+PRESERVE_WHITESPACE = {"pre", "textarea"}
+
+
+def escape_text(text: str) -> str:
+    """Escape &, < and > in text."""
+    return escape(text, quote=False)
+
+
+def format_attributes(attrs: Optional[Dict[str, Optional[str]]]) -> str:
+    """
+    Format the attributes of a tag.
+
+    As with BeautifulSoup, &, <, > and " are escaped in the values, but not '.
+
+    Parameters
+    ----------
+    attrs:
+        The attributes, in the order to write them. An attribute with no value
+        is written with an empty one.
+    """
+    if not attrs:
+        return ""
+
+    formatted = []
+    for name, value in attrs.items():
+        value = "" if value is None else str(value)
+        if name == "class":
+            value = " ".join(value.split())
+        value = escape_text(value).replace('"', "&quot;")
+        formatted.append(f' {name}="{value}"')
+
+    return "".join(formatted)
+
+
+class HTMLWriter:
+    """
+    Write HTML to a file, laid out as by BeautifulSoup's prettify().
+
+    Elements left open are closed by an end tag for an element outside them,
+    or by close().
+
+    Parameters
+    ----------
+    fp:
+        The file to write to.
+    """
+
+    def __init__(self, fp: TextIO):
+        self.fp = fp
+        self.open: List[str] = []
+        self.preserving = 0
+
+    def _line(self, html: str) -> None:
+        if self.preserving:
+            self.fp.write(html)
+        else:
+            self.fp.write(" " * len(self.open) + html + "\n")
+
+    def start(self, tag: str, attrs: Optional[Dict[str, Optional[str]]] = None) -> None:
+        """
+        Write a start tag.
+
+        Parameters
+        ----------
+        tag:
+            The name of the element.
+        attrs:
+            The attributes of the element.
+        """
+        if tag in VOID_ELEMENTS:
+            self._line(f"<{tag}{format_attributes(attrs)}/>")
+            return
+
+        if tag in PRESERVE_WHITESPACE and not self.preserving:
+            self.fp.write(" " * len(self.open))
+        if tag in PRESERVE_WHITESPACE or self.preserving:
+            self.preserving += 1
+            self.fp.write(f"<{tag}{format_attributes(attrs)}>")
+        else:
+            self._line(f"<{tag}{format_attributes(attrs)}>")
+        self.open.append(tag)
+
+    def end(self, tag: str) -> None:
+        """
+        Write the end tag of an open element, and of any elements still open
+        inside it.
+
+        An end tag for an element which is not open is ignored.
+
+        Parameters
+        ----------
+        tag:
+            The name of the element.
+        """
+        if tag not in self.open:
+            return
+
+        while self.open:
+            name = self.open.pop()
+            if self.preserving:
+                self.preserving -= 1
+                self.fp.write(f"</{name}>")
+                if not self.preserving:
+                    self.fp.write("\n")
+            else:
+                self._line(f"</{name}>")
+            if name == tag:
+                break
+
+    def text(self, text: str) -> None:
+        """
+        Write text, without the whitespace around it.
+
+        Text which is only whitespace is not written.
+
+        Parameters
+        ----------
+        text:
+            The text, which is escaped.
+        """
+        if self.preserving:
+            self.fp.write(escape_text(text))
+        elif text.strip():
+            self._line(escape_text(text.strip()))
+
+    def comment(self, comment: str) -> None:
+        """Write a comment."""
+        self._line(f"<!--{comment}-->")
+
+    @contextmanager
+    def tag(self, tag: str, attrs: Optional[Dict[str, Optional[str]]] = None) -> Iterator["HTMLWriter"]:
+        """
+        Write an element, with what is written inside the with block as its
+        contents.
+
+        Parameters
+        ----------
+        tag:
+            The name of the element.
+        attrs:
+            The attributes of the element.
+        """
+        self.start(tag, attrs)
+        yield self
+        self.end(tag)
+
+    def element(self, tag: str, text: str, attrs: Optional[Dict[str, Optional[str]]] = None) -> None:
+        """
+        Write an element containing only text.
+
+        Parameters
+        ----------
+        tag:
+            The name of the element.
+        text:
+            The text inside the element.
+        attrs:
+            The attributes of the element.
+        """
+        self.start(tag, attrs)
+        self.text(text)
+        self.end(tag)
+
+    def html(self, html: str) -> None:
+        """
+        Write HTML from elsewhere, laid out like the rest of the file.
+
+        Parameters
+        ----------
+        html:
+            The HTML.
+        """
+        parser = _HTMLCopier(self)
+        parser.feed(html)
+        parser.close()
+
+    def close(self) -> None:
+        """Write the end tags of any elements which are still open."""
+        if self.open:
+            self.end(self.open[0])
+
+
+class _HTMLCopier(HTMLParser):
+    """Pass parsed HTML on to an HTMLWriter."""
+
+    def __init__(self, writer: HTMLWriter):
+        super().__init__(convert_charrefs=True)
+        self.writer = writer
+
+    def handle_starttag(self, tag, attrs):
+        self.writer.start(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.writer.start(tag, dict(attrs))
+        if tag not in VOID_ELEMENTS:
+            self.writer.end(tag)
+
+    def handle_endtag(self, tag):
+        self.writer.end(tag)
+
+    def handle_data(self, data):
+        self.writer.text(data)
+
+    def handle_comment(self, data):
+        self.writer.comment(data)
@@ -0,0 +1,255 @@
+"""Record where the build spends its time.
+
+Set $RSG_TRACE to the path of a JSON file, or use `bin/build.py --trace`, to
+record a span for each stage, each lesson and each step within them: GitHub
+API requests, git commands, copying files, rewriting episodes, pandoc, the
+schedules and setup.md. Each span has its wall time and, where it applies,
+the number of files and bytes written or transferred.
+
+The file is in the Chrome trace event format, so it can be opened in
+chrome://tracing or https://ui.perfetto.dev, with a "summary" of the totals
+for each category of span and each lesson alongside the events. Every process
+adds its events to the file when it exits, so the stages of a build, which
+may run in separate processes, end up in the same trace. The file is not
+cleared between runs of the scripts, but bin/build.py starts a new trace for
+each build.
+
+When $RSG_TRACE is not set nothing is recorded, and the spans cost next to
+nothing.
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+from build_manifest import file_lock
+
+log = logging.getLogger(__name__)
+
+TRACE_ENV = "RSG_TRACE"
+
+# The arguments of a span which are added up in the summary
+SUMMED_ARGS = ["files", "bytes"]
+
+_events: List[dict] = []
+_lock = threading.Lock()
+_registered = False
+
+
+def configure_logging() -> None:
+    """
+    Show log messages from the build scripts.
+
+    The level is taken from $RSG_LOG_LEVEL, which defaults to INFO.
+    """
+    logging.basicConfig(level=os.environ.get("RSG_LOG_LEVEL", "INFO").upper(), format="[%(module)s] %(message)s")
+
+
+def trace_file() -> Optional[Path]:
+    """Get the file to write the trace to, or None if tracing is off."""
+    path = os.environ.get(TRACE_ENV)
+    return Path(path) if path else None
+
+
+def enabled() -> bool:
+    """Check if spans are being recorded."""
+    return bool(os.environ.get(TRACE_ENV))
+
+
+def record(name: str, category: str, start: float, seconds: float, **args) -> None:
+    """
+    Record a span which has already finished.
+
+    Parameters
+    ----------
+    name:
+        The name of the span, e.g. "fetch shell-novice".
+    category:
+        The kind of span, e.g. "git" or "pandoc".
+    start:
+        When the span started, as from time.time().
+    seconds:
+        How long the span took.
+    args:
+        Anything else to record with the span, e.g. lesson, files or bytes.
+    """
+    global _registered
+    if not enabled():
+        return
+
+    event = {
+        "name": name, "cat": category, "ph": "X", "ts": round(start * 1e6), "dur": round(seconds * 1e6),
+        "pid": os.getpid(), "tid": threading.get_native_id(), "args": args,
+    }
+    with _lock:
+        _events.append(event)
+        if not _registered:
+            atexit.register(save_trace)
+            _registered = True
+
+
+@contextmanager
+def span(name: str, category: str = "stage", **args) -> Iterator[dict]:
+    """
+    Record how long a block of code takes.
+
+    The arguments of the span are yielded, so the block can add to them, e.g.
+    the number of files it wrote.
+
+    Parameters
+    ----------
+    name:
+        The name of the span.
+    category:
+        The kind of span.
+    args:
+        Anything else to record with the span.
+    """
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield args
+    finally:
+        record(name, category, start, time.perf_counter() - start_counter, **args)
+
+
+def traced(name: str, category: str = "stage") -> Callable:
+    """
+    Make a function record a span each time it is called.
+
+    Parameters
+    ----------
+    name:
+        The name of the span.
+    category:
+        The kind of span.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run(command, name: Optional[str] = None, category: str = "subprocess", lesson: Optional[str] = None,
+        **kwargs) -> subprocess.CompletedProcess:
+    """
+    Run a command with subprocess.run, recording how long it takes.
+
+    Parameters
+    ----------
+    command:
+        The command, as for subprocess.run.
+    name:
+        The name of the span, which defaults to the command.
+    category:
+        The kind of span.
+    lesson:
+        The lesson the command is for, if any.
+    kwargs:
+        Passed on to subprocess.run.
+    """
+    if name is None:
+        name = command if isinstance(command, str) else " ".join(str(arg) for arg in command)
+    with span(name, category, **({"lesson": lesson} if lesson else {})) as args:
+        result = subprocess.run(command, **kwargs)
+        args["returncode"] = result.returncode
+
+    return result
+
+
+def system(command: str, name: Optional[str] = None, category: str = "subprocess",
+           lesson: Optional[str] = None) -> int:
+    """
+    Run a shell command with os.system, recording how long it takes.
+
+    Parameters
+    ----------
+    command:
+        The shell command.
+    name:
+        The name of the span, which defaults to the command.
+    category:
+        The kind of span.
+    lesson:
+        The lesson the command is for, if any.
+    """
+    with span(name or command, category, **({"lesson": lesson} if lesson else {})) as args:
+        status = os.system(command)
+        args["returncode"] = status
+
+    return status
+
+
+def summarise(events: List[dict]) -> Dict[str, Dict[str, dict]]:
+    """
+    Add up the time, files and bytes of the spans in a trace.
+
+    Parameters
+    ----------
+    events:
+        The events in the trace.
+
+    Returns
+    -------
+    summary:
+        The count, seconds, files and bytes of the spans in each category and
+        for each lesson.
+    """
+    summary = {"categories": {}, "lessons": {}}
+    for event in events:
+        groups = [("categories", event["cat"])]
+        if "lesson" in event["args"]:
+            groups.append(("lessons", event["args"]["lesson"]))
+        for section, key in groups:
+            totals = summary[section].setdefault(key, {"count": 0, "seconds": 0.0, "files": 0, "bytes": 0})
+            totals["count"] += 1
+            totals["seconds"] = round(totals["seconds"] + event["dur"] / 1e6, 6)
+            for arg in SUMMED_ARGS:
+                if isinstance(event["args"].get(arg), int):
+                    totals[arg] += event["args"][arg]
+
+    return summary
+
+
+def save_trace() -> None:
+    """
+    Add the spans recorded by this process to the trace file.
+
+    Only the spans recorded by this process are written, so a forked worker
+    does not write its parent's spans too.
+    """
+    path = trace_file()
+    with _lock:
+        events = [event for event in _events if event["pid"] == os.getpid()]
+        _events.clear()
+    if path is None or not events:
+        return
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(f"{path}.lock"):
+        try:
+            with open(path, "r") as fp:
+                trace = json.load(fp)
+        except (OSError, ValueError):
+            trace = {"traceEvents": [], "displayTimeUnit": "ms"}
+
+        trace["traceEvents"] += events
+        trace["summary"] = summarise(trace["traceEvents"])
+
+        tmp_file = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp_file, "w") as fp:
+            json.dump(trace, fp)
+        os.replace(tmp_file, path)
+
+    log.debug(f"Wrote {len(events)} spans to {path}")
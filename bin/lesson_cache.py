@@ -0,0 +1,373 @@
+"""Persistent cache of the git repositories used to build the website.
+
+Each repository is kept as a bare mirror in {cache_dir}/{org}/{name}.git,
+which survives between builds. A build asks the remote for the commit at the
+head of the branch it wants and only fetches when the mirror does not already
+have that commit, so rebuilding an unchanged workshop transfers no objects.
+The checkouts in submodules/ are git worktrees of the mirrors, so share the
+mirror's objects rather than copying them.
+
+A build which only reads some of the paths in a repository can check out just
+those paths. The mirror is then a partial clone, which fetches the commits
+and trees but leaves out the contents of files, and a sparse checkout of the
+paths fetches only the files under them. Large files which the build never
+reads, such as datasets and notebooks, are never transferred or stored.
+
+The cache is bounded in size by evicting the least recently used mirrors.
+"""
+
+import os
+import time
+import logging
+import subprocess
+from pathlib import Path
+from shutil import rmtree
+from typing import Iterable, List, Optional
+
+import instrumentation
+
+log = logging.getLogger(__name__)
+
+GITHUB_URL = "https://github.com"
+
+DEFAULT_CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "rsg-workshop-template"
+DEFAULT_CACHE_SIZE_MB = 2048
+
+# Touched every time a mirror is used, so the mirrors can be evicted in least
+# recently used order
+LAST_USED_FILE = "rsg-last-used"
+
+# How a repository is checked out: "full" checks out every file, "sparse" only
+# the paths the build reads, from a partial clone
+CHECKOUT_MODES = ["full", "sparse"]
+
+
+def _git(*args: str, cwd: Optional[Path] = None) -> str:
+    """
+    Run a git command and return its output, raising if it fails.
+
+    Parameters
+    ----------
+    args:
+        The arguments to pass to git.
+    cwd:
+        The directory to run the command in.
+    """
+    result = instrumentation.run(
+        ["git", *args], name=f"git {args[0]}", category="git", cwd=cwd, check=True, capture_output=True, text=True
+    )
+    return result.stdout.strip()
+
+
+def repository_url(org_name: str, repo_name: str) -> str:
+    """
+    Get the URL of a repository on GitHub.
+
+    Parameters
+    ----------
+    org_name:
+        The GitHub org, or user, which owns the repository.
+    repo_name:
+        The name of the repository.
+    """
+    return f"{GITHUB_URL}/{org_name}/{repo_name}.git"
+
+
+def mirror_path(cache_dir: Path, org_name: str, repo_name: str) -> Path:
+    """
+    Get the path to the mirror of a repository in the cache.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    org_name:
+        The GitHub org, or user, which owns the repository.
+    repo_name:
+        The name of the repository.
+    """
+    return Path(cache_dir) / org_name / f"{repo_name}.git"
+
+
+def has_commit(mirror: Path, commit: str) -> bool:
+    """
+    Check if a mirror contains a commit.
+
+    Parameters
+    ----------
+    mirror:
+        The path to the mirror.
+    commit:
+        The commit SHA, which may be abbreviated.
+    """
+    # --missing stops a partial clone fetching the commit from origin to
+    # answer the question, which would fetch the whole history behind it
+    result = subprocess.run(
+        ["git", "rev-list", "--no-walk", "--missing=allow-any", f"{commit}^{{commit}}"], cwd=mirror,
+        capture_output=True
+    )
+    return result.returncode == 0
+
+
+def is_partial(mirror: Path) -> bool:
+    """
+    Check if a mirror is a partial clone, so can fetch only some files.
+
+    Parameters
+    ----------
+    mirror:
+        The path to the mirror.
+    """
+    result = subprocess.run(
+        ["git", "config", "--get", "extensions.partialClone"], cwd=mirror, capture_output=True
+    )
+    return result.returncode == 0
+
+
+def make_partial(mirror: Path) -> None:
+    """
+    Make a mirror a partial clone, which leaves out the contents of files until
+    they are checked out.
+
+    Files already in the mirror are kept, and files missing from it are fetched
+    from origin when a checkout needs them.
+
+    Parameters
+    ----------
+    mirror:
+        The path to the mirror.
+    """
+    _git("config", "core.repositoryformatversion", "1", cwd=mirror)
+    _git("config", "remote.origin.promisor", "true", cwd=mirror)
+    _git("config", "remote.origin.partialclonefilter", "blob:none", cwd=mirror)
+    _git("config", "extensions.partialClone", "origin", cwd=mirror)
+
+
+def fetch_mirror(
+    cache_dir: Path, org_name: str, repo_name: str, branch: Optional[str] = None, commit: Optional[str] = None,
+    partial: bool = False, pinned: bool = False
+) -> str:
+    """
+    Bring the mirror of a repository up to date with a branch or commit.
+
+    When a branch is given, the mirror is updated to the head of that branch
+    with a shallow fetch. If the commit at the head of the branch is already
+    known, e.g. from git ls-remote, it can be given as well to save asking the
+    remote for it again. When only a commit is given, e.g. for a pinned
+    version, every branch is fetched with full history as a commit can only be
+    fetched by its full SHA. In all cases nothing is fetched if the mirror
+    already has the commit.
+
+    A commit pinned to a branch, e.g. by the lockfile, is fetched by its full
+    SHA on its own, even if the branch has since moved on.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    org_name:
+        The GitHub org, or user, which owns the repository.
+    repo_name:
+        The name of the repository.
+    branch:
+        The branch to bring the mirror up to date with.
+    commit:
+        The commit to make sure is in the mirror, or the head of branch.
+    partial:
+        Whether to fetch without the contents of files, for a sparse checkout.
+        The mirror is made a partial clone, if it is not one already.
+    pinned:
+        Whether commit is the full SHA of a commit on branch which must be
+        fetched, rather than the head of branch when it was looked up.
+
+    Returns
+    -------
+    commit:
+        The full SHA of the commit which was asked for, or the head of branch.
+    """
+    if branch is None and commit is None:
+        raise ValueError("A branch or commit must be given to fetch a mirror")
+
+    with instrumentation.span(f"fetch {org_name}/{repo_name}", "fetch", lesson=repo_name) as span_args:
+        url = repository_url(org_name, repo_name)
+        mirror = mirror_path(cache_dir, org_name, repo_name)
+        if not mirror.is_dir():
+            mirror.mkdir(parents=True)
+            _git("init", "--quiet", "--bare", cwd=mirror)
+            _git("remote", "add", "origin", url, cwd=mirror)
+        if partial and not is_partial(mirror):
+            make_partial(mirror)
+        (mirror / LAST_USED_FILE).touch()
+        filters = ["--filter=blob:none"] if partial else []
+        # What was transferred is measured by how much the mirror grows, which
+        # is only worth working out when it is being recorded
+        size_before = directory_size(mirror) if instrumentation.enabled() else 0
+
+        if branch is not None:
+            if commit is None:
+                remote_head = _git("ls-remote", url, f"refs/heads/{branch}").split()
+                if not remote_head:
+                    raise ValueError(f"Branch {branch} does not exist in {org_name}/{repo_name}")
+                commit = remote_head[0]
+            if has_commit(mirror, commit):
+                log.info(f"Using cached {org_name}/{repo_name}@{branch} ({commit[:10]})")
+            else:
+                log.info(f"Fetching {org_name}/{repo_name}@{branch} into {mirror}")
+                source = commit if pinned else f"refs/heads/{branch}"
+                _git(
+                    "fetch", "--quiet", *filters, "--depth", "1", "origin", f"+{source}:refs/heads/{branch}",
+                    cwd=mirror
+                )
+                # The branch may have moved on since its head was looked up
+                if not has_commit(mirror, commit):
+                    if pinned:
+                        raise ValueError(f"Commit {commit} does not exist in {org_name}/{repo_name}")
+                    commit = f"refs/heads/{branch}"
+        else:
+            if has_commit(mirror, commit):
+                log.info(f"Using cached {org_name}/{repo_name} at {commit}")
+            else:
+                log.info(f"Fetching {org_name}/{repo_name} into {mirror} to find {commit}")
+                _git("fetch", "--quiet", *filters, "origin", "+refs/heads/*:refs/heads/*", cwd=mirror)
+                if not has_commit(mirror, commit):
+                    raise ValueError(f"Commit {commit} does not exist in {org_name}/{repo_name}")
+
+        if instrumentation.enabled():
+            span_args["bytes"] = max(0, directory_size(mirror) - size_before)
+
+    return _git("rev-parse", f"{commit}^{{commit}}", cwd=mirror)
+
+
+def commit_tree(cache_dir: Path, org_name: str, repo_name: str, commit: str) -> str:
+    """
+    Get the tree of a commit in a mirror, which is a hash of its contents.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    org_name:
+        The GitHub org, or user, which owns the repository.
+    repo_name:
+        The name of the repository.
+    commit:
+        The commit, as returned by fetch_mirror.
+    """
+    return _git("rev-parse", f"{commit}^{{tree}}", cwd=mirror_path(cache_dir, org_name, repo_name))
+
+
+def checkout_mirror(cache_dir: Path, org_name: str, repo_name: str, dest: Path, commit: str,
+                    sparse_paths: Optional[List[str]] = None) -> None:
+    """
+    Check out a commit from a mirror into a new worktree.
+
+    No network access is needed. The HEAD of the worktree is detached, as a
+    branch can only be checked out in one worktree of a mirror at a time and
+    the same mirror may be shared by several workshops.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    org_name:
+        The GitHub org, or user, which owns the repository.
+    repo_name:
+        The name of the repository.
+    dest:
+        The directory to check the repository out into, which must not exist.
+    commit:
+        The commit to check out, as returned by fetch_mirror.
+    sparse_paths:
+        The files and directories to check out, relative to the top of the
+        repository, or None to check out everything. Files from a partial
+        clone which are not in the mirror are fetched as they are checked out.
+    """
+    mirror = mirror_path(cache_dir, org_name, repo_name)
+    dest = str(Path(dest).resolve())
+    with instrumentation.span(f"checkout {org_name}/{repo_name}", "checkout", lesson=repo_name):
+        # Forget any worktrees which have since been deleted, e.g. by a previous
+        # build removing submodules/, otherwise git refuses to reuse their path
+        _git("worktree", "prune", cwd=mirror)
+        if sparse_paths is None:
+            _git("worktree", "add", "--quiet", "--force", "--detach", dest, commit, cwd=mirror)
+            return
+
+        # The paths are anchored to the top of the repository, so e.g. fig/
+        # does not also match _episodes/fig/
+        _git("worktree", "add", "--quiet", "--force", "--no-checkout", "--detach", dest, commit, cwd=mirror)
+        _git("sparse-checkout", "set", "--no-cone", *(f"/{path}" for path in sparse_paths), cwd=Path(dest))
+        _git("checkout", "--quiet", cwd=Path(dest))
+
+
+def directory_size(path: Path) -> int:
+    """
+    Get the total size, in bytes, of the files in a directory.
+
+    Parameters
+    ----------
+    path:
+        The directory to get the size of.
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except FileNotFoundError:
+                pass
+    return size
+
+
+def has_worktrees(mirror: Path) -> bool:
+    """
+    Check if a mirror still has worktrees checked out from it, e.g. in the
+    submodules/ of another workshop.
+
+    Worktrees which have since been deleted are forgotten first.
+
+    Parameters
+    ----------
+    mirror:
+        The path to the mirror.
+    """
+    subprocess.run(["git", "worktree", "prune"], cwd=mirror, capture_output=True)
+    worktrees = mirror / "worktrees"
+    return worktrees.is_dir() and any(worktrees.iterdir())
+
+
+def evict_mirrors(cache_dir: Path, max_bytes: int, keep: Iterable[Path] = ()) -> None:
+    """
+    Remove the least recently used mirrors until the cache fits in max_bytes.
+
+    A mirror which still has worktrees is never evicted, as removing it would
+    break the checkouts, so the cache can stay larger than max_bytes until
+    they are deleted.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    max_bytes:
+        The maximum size of the cache.
+    keep:
+        Mirrors which must not be evicted, e.g. the ones used in this build.
+    """
+    keep = {Path(path).resolve() for path in keep}
+    mirrors = []
+    for mirror in Path(cache_dir).glob("*/*.git"):
+        last_used = mirror / LAST_USED_FILE
+        last_used = last_used.stat().st_mtime if last_used.exists() else 0
+        mirrors.append((last_used, directory_size(mirror), mirror))
+
+    total = sum(size for _, size, _ in mirrors)
+    for last_used, size, mirror in sorted(mirrors):
+        if total <= max_bytes:
+            break
+        if mirror.resolve() in keep or has_worktrees(mirror):
+            continue
+        log.info(f"Evicting {mirror} from the cache, last used {time.ctime(last_used)}")
+        rmtree(mirror, ignore_errors=True)
+        total -= size
+
+    if total > max_bytes:
+        log.warning(f"Cache {cache_dir} is {total / 2**20:.0f} MB, larger than the {max_bytes / 2**20:.0f} MB limit")
@@ -0,0 +1,340 @@
+"""Pin the lessons, reveal.js and setup-documents to the commits a build uses.
+
+`bin/lesson_lock.py update` resolves the org and branch of every lesson in
+_config.yml, fetches the head of each branch and records the org, branch,
+commit and tree (a hash of the contents) of each lesson, reveal.js and
+setup-documents in _config.lock.yml, next to _config.yml. The repositories
+are resolved and fetched concurrently.
+
+A build with --frozen then fetches exactly the commits in the lockfile, with
+no GitHub API requests and no branch resolution, so it only changes when the
+lockfile does. A frozen build stops with an error if the lockfile does not
+match _config.yml, e.g. when a lesson has been added; `bin/lesson_lock.py
+check` reports the same problems without building anything.
+"""
+
+import os
+import sys
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from yaml import dump, load
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+import instrumentation
+from lesson_cache import CHECKOUT_MODES, DEFAULT_CACHE_DIR, commit_tree, fetch_mirror
+from workshop_config import ConfigError, WorkshopConfig, load_config
+
+log = logging.getLogger(__name__)
+
+LOCK_FILE = "_config.lock.yml"
+
+# Written at the top of the lockfile
+LOCK_HEADER = "# Generated by bin/lesson_lock.py update, do not edit by hand\n"
+
+
+class LockError(ValueError):
+    """Raised when the lockfile is missing or does not match _config.yml."""
+
+
+def lesson_request(lesson_info: Dict[str, Any]) -> Dict[str, Optional[str]]:
+    """
+    Get what a lesson entry in _config.yml asks for, which the lockfile is
+    resolved from.
+
+    Parameters
+    ----------
+    lesson_info:
+        The lesson entry from the lessons list in _config.yml.
+    """
+    return {"org-name": lesson_info.get("org-name"), "branch": lesson_info.get("branch")}
+
+
+def load_lock(path: Path = LOCK_FILE) -> Dict[str, Any]:
+    """
+    Load the lockfile.
+
+    Parameters
+    ----------
+    path:
+        The lockfile to load.
+    """
+    try:
+        with open(path, "r") as fp:
+            lock = load(fp, Loader=Loader)
+    except FileNotFoundError:
+        raise LockError(f"There is no {path}, run bin/lesson_lock.py update to make it") from None
+
+    if not isinstance(lock, dict):
+        raise LockError(f"{path} should contain a mapping of keys to values")
+
+    return lock
+
+
+def save_lock(lock: Dict[str, Any], path: Path = LOCK_FILE) -> None:
+    """
+    Write the lockfile, replacing it in one go.
+
+    Parameters
+    ----------
+    lock:
+        The lessons, reveal.js and setup-documents to pin.
+    path:
+        The lockfile to write.
+    """
+    path = Path(path)
+    tmp_file = path.with_name(f".{path.name}.tmp")
+    with open(tmp_file, "w") as fp:
+        fp.write(LOCK_HEADER)
+        dump(lock, fp, sort_keys=False, default_flow_style=False)
+    os.replace(tmp_file, path)
+
+
+def locked_lessons(lock: Dict[str, Any], website_config: WorkshopConfig) -> Dict[str, Dict[str, str]]:
+    """
+    Get the pinned commit of each lesson in _config.yml.
+
+    Every problem is reported at once. Raises LockError if a lesson is not in
+    the lockfile, or its org or branch in _config.yml has changed since the
+    lockfile was updated.
+
+    Parameters
+    ----------
+    lock:
+        The lockfile.
+    website_config:
+        The website config.
+
+    Returns
+    -------
+    lessons:
+        The org-name, branch, commit and tree of each lesson, keyed by
+        gh-name.
+    """
+    lessons = lock.get("lessons") or {}
+    problems = []
+    for lesson_info in website_config.lessons:
+        lesson_name = lesson_info["gh-name"]
+        if lesson_name not in lessons:
+            problems.append(f"{lesson_name} is not in {LOCK_FILE}")
+        elif lessons[lesson_name].get("request") != lesson_request(lesson_info):
+            problems.append(f"the org-name or branch of {lesson_name} has changed since {LOCK_FILE} was updated")
+
+    if problems:
+        raise LockError(
+            f"{LOCK_FILE} does not match {website_config.path}, run bin/lesson_lock.py update:\n - "
+            + "\n - ".join(problems)
+        )
+
+    return {lesson_name: lessons[lesson_name] for lesson_name in website_config.lesson_names}
+
+
+def locked_repository(lock: Dict[str, Any], name: str, expected: Dict[str, str]) -> Dict[str, str]:
+    """
+    Get the pinned commit of reveal.js or setup-documents.
+
+    Raises LockError if it is not in the lockfile, or was locked with
+    different settings.
+
+    Parameters
+    ----------
+    lock:
+        The lockfile.
+    name:
+        The name of the repository in the lockfile.
+    expected:
+        What the lockfile should have recorded for the repository, e.g. the
+        branch.
+    """
+    entry = lock.get(name)
+    if not isinstance(entry, dict) or any(entry.get(key) != value for key, value in expected.items()):
+        raise LockError(f"{name} in {LOCK_FILE} is missing or out of date, run bin/lesson_lock.py update")
+
+    return entry
+
+
+def locked_commits(lock: Dict[str, Any]) -> Dict[str, str]:
+    """
+    Get the commit of everything in the lockfile, keyed by repository name.
+
+    Parameters
+    ----------
+    lock:
+        The lockfile.
+    """
+    entries = {**(lock.get("lessons") or {}), **{name: entry for name, entry in lock.items() if name != "lessons"}}
+    return {
+        name: entry["commit"] for name, entry in entries.items() if isinstance(entry, dict) and entry.get("commit")
+    }
+
+
+def update_lock(website_config: Optional[WorkshopConfig] = None, jobs: int = 8, cache_dir: Path = DEFAULT_CACHE_DIR,
+                resolver: str = "api", checkout: str = "full", path: Path = LOCK_FILE) -> Dict[str, Any]:
+    """
+    Pin every lesson, reveal.js and setup-documents at the head of its branch.
+
+    The repositories are resolved and fetched into the cache concurrently,
+    using a pool of `jobs` threads, so a build from the lockfile afterwards
+    has nothing left to fetch.
+
+    Parameters
+    ----------
+    website_config:
+        The website config, or None to load _config.yml.
+    jobs:
+        The number of repositories to resolve and fetch at the same time.
+    cache_dir:
+        The directory containing the cache of repositories.
+    resolver:
+        How to check each lesson's org and branch, one of RESOLVERS in
+        get_submodules.py.
+    checkout:
+        How the repositories will be checked out, one of CHECKOUT_MODES, which
+        decides whether the contents of files are fetched.
+    path:
+        The lockfile to write.
+
+    Returns
+    -------
+    lock:
+        The new contents of the lockfile.
+    """
+    # Both scripts import this module, so are only imported here
+    import get_submodules
+    from get_setup import SETUP_DOCS_BRANCH, SETUP_DOCS_ORG, SETUP_DOCS_REPO
+    from github_api import GitHubAPI
+
+    if website_config is None:
+        website_config = load_config()
+
+    api = GitHubAPI(Path(cache_dir) / "github-api.json", pool_size=jobs) if resolver == "api" else None
+    partial = checkout == "sparse"
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        lessons = [
+            pool.submit(get_submodules.resolve_lesson, n, lesson_info, cache_dir, api, resolver, checkout)
+            for n, lesson_info in enumerate(website_config.lessons)
+        ]
+        revealjs = pool.submit(
+            fetch_mirror, cache_dir, get_submodules.REVEALJS_ORG, get_submodules.REVEALJS_REPO,
+            commit=get_submodules.REVEALJS_COMMIT
+        )
+        setup_docs = pool.submit(
+            fetch_mirror, cache_dir, SETUP_DOCS_ORG, SETUP_DOCS_REPO, branch=SETUP_DOCS_BRANCH, partial=partial
+        )
+
+        lock = {"lessons": {}}
+        for lesson_info, resolved in zip(website_config.lessons, lessons):
+            lesson_name, org_name, gh_branch, commit = resolved.result()
+            lock["lessons"][lesson_name] = {
+                "request": lesson_request(lesson_info),
+                "org-name": org_name,
+                "branch": gh_branch,
+                "commit": commit,
+                "tree": commit_tree(cache_dir, org_name, lesson_name, commit),
+            }
+
+        commit = revealjs.result()
+        lock[get_submodules.REVEALJS_REPO] = {
+            "pin": get_submodules.REVEALJS_COMMIT,
+            "org-name": get_submodules.REVEALJS_ORG,
+            "commit": commit,
+            "tree": commit_tree(cache_dir, get_submodules.REVEALJS_ORG, get_submodules.REVEALJS_REPO, commit),
+        }
+
+        commit = setup_docs.result()
+        lock[SETUP_DOCS_REPO] = {
+            "org-name": SETUP_DOCS_ORG,
+            "branch": SETUP_DOCS_BRANCH,
+            "commit": commit,
+            "tree": commit_tree(cache_dir, SETUP_DOCS_ORG, SETUP_DOCS_REPO, commit),
+        }
+
+    if api is not None:
+        api.save()
+
+    try:
+        old_commits = locked_commits(load_lock(path))
+    except LockError:
+        old_commits = {}
+    for name, commit in locked_commits(lock).items():
+        if name not in old_commits:
+            log.info(f"Locked {name} at {commit[:10]}")
+        elif old_commits[name] != commit:
+            log.info(f"Locked {name} at {commit[:10]}, was {old_commits[name][:10]}")
+
+    save_lock(lock, path)
+
+    return lock
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """Make the command line parser, with defaults taken from the environment."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update = subparsers.add_parser("update", help=f"pin everything at the head of its branch in {LOCK_FILE}")
+    update.add_argument(
+        "-j", "--jobs", type=int, default=int(os.environ.get("RSG_BUILD_JOBS", 8)),
+        help="number of repositories to fetch concurrently, defaults to $RSG_BUILD_JOBS or 8"
+    )
+    update.add_argument(
+        "--cache-dir", type=Path, default=Path(os.environ.get("RSG_CACHE_DIR", DEFAULT_CACHE_DIR)),
+        help=f"directory to cache repositories in, defaults to $RSG_CACHE_DIR or {DEFAULT_CACHE_DIR}"
+    )
+    update.add_argument(
+        "--resolver", choices=["api", "ls-remote"], default=os.environ.get("RSG_RESOLVER", "api"),
+        help="how to check each lesson's org and branch, defaults to $RSG_RESOLVER or api"
+    )
+    update.add_argument(
+        "--checkout", choices=CHECKOUT_MODES, default=os.environ.get("RSG_CHECKOUT", "full"),
+        help="how the repositories will be checked out, defaults to $RSG_CHECKOUT or full"
+    )
+    subparsers.add_parser("check", help=f"check {LOCK_FILE} matches _config.yml")
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Run a command from the command line.
+
+    Parameters
+    ----------
+    argv:
+        The command line arguments, or None to use sys.argv.
+
+    Returns
+    -------
+    returncode:
+        0 if the command succeeded, otherwise 1.
+    """
+    args = argument_parser().parse_args(argv)
+    try:
+        website_config = load_config()
+        if args.command == "update":
+            update_lock(website_config, args.jobs, args.cache_dir, args.resolver, args.checkout)
+        else:
+            # get_submodules imports this module, so is only imported here
+            from get_setup import SETUP_DOCS_BRANCH, SETUP_DOCS_ORG, SETUP_DOCS_REPO
+            from get_submodules import REVEALJS_COMMIT, REVEALJS_REPO
+
+            lock = load_lock()
+            locked_lessons(lock, website_config)
+            locked_repository(lock, REVEALJS_REPO, {"pin": REVEALJS_COMMIT})
+            locked_repository(lock, SETUP_DOCS_REPO, {"org-name": SETUP_DOCS_ORG, "branch": SETUP_DOCS_BRANCH})
+            log.info(f"{LOCK_FILE} matches {website_config.path}")
+    except (ConfigError, LockError) as exc:
+        log.error(exc)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    instrumentation.configure_logging()
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""Shared store of processed lessons, for building many workshops.
+
+Processing a lesson, i.e. rewriting its episodes and building its slides,
+depends only on the lesson's commit and a few settings, so gives the same
+result for every workshop which uses the lesson at that commit. Processed
+lessons are kept in {cache_dir}/store/{kind}/{key}, where the key is a hash of
+everything the processing depends on. Slides are kept twice over: "slides"
+entries hold a lesson's whole deck by its commit, and "pandoc" entries just
+the HTML built from an index.md, which is found when a new commit leaves the
+slides alone. A workshop which needs a lesson that is
+already in the store has it put in place with reflinks or hardlinks, rather
+than processing it again.
+
+The files in the store are shared with the workshops they are linked into, so
+must never be written to in place. A build only ever replaces them.
+
+The store is bounded in size by evicting the least recently used entries.
+"""
+
+import os
+import time
+import logging
+from pathlib import Path
+from shutil import rmtree
+from typing import Callable, Dict, Iterable, Optional
+
+from asset_sync import clone_file, files_match
+from build_manifest import hash_inputs
+from lesson_cache import directory_size
+
+log = logging.getLogger(__name__)
+
+STORE_DIR = "store"
+
+# Part of every key, so bumping it when the way lessons are processed changes
+# means nothing processed the old way is used
+STORE_VERSION = 2
+
+DEFAULT_STORE_SIZE_MB = 512
+
+
+def artifact_key(*values) -> str:
+    """
+    Make the key of an entry in the store from everything it depends on.
+
+    Parameters
+    ----------
+    values:
+        The values the entry depends on, e.g. the lesson's commit.
+    """
+    return hash_inputs(STORE_VERSION, *values)
+
+
+def artifact_path(cache_dir: Path, kind: str, key: str) -> Path:
+    """
+    Get the path of an entry in the store.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    kind:
+        The kind of entry, e.g. "lessons" or "slides".
+    key:
+        The key of the entry, from artifact_key.
+    """
+    return Path(cache_dir) / STORE_DIR / kind / key
+
+
+def lookup_artifact(cache_dir: Path, kind: str, key: str) -> Optional[Path]:
+    """
+    Find an entry in the store, marking it as used.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    kind:
+        The kind of entry.
+    key:
+        The key of the entry.
+
+    Returns
+    -------
+    path:
+        The directory of the entry, or None if it is not in the store.
+    """
+    path = artifact_path(cache_dir, kind, key)
+    if not path.is_dir():
+        return None
+
+    os.utime(path)
+    return path
+
+
+def add_artifact(cache_dir: Path, kind: str, key: str, build: Callable[[Path], None]) -> Path:
+    """
+    Add an entry to the store.
+
+    The entry is built in a temporary directory which is then renamed into
+    place, so other builds never see a partly built entry. If another build
+    adds the same entry first, its entry is kept, as they are the same.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    kind:
+        The kind of entry.
+    key:
+        The key of the entry.
+    build:
+        Called with the directory to build the entry in.
+
+    Returns
+    -------
+    path:
+        The directory of the entry.
+    """
+    path = artifact_path(cache_dir, kind, key)
+    staging = path.with_name(f".{key}.{os.getpid()}.tmp")
+    rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+    try:
+        build(staging)
+        try:
+            os.rename(staging, path)
+        except OSError:
+            if not path.is_dir():
+                raise
+    finally:
+        rmtree(staging, ignore_errors=True)
+
+    return path
+
+
+def link_tree(src: Path, dest: Path, ignore: Iterable[str] = ()) -> int:
+    """
+    Reflink or hardlink every file in a directory into another, e.g. to add
+    files which have just been built to the store.
+
+    Parameters
+    ----------
+    src:
+        The directory to link the files from.
+    dest:
+        The directory to link them into.
+    ignore:
+        The names of files or directories at the top of src to leave out.
+
+    Returns
+    -------
+    files:
+        The number of files linked.
+    """
+    n_files = 0
+    for root, dirs, files in os.walk(src):
+        if Path(root) == Path(src):
+            dirs[:] = [name for name in dirs if name not in ignore]
+            files = [name for name in files if name not in ignore]
+        for name in files:
+            target = Path(dest) / Path(root).relative_to(src) / name
+            target.parent.mkdir(parents=True, exist_ok=True)
+            clone_file(Path(root) / name, target)
+            n_files += 1
+
+    return n_files
+
+
+def materialize(artifact: Path, dest: Path, keep: Iterable[str] = ()) -> Dict[str, int]:
+    """
+    Make a directory match an entry in the store, by linking its files.
+
+    Files already the same as in the entry are left alone, and files which are
+    not in the entry are removed.
+
+    Parameters
+    ----------
+    artifact:
+        The directory of the entry.
+    dest:
+        The directory to put the entry's files in.
+    keep:
+        The names of files or directories at the top of dest which are left
+        alone, e.g. ones written by a later stage.
+
+    Returns
+    -------
+    stats:
+        The number of files which were linked, were unchanged and were
+        removed.
+    """
+    artifact, dest = Path(artifact), Path(dest)
+    keep = set(keep)
+    stats = {"linked": 0, "unchanged": 0, "removed": 0}
+    wanted = set()
+    for root, _, files in os.walk(artifact):
+        for name in files:
+            relative = Path(root).relative_to(artifact) / name
+            wanted.add(relative)
+            src, target = artifact / relative, dest / relative
+            if files_match(src, target):
+                stats["unchanged"] += 1
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.unlink(missing_ok=True)
+            clone_file(src, target)
+            stats["linked"] += 1
+
+    for root, dirs, files in os.walk(dest):
+        if Path(root) == dest:
+            dirs[:] = [name for name in dirs if name not in keep]
+            files = [name for name in files if name not in keep]
+        for name in files:
+            relative = Path(root).relative_to(dest) / name
+            if relative not in wanted:
+                (dest / relative).unlink()
+                stats["removed"] += 1
+
+    return stats
+
+
+def evict_artifacts(cache_dir: Path, max_bytes: int) -> None:
+    """
+    Remove the least recently used entries until the store fits in max_bytes.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    max_bytes:
+        The maximum size of the store.
+    """
+    entries = [
+        (path.stat().st_mtime, directory_size(path), path)
+        for path in (Path(cache_dir) / STORE_DIR).glob("*/*") if not path.name.startswith(".")
+    ]
+
+    total = sum(size for _, size, _ in entries)
+    for last_used, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        log.info(f"Evicting {path} from the store, last used {time.ctime(last_used)}")
+        rmtree(path, ignore_errors=True)
+        total -= size
@@ -1,7 +1,153 @@
-from favicons import Favicons
+"""Generate the favicons in each size from the base images.
 
-favicon_dir = "assets/favicons/rsg/"
-base_favicon = favicon_dir+"rsg_fav_base.png"
+The favicons of each base image are written to the directory the image is in.
+By default there is one base image, assets/favicons/rsg/rsg_fav_base.png, and
+more can be listed under favicons in _config.yml, or given on the command
+line, so the favicons for several brandings are made in one run.
 
-with Favicons(base_favicon, favicon_dir) as favicons:
-    favicons.generate()
\ No newline at end of file
+A base image's favicons are only generated when the image, or the settings
+and version of the generator, have changed since the last build, as recorded
+in the build manifest. The base images are rendered at the same time in a
+pool of threads, each with its own generator, as Pillow releases the GIL while
+it resizes and saves images.
+"""
+
+import os
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
+from pathlib import Path
+from typing import List, Optional
+
+import instrumentation
+from build_manifest import hash_inputs, hash_path, is_up_to_date, load_manifest, record_stage, save_manifest
+from workshop_config import WorkshopConfig, load_config
+
+log = logging.getLogger(__name__)
+
+# The number of base images to render the favicons of at the same time
+DEFAULT_JOBS = os.cpu_count() or 1
+
+# Passed on to Favicons, so a change to them generates the favicons again
+FAVICON_SETTINGS = {"background_color": "#000000", "transparent": True}
+
+
+def generator_version() -> Optional[str]:
+    """Get the version of the favicons package, without importing it."""
+    try:
+        return metadata.version("favicons")
+    except metadata.PackageNotFoundError:
+        return None
+
+
+def favicon_directory(image: str) -> str:
+    """
+    Get the directory the favicons of a base image are written to.
+
+    Parameters
+    ----------
+    image:
+        The path to the base image.
+    """
+    return Path(image).parent.as_posix()
+
+
+def render_favicons(image: str) -> None:
+    """
+    Render every size of favicon for a base image.
+
+    Parameters
+    ----------
+    image:
+        The path to the base image.
+    """
+    # favicons pulls in Pillow and friends, so is only imported when needed
+    from favicons import Favicons
+
+    with Favicons(image, favicon_directory(image), **FAVICON_SETTINGS) as favicons:
+        favicons.generate()
+
+
+def generate_favicons(images: List[str], jobs: int = DEFAULT_JOBS) -> None:
+    """
+    Render every size of favicon for each base image.
+
+    Parameters
+    ----------
+    images:
+        The paths to the base images.
+    jobs:
+        The number of base images to render the favicons of at the same time.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        for _ in pool.map(render_favicons, images):
+            pass
+
+    log.info(f"Rendered the favicons from {', '.join(images)}")
+
+
+@instrumentation.traced("make_favicons")
+def main(images: Optional[List[str]] = None, jobs: int = DEFAULT_JOBS,
+         website_config: Optional[WorkshopConfig] = None) -> None:
+    """
+    Generate the favicons of each base image, unless they have not changed.
+
+    Parameters
+    ----------
+    images:
+        The paths to the base images, or None for the favicons in the website
+        config.
+    jobs:
+        The number of base images to render the favicons of at the same time.
+    website_config:
+        The website config, or None to load _config.yml.
+    """
+    if images is None:
+        if website_config is None:
+            website_config = load_config()
+        images = website_config.favicons
+
+    directories = [favicon_directory(image) for image in images]
+    if len(set(directories)) < len(directories):
+        raise ValueError(f"The base images {', '.join(images)} should each be in a different directory")
+
+    manifest = load_manifest()
+    version = generator_version()
+    stale = {}
+    for image, directory in zip(images, directories):
+        stage = f"make_favicons/{directory}"
+        inputs = hash_inputs(hash_path(image), FAVICON_SETTINGS, version)
+        if is_up_to_date(manifest, stage, inputs, [directory]):
+            log.info(f"Favicons for {image} have not changed since the last build, not generating")
+        else:
+            stale[image] = (stage, inputs, [directory])
+
+    if not stale:
+        return
+
+    generate_favicons(list(stale), jobs)
+
+    for stage, inputs, outputs in stale.values():
+        record_stage(manifest, stage, inputs, outputs)
+    save_manifest(manifest)
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """Make the command line parser."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "images", nargs="*", metavar="image",
+        help="a base image to generate favicons from, defaults to the favicons in _config.yml"
+    )
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=DEFAULT_JOBS,
+        help=f"number of base images to render the favicons of at the same time, defaults to {DEFAULT_JOBS}"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    instrumentation.configure_logging()
+    args = argument_parser().parse_args()
+    main(args.images or None, args.jobs)
@@ -0,0 +1,361 @@
+"""Rebuild only the parts of the website affected by each change, for local
+authoring.
+
+Once the website has been built with bin/build.py, bin/watch.py watches
+_config.yml, the lesson checkouts in submodules/ and the checkout of
+setup-documents, and maps each change to the least work which brings the
+website up to date:
+
+- an edit to a lesson's episodes or reference.md processes just that lesson
+  again from its checkout, i.e. its copy and frontmatter pass,
+- an edit to a lesson's blurb.html also writes the schedules, which show it,
+- an edit to a lesson's fig/, data/ or code/ merges the assets again,
+- an edit to a lesson's slides builds just its slides,
+- an edit to setup-documents, or to a lesson's _config.yml, writes setup.md,
+- an edit to _config.yml is compared with the config before it. A change to
+  the dates, start times, order or sessions writes the schedules, and
+  get_schedules.py only writes the detailed schedule of the lessons whose
+  entries changed. A change to a lesson's title also processes the lesson
+  again. Adding, removing or reordering lessons, or changing where they come
+  from, runs get_submodules.py, which replaces the checkouts in submodules/.
+
+The standard library has no inotify, so the watched files are polled: their
+sizes and modification times are read every --interval seconds, which takes
+a few milliseconds for a workshop. Everything is rebuilt in this process,
+with the build modules imported once, so a change is rebuilt well within a
+second. A lesson edited in its checkout is never taken from the lesson store,
+as the store only knows the lesson's commit. Run `bundle exec jekyll serve`
+alongside to see the changes in the website.
+"""
+
+import os
+import time
+import argparse
+import logging
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from yaml import YAMLError
+
+import get_schedules
+import get_setup
+import get_submodules
+import instrumentation
+from build import run_stage
+from build_manifest import load_manifest, save_manifest
+from get_setup import SETUP_DOCS_PATH, SETUP_DOCS_PATHS
+from get_submodules import LESSON_PATHS, SHARED_DIRECTORIES
+from workshop_config import CONFIG_FILE, ConfigError, WorkshopConfig, load_config
+
+log = logging.getLogger(__name__)
+
+# How often the watched files are checked for changes, in seconds
+DEFAULT_INTERVAL = 0.25
+
+# How long to wait for more changes after the first, e.g. while an editor
+# saves a file, in seconds
+DEBOUNCE = 0.05
+
+# The order the kinds of work are done in, as later work reads what earlier
+# work writes. "lessons" runs get_submodules.py
+ACTIONS = ["lessons", "content", "slides", "assets", "favicons", "schedules", "setup"]
+
+# The work get_submodules.py does for every lesson
+LESSON_ACTIONS = ["content", "slides", "assets"]
+
+# The files in a lesson which are processed into its content
+CONTENT_FILES = ["_episodes", "blurb.html", "reference.md"]
+
+Action = Tuple[str, Optional[str]]
+
+
+def watched_paths(website_config: WorkshopConfig) -> List[Path]:
+    """
+    List the files and directories to watch.
+
+    Parameters
+    ----------
+    website_config:
+        The website config, with the lessons to watch.
+    """
+    paths = [Path(CONFIG_FILE)]
+    for lesson_name in website_config.lesson_names:
+        paths.extend(Path(f"submodules/{lesson_name}/{path}") for path in LESSON_PATHS)
+    paths.extend(Path(SETUP_DOCS_PATH) / path for path in SETUP_DOCS_PATHS)
+    return paths
+
+
+def snapshot(paths: Iterable[Path]) -> Dict[str, Tuple[int, int]]:
+    """
+    Get the size and modification time of every file in the watched paths.
+
+    Hidden files, such as editors' swap files, are left out.
+
+    Parameters
+    ----------
+    paths:
+        The files and directories to look in.
+
+    Returns
+    -------
+    files:
+        The modification time and size of each file, keyed by its path.
+    """
+    files = {}
+    for path in paths:
+        if path.is_file():
+            stat = path.stat()
+            files[path.as_posix()] = (stat.st_mtime_ns, stat.st_size)
+            continue
+        for directory, dirs, names in os.walk(path):
+            dirs[:] = [name for name in dirs if not name.startswith(".")]
+            for name in names:
+                if name.startswith(".") or name.endswith("~"):
+                    continue
+                file = Path(directory) / name
+                try:
+                    stat = file.stat()
+                except FileNotFoundError:
+                    continue
+                files[file.as_posix()] = (stat.st_mtime_ns, stat.st_size)
+
+    return files
+
+
+def path_actions(path: str) -> Set[Action]:
+    """
+    Get the work needed after a watched file has changed.
+
+    Parameters
+    ----------
+    path:
+        The path of the file.
+
+    Returns
+    -------
+    actions:
+        Each kind of work, one of ACTIONS, with the lesson it is for or None.
+    """
+    parts = PurePosixPath(path).parts
+    if path == CONFIG_FILE:
+        return {("config", None)}
+    if path.startswith(f"{SETUP_DOCS_PATH}/"):
+        return {("setup", None)}
+    if len(parts) < 3 or parts[0] != "submodules":
+        return set()
+
+    lesson_name, top = parts[1], parts[2]
+    if top == "blurb.html":
+        return {("content", lesson_name), ("schedules", None)}
+    if top in CONTENT_FILES:
+        return {("content", lesson_name)}
+    if top in SHARED_DIRECTORIES:
+        return {("assets", None)}
+    if top == "slides":
+        return {("slides", lesson_name)}
+    if top == "_config.yml":
+        return {("setup", None)}
+    return set()
+
+
+def config_actions(old: WorkshopConfig, new: WorkshopConfig) -> Set[Action]:
+    """
+    Get the work needed after _config.yml has changed.
+
+    Parameters
+    ----------
+    old:
+        The config before the change.
+    new:
+        The config after the change.
+
+    Returns
+    -------
+    actions:
+        Each kind of work, one of ACTIONS, with the lesson it is for or None.
+    """
+    def sources(config):
+        return [(lesson.get("gh-name"), lesson.get("org-name"), lesson.get("branch")) for lesson in config.lessons]
+
+    actions = set()
+    if sources(old) != sources(new):
+        actions.update({("lessons", None), ("setup", None)})
+    else:
+        old_lessons = dict(zip(old.lesson_names, old.lessons))
+        for lesson_name, lesson in zip(new.lesson_names, new.lessons):
+            if lesson.get("title") != old_lessons[lesson_name].get("title"):
+                actions.add(("content", lesson_name))
+
+    if any(old.get(key) != new.get(key) for key in get_schedules.SCHEDULE_CONFIG_KEYS):
+        actions.add(("schedules", None))
+    if old.setup_docs != new.setup_docs or old.title != new.title:
+        actions.add(("setup", None))
+    if old.favicons != new.favicons:
+        actions.add(("favicons", None))
+
+    return actions
+
+
+class Rebuilder:
+    """
+    Do the work for a set of changes, with the options the scripts would use.
+
+    Parameters
+    ----------
+    cache_dir:
+        The directory containing the cache.
+    """
+
+    def __init__(self, cache_dir: Optional[Path] = None):
+        self.options = get_submodules.argument_parser().parse_args([])
+        self.cache_dir = cache_dir or self.options.cache_dir
+        self._pandoc_version = None
+
+    @property
+    def pandoc_version(self) -> Optional[str]:
+        """The version of pandoc, found the first time slides are built."""
+        if self._pandoc_version is None:
+            self._pandoc_version = get_submodules.get_pandoc_version() or ""
+        return self._pandoc_version or None
+
+    def rebuild(self, actions: Set[Action], website_config: WorkshopConfig) -> None:
+        """
+        Do the work for a set of changes, in the order of ACTIONS.
+
+        Parameters
+        ----------
+        actions:
+            The work to do, from path_actions and config_actions.
+        website_config:
+            The website config.
+        """
+        kinds = {kind for kind, _ in actions}
+        if "lessons" in kinds:
+            log.warning("The lessons have changed, so the checkouts in submodules/ are replaced")
+            run_stage("get_submodules", website_config, cache_dir=self.cache_dir)
+
+        lessons = dict(zip(website_config.lesson_names, website_config.lessons))
+
+        def lessons_to(kind):
+            return sorted(lesson_name for action, lesson_name in actions if action == kind and lesson_name in lessons)
+
+        if "content" in kinds:
+            manifest = load_manifest()
+            for lesson_name in lessons_to("content"):
+                get_submodules.copy_lesson_content(lesson_name, lessons[lesson_name], None, self.cache_dir, manifest)
+            save_manifest(manifest)
+
+        if "slides" in kinds:
+            command = get_submodules.pandoc_command(self.options.revealjs)
+            for lesson_name in lessons_to("slides"):
+                has_slides = get_submodules.copy_lesson_slides(lesson_name, self.options.revealjs)
+                if has_slides and self.pandoc_version is not None:
+                    get_submodules.render_lesson_slides(lesson_name, self.cache_dir, self.pandoc_version, command)
+
+        if "assets" in kinds:
+            manifest = load_manifest()
+            get_submodules.sync_lesson_assets(manifest, website_config)
+            save_manifest(manifest)
+
+        if "favicons" in kinds:
+            run_stage("make_favicons", website_config)
+        if "schedules" in kinds:
+            get_schedules.main(website_config)
+        if "setup" in kinds:
+            get_setup.build_setup(website_config)
+
+
+def describe(actions: Set[Action]) -> str:
+    """Describe a set of changes, e.g. "content of shell-novice, schedules"."""
+    descriptions = []
+    for kind in ACTIONS:
+        lesson_names = sorted(lesson_name for action, lesson_name in actions if action == kind and lesson_name)
+        if lesson_names:
+            descriptions.append(f"{kind} of {', '.join(lesson_names)}")
+        elif (kind, None) in actions:
+            descriptions.append(kind)
+    return ", ".join(descriptions)
+
+
+def watch(interval: float = DEFAULT_INTERVAL, cache_dir: Optional[Path] = None) -> None:
+    """
+    Watch for changes, and rebuild what each affects.
+
+    Parameters
+    ----------
+    interval:
+        How often to check for changes, in seconds.
+    cache_dir:
+        The directory containing the cache, or None for the default.
+    """
+    website_config = load_config()
+    rebuilder = Rebuilder(cache_dir)
+    paths = watched_paths(website_config)
+    state = snapshot(paths)
+    log.info(f"Watching {CONFIG_FILE}, {len(website_config.lesson_names)} lessons and setup-documents for changes")
+
+    while True:
+        time.sleep(interval)
+        new_state = snapshot(paths)
+        if new_state == state:
+            continue
+
+        # Let a burst of writes finish, so they are rebuilt together
+        time.sleep(DEBOUNCE)
+        new_state = snapshot(paths)
+        changed = sorted(path for path in state.keys() | new_state.keys() if state.get(path) != new_state.get(path))
+        state = new_state
+
+        start = time.perf_counter()
+        actions = set().union(*(path_actions(path) for path in changed))
+        if ("config", None) in actions:
+            actions.discard(("config", None))
+            try:
+                new_config = load_config()
+            except (ConfigError, YAMLError) as exc:
+                log.error(f"{CONFIG_FILE} is not valid, so is not rebuilt: {exc}")
+                continue
+            actions |= config_actions(website_config, new_config)
+            website_config = new_config
+
+        if ("lessons", None) in actions:
+            actions = {action for action in actions if action[0] not in LESSON_ACTIONS}
+        if not actions:
+            continue
+
+        log.info(f"{', '.join(changed[:3])}{' and more' if len(changed) > 3 else ''} changed, rebuilding "
+                 f"{describe(actions)}")
+        try:
+            rebuilder.rebuild(actions, website_config)
+        except Exception as exc:
+            log.error(f"Rebuilding failed, fix the problem and save again: {exc}")
+        else:
+            log.info(f"Rebuilt {describe(actions)} in {time.perf_counter() - start:.2f} s")
+
+        # The lessons may have been checked out again, or changed
+        paths = watched_paths(website_config)
+        if any(kind == "lessons" for kind, _ in actions):
+            state = snapshot(paths)
+
+
+def argument_parser() -> argparse.ArgumentParser:
+    """Make the command line parser, with defaults taken from the environment."""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--interval", type=float, default=float(os.environ.get("RSG_WATCH_INTERVAL", DEFAULT_INTERVAL)),
+        help=f"seconds between checks for changes, defaults to $RSG_WATCH_INTERVAL or {DEFAULT_INTERVAL}"
+    )
+    parser.add_argument(
+        "--cache-dir", type=Path, default=None,
+        help="directory containing the cache, defaults to the one get_submodules.py uses"
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    instrumentation.configure_logging()
+    args = argument_parser().parse_args()
+    try:
+        watch(args.interval, args.cache_dir)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,207 @@
+"""Load and check the website's _config.yml.
+
+The config is parsed once, with the C YAML loader when PyYAML has been built
+with it, checked, and then shared by every build stage running in the same
+process. It is only parsed again if the file changes.
+
+WorkshopConfig behaves like the dictionary from _config.yml, so stages can
+still look up any key, and also has typed attributes for the keys the build
+relies on.
+"""
+
+import os
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from yaml import load
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+CONFIG_FILE = "_config.yml"
+
+# The kinds of website, and the ways a workshop can be delivered, which the
+# schedules can be made for
+KINDS = ["workshop", "lesson"]
+DELIVERIES = ["dated", "static"]
+
+# The base images the favicons are generated from, when _config.yml does not
+# list any
+DEFAULT_FAVICONS = ["assets/favicons/rsg/rsg_fav_base.png"]
+
+# Configs already loaded, keyed by the path, modification time and size of
+# the file
+_loaded: Dict[Tuple[str, int, int], "WorkshopConfig"] = {}
+
+
+class ConfigError(ValueError):
+    """Raised when _config.yml is missing something the build needs."""
+
+
+def session_problems(sessions: Any, where: str) -> List[str]:
+    """
+    Check a list of the sessions of a day, for the schedules.
+
+    Parameters
+    ----------
+    sessions:
+        The sessions from _config.yml.
+    where:
+        What the sessions are for, used in the problems found.
+
+    Returns
+    -------
+    problems:
+        The problems with the sessions, if any.
+    """
+    if not isinstance(sessions, list) or not sessions:
+        return [f"the sessions of {where} should be a list"]
+
+    return [
+        f"session {n} of {where} should have a time and a session"
+        for n, session in enumerate(sessions)
+        if not isinstance(session, dict) or session.get("time") is None or session.get("session") is None
+    ]
+
+
+class WorkshopConfig(Mapping):
+    """
+    The contents of _config.yml, checked for what the build needs.
+
+    Parameters
+    ----------
+    data:
+        The parsed contents of _config.yml.
+    path:
+        The file the config was read from, used in error messages.
+    """
+
+    def __init__(self, data: Dict[str, Any], path: Path = Path(CONFIG_FILE)):
+        self.path = Path(path)
+        self.data = data if data is not None else {}
+        self.validate()
+
+    def __getitem__(self, key: str) -> Any:
+        return self.data[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def title(self) -> str:
+        """The title of the website."""
+        return self.data["title"]
+
+    @property
+    def kind(self) -> Optional[str]:
+        """The kind of website, one of KINDS."""
+        return self.data.get("kind")
+
+    @property
+    def delivery(self) -> Optional[str]:
+        """How a workshop is delivered, one of DELIVERIES."""
+        return self.data.get("delivery")
+
+    @property
+    def lessons(self) -> List[Dict[str, Any]]:
+        """The lessons in the workshop, as their entries in _config.yml."""
+        return self.data.get("lessons") or []
+
+    @property
+    def lesson_names(self) -> List[str]:
+        """The name of each lesson, i.e. gh-name, in config order."""
+        return [lesson["gh-name"] for lesson in self.lessons]
+
+    @property
+    def setup_docs(self) -> List[str]:
+        """The setup documents needed by the workshop as a whole."""
+        return list(self.data.get("setup_docs") or [])
+
+    @property
+    def favicons(self) -> List[str]:
+        """The base images to generate favicons from, each into its own directory."""
+        return list(self.data.get("favicons") or DEFAULT_FAVICONS)
+
+    def validate(self) -> None:
+        """
+        Check the config has what the build needs.
+
+        Every problem is reported at once, rather than one stage at a time.
+        Raises ConfigError if there are any problems.
+        """
+        problems = []
+        if not isinstance(self.data, dict):
+            raise ConfigError(f"{self.path} should contain a mapping of keys to values")
+
+        if not self.data.get("title"):
+            problems.append("title has not been set")
+
+        if self.kind is None:
+            problems.append("kind has not been set")
+        elif self.kind not in KINDS:
+            problems.append(f'kind "{self.kind}" is unknown, it should be one of {", ".join(KINDS)}')
+
+        if self.kind == "workshop":
+            if self.delivery not in DELIVERIES:
+                problems.append(
+                    f'delivery "{self.delivery}" is unknown for a workshop, it should be one of {", ".join(DELIVERIES)}'
+                )
+
+            lessons = self.data.get("lessons")
+            if not lessons:
+                problems.append("lessons is empty, a workshop needs at least one lesson")
+            elif not isinstance(lessons, list):
+                problems.append("lessons should be a list")
+            else:
+                for n, lesson in enumerate(lessons):
+                    if not isinstance(lesson, dict):
+                        problems.append(f"lesson {n} should be a mapping of keys to values")
+                        continue
+                    if not lesson.get("gh-name") or not isinstance(lesson["gh-name"], str):
+                        problems.append(f"lesson {n} ({lesson.get('title', 'untitled')}) has no gh-name")
+                    for key in ("org-name", "branch"):
+                        if key in lesson and not isinstance(lesson[key], str):
+                            problems.append(f"{key} of lesson {n} should be a string")
+                    if "sessions" in lesson:
+                        problems += session_problems(lesson["sessions"], f"lesson {n}")
+
+        if "sessions" in self.data:
+            problems += session_problems(self.data["sessions"], "the workshop")
+
+        setup_docs = self.data.get("setup_docs")
+        if setup_docs is not None and not isinstance(setup_docs, list):
+            problems.append("setup_docs should be a list")
+
+        favicons = self.data.get("favicons")
+        if favicons is not None:
+            if not isinstance(favicons, list) or not all(isinstance(image, str) for image in favicons):
+                problems.append("favicons should be a list of paths to images")
+            elif len({str(Path(image).parent) for image in favicons}) < len(favicons):
+                problems.append("each of the favicons should be in a different directory")
+
+        if problems:
+            raise ConfigError(f"Problems with {self.path}:\n - " + "\n - ".join(problems))
+
+
+def load_config(path: Path = CONFIG_FILE) -> WorkshopConfig:
+    """
+    Load _config.yml, or reuse it if it has already been loaded.
+
+    Parameters
+    ----------
+    path:
+        The config file to load.
+    """
+    stat = os.stat(path)
+    key = (str(Path(path).resolve()), stat.st_mtime_ns, stat.st_size)
+    if key not in _loaded:
+        with open(path, "r") as fp:
+            _loaded[key] = WorkshopConfig(load(fp, Loader=Loader), path)
+
+    return _loaded[key]